@@ -0,0 +1,173 @@
+"""
+In-memory membership filter of existing account addresses.
+
+doveauth uses an AddressFilter to answer lookups
+for addresses that definitely do not exist without touching disk.
+The filter is a Bloom filter, so it may contain addresses
+which do not exist (false positives, or accounts removed by chatmail-expire)
+but never misses an address which was added.
+
+Bits are packed eight per byte in anonymous shared memory,
+so pre-forked worker processes share the filter.
+Setting a bit modifies its whole byte, so additions hold a lock
+shared by the processes and never lose each other's bits.
+There are two such buffers: additions go to both,
+lookups use the active one and a rebuild scans the mailboxes directory
+into the inactive one before making it active,
+which drops addresses of removed accounts.
+"""
+
+import hashlib
+import logging
+import math
+import mmap
+import multiprocessing
+import struct
+import threading
+import time
+
+from .mailboxes import iter_mailbox_dirs
+
+# minimum number of addresses the filter is sized for
+MIN_CAPACITY = 100_000
+
+# targeted false positive rate when holding `capacity` addresses
+ERROR_RATE = 0.01
+
+# seconds between two rebuilds from the mailboxes directory
+REBUILD_INTERVAL = 6 * 3600
+
+
+class AddressFilter:
+    def __init__(self, capacity, error_rate=ERROR_RATE):
+        self.capacity = capacity
+        self.numbits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.numhashes = get_numhashes(error_rate)
+        # every hash is a 32 bit slice of one blake2b digest
+        assert self.numhashes <= 16 and self.numbits < 2**32
+        self._unpack_hashes = struct.Struct(f"<{self.numhashes}I").unpack
+        self.numbytes = (self.numbits + 7) // 8
+        # byte 0 holds the index of the active buffer
+        self._mem = mmap.mmap(-1, 1 + 2 * self.numbytes)
+        self._buffers = (
+            memoryview(self._mem)[1 : 1 + self.numbytes],
+            memoryview(self._mem)[1 + self.numbytes :],
+        )
+        # created before forking, so all worker processes share it
+        self._write_lock = multiprocessing.Lock()
+        self._rebuild_lock = threading.Lock()
+
+    @classmethod
+    def from_mailboxes_dir(cls, mailboxes_dir, error_rate=ERROR_RATE):
+        """Return a filter of all addresses in `mailboxes_dir`
+        with room for twice as many.
+
+        The directory is scanned once, keeping only the digests
+        of the addresses until the number of addresses is known.
+        """
+        digest_size = 4 * get_numhashes(error_rate)
+        digests = bytearray()
+        for addr in iter_addresses(mailboxes_dir):
+            digests += hashlib.blake2b(addr.encode(), digest_size=digest_size).digest()
+        num = len(digests) // digest_size
+        addrfilter = cls(max(2 * num, MIN_CAPACITY), error_rate=error_rate)
+        bits = addrfilter._get_bits(
+            digests[i : i + digest_size] for i in range(0, len(digests), digest_size)
+        )
+        addrfilter._buffers[0][:] = bits
+        addrfilter._buffers[1][:] = bits
+        return addrfilter
+
+    def _get_indexes(self, addr):
+        digest = hashlib.blake2b(addr.encode(), digest_size=4 * self.numhashes)
+        numbits = self.numbits
+        return [x % numbits for x in self._unpack_hashes(digest.digest())]
+
+    def _get_bits(self, digests):
+        """Return the packed bits of `digests` of addresses."""
+        bits = bytearray(self.numbytes)
+        unpack_hashes, numbits = self._unpack_hashes, self.numbits
+        for digest in digests:
+            for h in unpack_hashes(digest):
+                x = h % numbits
+                bits[x >> 3] |= 1 << (x & 7)
+        return bits
+
+    def add(self, addr):
+        """Add `addr` which must be called after its mailbox was created."""
+        buffers = self._buffers
+        indexes = self._get_indexes(addr)
+        with self._write_lock:
+            for index in indexes:
+                bit = 1 << (index & 7)
+                buffers[0][index >> 3] |= bit
+                buffers[1][index >> 3] |= bit
+
+    def __contains__(self, addr):
+        active = self._buffers[self._mem[0]]
+        digest = hashlib.blake2b(addr.encode(), digest_size=4 * self.numhashes)
+        numbits = self.numbits
+        for h in self._unpack_hashes(digest.digest()):
+            x = h % numbits
+            if not active[x >> 3] >> (x & 7) & 1:
+                return False
+        return True
+
+    def rebuild(self, mailboxes_dir):
+        """Rebuild the filter from `mailboxes_dir`
+        and return the number of addresses found.
+
+        Addresses added concurrently, from this or other processes,
+        are kept because the inactive buffer is cleared before scanning
+        and the scanned bits are merged into it.
+        """
+        with self._rebuild_lock:
+            inactive_index = 1 - self._mem[0]
+            inactive = self._buffers[inactive_index]
+            with self._write_lock:
+                inactive[:] = bytes(self.numbytes)
+            num = 0
+            blake2b, digest_size = hashlib.blake2b, 4 * self.numhashes
+
+            def iter_digests():
+                nonlocal num
+                for addr in iter_addresses(mailboxes_dir):
+                    num += 1
+                    yield blake2b(addr.encode(), digest_size=digest_size).digest()
+
+            bits = int.from_bytes(self._get_bits(iter_digests()), "little")
+            with self._write_lock:
+                bits |= int.from_bytes(inactive, "little")
+                inactive[:] = bits.to_bytes(self.numbytes, "little")
+                self._mem[0] = inactive_index
+        if num > self.capacity:
+            logging.warning(
+                f"{num} accounts exceed the address filter capacity {self.capacity},"
+                " restart doveauth to resize it"
+            )
+        return num
+
+    def start_rebuilder(self, mailboxes_dir, interval=REBUILD_INTERVAL):
+        """Start a daemon thread rebuilding the filter every `interval` seconds."""
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.rebuild(mailboxes_dir)
+                except OSError:
+                    logging.exception("could not rebuild address filter")
+
+        thread = threading.Thread(target=run, daemon=True, name="addrfilter")
+        thread.start()
+        return thread
+
+
+def get_numhashes(error_rate):
+    """Return the number of hashes of a filter with `error_rate`."""
+    return max(1, round(-math.log(error_rate) / math.log(2)))
+
+
+def iter_addresses(mailboxes_dir):
+    for addr, _ in iter_mailbox_dirs(mailboxes_dir):
+        yield addr
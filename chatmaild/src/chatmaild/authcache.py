@@ -0,0 +1,118 @@
+"""
+Flush entries of the Dovecot authentication cache.
+
+With ``auth_cache_ttl`` set in chatmail.ini, Dovecot caches
+passdb and userdb replies of doveauth, including negative ones
+for addresses which have no account.
+When doveauth creates an account or chatmail-expire removes one,
+the cached entries of the address are stale and are flushed
+through the auth-master socket, as ``doveadm auth cache flush`` does.
+Creations which are only rejected for the moment
+are answered with a failure, which Dovecot does not cache.
+"""
+
+import itertools
+import logging
+import queue
+import socket
+import threading
+
+AUTH_MASTER_SOCKET = "/run/dovecot/auth-master"
+
+# https://doc.dovecot.org/2.3/developer_manual/design/auth_protocol/
+AUTH_MASTER_VERSION = "VERSION\t1\t0\n"
+
+# maximum number of addresses flushed with one CACHE-FLUSH command
+FLUSH_BATCH_SIZE = 100
+
+# seconds to wait for a reply from the auth process
+FLUSH_TIMEOUT = 5.0
+
+
+class AuthCacheFlusher:
+    """Flush cached authentication entries of addresses.
+
+    `flush` blocks until Dovecot replied,
+    `flush_later` queues addresses for a thread
+    which is started with `start` and flushes them in batches
+    without delaying the caller.
+    """
+
+    def __init__(self, socket_path=None, timeout=FLUSH_TIMEOUT):
+        self.socket_path = socket_path or AUTH_MASTER_SOCKET
+        self.timeout = timeout
+        self.failed = 0
+        self._queue = queue.SimpleQueue()
+        self._request_ids = itertools.count(1)
+
+    def flush(self, addrs):
+        """Flush the cache entries of `addrs` and return the number of removed entries.
+
+        Raises OSError if the auth process cannot be reached
+        and ValueError if it did not accept the command.
+        """
+        addrs = list(addrs)
+        if not addrs:
+            return 0
+        request_id = str(next(self._request_ids))
+        for addr in addrs:
+            if "\t" in addr or "\n" in addr:
+                raise ValueError(f"invalid address {addr!r}")
+        command = "\t".join(["CACHE-FLUSH", request_id, *addrs]) + "\n"
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            sock.sendall((AUTH_MASTER_VERSION + command).encode())
+            rfile = sock.makefile("r", encoding="utf8")
+            for line in rfile:
+                parts = line.rstrip("\n").split("\t")
+                # skip the VERSION and SPID lines greeting the client
+                if parts[0] in ("VERSION", "SPID") or parts[1:2] != [request_id]:
+                    continue
+                if parts[0] == "OK":
+                    return int(parts[2]) if len(parts) > 2 else 0
+                raise ValueError(f"auth cache flush failed: {line.strip()}")
+        raise ValueError("auth process closed connection without reply")
+
+    def flush_quietly(self, addrs):
+        """Flush the cache entries of `addrs` and log instead of raising errors.
+
+        A missing socket means Dovecot does not run or has no cache configured.
+        """
+        try:
+            return self.flush(addrs)
+        except FileNotFoundError:
+            logging.debug(f"no auth cache to flush at {self.socket_path}")
+        except (OSError, ValueError) as e:
+            self.failed += 1
+            logging.warning(f"could not flush auth cache: {e}")
+        return 0
+
+    def flush_later(self, addr):
+        """Queue `addr` to be flushed by the thread started with `start`."""
+        self._queue.put(addr)
+
+    def flush_queued(self, batch=()):
+        """Flush `batch` and all queued addresses
+        in batches of at most FLUSH_BATCH_SIZE."""
+        batch = list(batch)
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) >= FLUSH_BATCH_SIZE:
+                self.flush_quietly(batch)
+                batch = []
+        self.flush_quietly(batch)
+
+    def start(self):
+        def run():
+            while True:
+                # wait for an address, then flush it with all queued ones
+                self.flush_queued([self._queue.get()])
+
+        thread = threading.Thread(target=run, daemon=True, name="authcacheflush")
+        thread.start()
+        return thread
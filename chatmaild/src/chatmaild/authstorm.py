@@ -0,0 +1,326 @@
+"""
+Benchmark doveauth under a storm of account creations.
+
+    chatmail-auth-storm /usr/local/lib/chatmaild/chatmail.ini --clients 50 --duration 10
+
+serves doveauth on a temporary mailboxes directory.
+`clients` concurrent dict connections send first-login passdb lookups
+for fresh addresses as fast as they are answered,
+while one more connection logs in existing users.
+The report shows accounts created per second,
+latency percentiles of creations and of the existing users' logins
+during the storm, and the filesystem operations one account creation needs.
+"""
+
+import builtins
+import io
+import itertools
+import os
+import socket
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from collections import Counter
+from pathlib import Path
+
+from .config import read_config
+from .dictreplay import percentile
+from .doveauth import AuthDictProxy
+
+# functions counted as filesystem operations by FsOpCounter
+FS_OPS = {
+    os: (
+        "stat",
+        "lstat",
+        "open",
+        "link",
+        "rename",
+        "replace",
+        "unlink",
+        "mkdir",
+        "utime",
+        "listdir",
+        "scandir",
+    ),
+    io: ("open",),
+    builtins: ("open",),
+}
+
+PASSWORD = "q9mr3faue1storm"
+
+
+class FsOpCounter:
+    """Count calls of FS_OPS functions by name while used as a context manager.
+
+    Only calls of the thread which entered the context are counted,
+    calls of other threads of the process are not.
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+        self._saved = []
+        self._thread_id = None
+
+    def _wrap(self, name, func):
+        counts = self.counts
+
+        def counted(*args, **kwargs):
+            if threading.get_ident() == self._thread_id:
+                counts[name] += 1
+            return func(*args, **kwargs)
+
+        return counted
+
+    def __enter__(self):
+        self._thread_id = threading.get_ident()
+        for module, names in FS_OPS.items():
+            for name in names:
+                func = getattr(module, name)
+                self._saved.append((module, name, func))
+                setattr(module, name, self._wrap(name, func))
+        return self
+
+    def __exit__(self, *exc):
+        while self._saved:
+            module, name, func = self._saved.pop()
+            setattr(module, name, func)
+
+
+class StormStats:
+    def __init__(self):
+        self.created = 0
+        self.rejected = 0
+        self.errors = 0
+        self.duration = 0.0
+        self.creation_latencies = []
+        self.login_latencies = []
+        self.fs_ops = Counter()
+        self.fs_ops_creations = 0
+        self._lock = threading.Lock()
+
+    @property
+    def creations_per_second(self):
+        return self.created / max(self.duration, 1e-9)
+
+    @property
+    def fs_ops_per_creation(self):
+        return sum(self.fs_ops.values()) / max(self.fs_ops_creations, 1)
+
+    def get_summary(self):
+        ops = ", ".join(f"{name} {num}" for name, num in sorted(self.fs_ops.items()))
+        return "\n".join(
+            [
+                f"{self.created} accounts created in {self.duration:.2f} seconds:"
+                f" {self.creations_per_second:.0f} creations/s,"
+                f" {self.rejected} rejected, {self.errors} errors",
+                f"{'lookup': <10} {'count':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}",
+                self.format_line("create", sorted(self.creation_latencies)),
+                self.format_line("login", sorted(self.login_latencies)),
+                f"{self.fs_ops_per_creation:.1f} filesystem operations per creation"
+                f" ({ops} in {self.fs_ops_creations} creations)",
+            ]
+        )
+
+    def format_line(self, name, latencies):
+        p50, p95, p99 = (percentile(latencies, q) * 1000 for q in (0.5, 0.95, 0.99))
+        return f"{name: <10} {len(latencies):>8} {p50:8.2f} {p95:8.2f} {p99:8.2f}"
+
+
+def passdb_request(addr, password=PASSWORD):
+    return f'Lshared/passdb/{password}"{addr}\t{addr}\n'.encode()
+
+
+class StormClient:
+    """A dict connection sending passdb lookups one after another."""
+
+    def __init__(self, socket_path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(30)
+        self.sock.connect(socket_path)
+        self.rfile = self.sock.makefile("rb")
+
+    def login(self, addr):
+        """Return the reply status character and latency of logging in `addr`."""
+        sent = time.perf_counter()
+        self.sock.sendall(passdb_request(addr))
+        reply = self.rfile.readline()
+        return reply[:1], time.perf_counter() - sent
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+class AuthStorm:
+    """Run account creation storms against a doveauth socket.
+
+    New addresses have localparts of ``username_max_length`` characters
+    and are unique within the mailboxes directory of `config`.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._counter = itertools.count()
+
+    def new_address(self):
+        length = self.config.username_max_length
+        localpart = f"s{next(self._counter):0{length - 1}x}"
+        return f"{localpart}@{self.config.mail_domain}"
+
+    def create_existing(self, dictproxy, num):
+        """Create and return `num` accounts through `dictproxy`."""
+        addrs = [self.new_address() for _ in range(num)]
+        for addr in addrs:
+            assert dictproxy.lookup_passdb(addr, PASSWORD), addr
+        return addrs
+
+    def count_fs_ops(self, dictproxy, num, stats):
+        """Count the filesystem operations of `num` account creations."""
+        addrs = [self.new_address() for _ in range(num)]
+        with FsOpCounter() as counter:
+            for addr in addrs:
+                assert dictproxy.lookup_passdb(addr, PASSWORD), addr
+        stats.fs_ops.update(counter.counts)
+        stats.fs_ops_creations += num
+
+    def run(self, socket_path, existing, clients, duration, stats):
+        """Create accounts from `clients` connections for `duration` seconds
+        while logging in the `existing` addresses from one more connection."""
+        stop = threading.Event()
+
+        def create():
+            client = StormClient(socket_path)
+            try:
+                while not stop.is_set():
+                    status, latency = client.login(self.new_address())
+                    with stats._lock:
+                        if status == b"O":
+                            stats.created += 1
+                            stats.creation_latencies.append(latency)
+                        else:
+                            stats.rejected += 1
+            except OSError:
+                with stats._lock:
+                    stats.errors += 1
+            finally:
+                client.close()
+
+        def login():
+            client = StormClient(socket_path)
+            try:
+                for addr in itertools.cycle(existing):
+                    if stop.is_set():
+                        break
+                    status, latency = client.login(addr)
+                    if status != b"O":
+                        raise OSError(f"login of existing {addr} failed")
+                    stats.login_latencies.append(latency)
+                    # leave the connection idle briefly, as logins come in
+                    time.sleep(0.001)
+            except OSError:
+                with stats._lock:
+                    stats.errors += 1
+            finally:
+                client.close()
+
+        threads = [threading.Thread(target=create) for _ in range(clients)]
+        if existing:
+            threads.append(threading.Thread(target=login))
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        stats.duration = time.perf_counter() - start
+        return stats
+
+
+def serve_temporary(dictproxy, socket_path, config, engine=None):
+    thread = threading.Thread(
+        target=dictproxy.serve_forever_from_socket,
+        args=(socket_path,),
+        kwargs=dict(
+            engine=engine or config.dictproxy_engine,
+            max_threads=config.dictproxy_max_threads,
+            max_queue=config.dictproxy_max_queue,
+            queue_budget=config.dictproxy_queue_budget,
+        ),
+        daemon=True,
+    )
+    thread.start()
+    while not os.path.exists(socket_path):
+        time.sleep(0.01)
+
+
+def run_storm(config, tmpdir, clients=10, duration=5.0, existing=100, engine=None):
+    """Run a storm against doveauth serving a mailboxes directory in `tmpdir`
+    and return its StormStats."""
+    config.mailboxes_dir = Path(tmpdir).joinpath("mailboxes")
+    config.mailboxes_dir.mkdir()
+    dictproxy = AuthDictProxy(config=config)
+    dictproxy.init_address_filter()
+    socket_path = os.path.join(tmpdir, "doveauth.socket")
+    serve_temporary(dictproxy, socket_path, config, engine)
+
+    storm = AuthStorm(config)
+    stats = StormStats()
+    try:
+        # creations of the setup must not be limited by the creation budget
+        rate = dictproxy.hasher.creations_per_second
+        dictproxy.hasher.creations_per_second = 0
+        addrs = storm.create_existing(dictproxy, existing)
+        storm.count_fs_ops(dictproxy, max(10, existing // 10), stats)
+        dictproxy.hasher.creations_per_second = rate
+        return storm.run(socket_path, addrs, clients, duration, stats)
+    finally:
+        dictproxy.on_worker_stop(None)
+
+
+def storm_main(args=None):
+    """Benchmark account creation storms against doveauth on temporary storage"""
+    parser = ArgumentParser(description=storm_main.__doc__)
+    parser.add_argument("chatmail_ini", help="path pointing to chatmail.ini file")
+    parser.add_argument(
+        "--clients",
+        type=int,
+        default=10,
+        help="number of connections creating accounts (default 10)",
+    )
+    parser.add_argument(
+        "--duration", type=float, default=5.0, help="seconds of the storm (default 5)"
+    )
+    parser.add_argument(
+        "--existing",
+        type=int,
+        default=100,
+        help="number of existing accounts logging in during the storm (default 100)",
+    )
+    parser.add_argument(
+        "--creations-per-second",
+        type=int,
+        default=None,
+        help="creation budget instead of the configured one (0 disables it)",
+    )
+    parser.add_argument(
+        "--engine",
+        default=None,
+        help="dictproxy engine to use instead of the configured one",
+    )
+    args = parser.parse_args(args)
+
+    config = read_config(args.chatmail_ini)
+    if args.creations_per_second is not None:
+        config.dictproxy_creations_per_second = args.creations_per_second
+    with tempfile.TemporaryDirectory() as tmpdir:
+        stats = run_storm(
+            config,
+            tmpdir,
+            clients=args.clients,
+            duration=args.duration,
+            existing=args.existing,
+            engine=args.engine,
+        )
+    print(stats.get_summary())
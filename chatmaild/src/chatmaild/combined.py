@@ -0,0 +1,55 @@
+"""
+Serve the doveauth, metadata and lastlogin dict proxies from one process.
+
+This is used instead of the separate doveauth, chatmail-metadata
+and lastlogin services if ``dictproxy_layout = combined`` is set.
+All proxies share one parsed config and thus its per-user cache,
+and the "dictproxy_*" engine, thread and worker settings
+apply to the process as a whole.
+"""
+
+import sys
+
+from .config import read_config
+from .dictproxy import serve_forever
+from .doveauth import AuthDictProxy
+from .lastlogin import LastLoginDictProxy
+from .metadata import create_dictproxy
+from .migrate_db import migrate_from_db_to_maildir
+from .userindex import rebuild_if_missing
+
+
+def serve_combined(config, auth_socket, metadata_socket, lastlogin_socket):
+    metadata_dictproxy = create_dictproxy(config)
+    if metadata_dictproxy is None:
+        return 1
+
+    auth_dictproxy = AuthDictProxy(config=config)
+    auth_dictproxy.init_address_filter()
+    proxies = [
+        (auth_dictproxy, auth_socket),
+        (metadata_dictproxy, metadata_socket),
+        (LastLoginDictProxy(config=config), lastlogin_socket),
+    ]
+    for dictproxy, _ in proxies:
+        dictproxy.init_metrics(config)
+        dictproxy.init_watchdog(config)
+
+    serve_forever(
+        proxies,
+        engine=config.dictproxy_engine,
+        max_threads=config.dictproxy_max_threads,
+        max_queue=config.dictproxy_max_queue,
+        workers=config.dictproxy_workers,
+        queue_budget=config.dictproxy_queue_budget,
+    )
+
+
+def main():
+    auth_socket, metadata_socket, lastlogin_socket, config_path = sys.argv[1:]
+    config = read_config(config_path)
+
+    migrate_from_db_to_maildir(config)
+    rebuild_if_missing(config)
+
+    return serve_combined(config, auth_socket, metadata_socket, lastlogin_socket)
@@ -1,10 +1,21 @@
 import ipaddress
+import threading
 from pathlib import Path
 
 import iniconfig
 from domain_validator import DomainValidator
 
+from chatmaild.mailboxes import MAILBOXES_LAYOUTS, get_mailbox_dir
+from chatmaild.passwords import check_scheme
 from chatmaild.user import User
+from chatmaild.userindex import USER_INDEX_NAME, UserIndex
+from chatmaild.userstore import USER_STORES, make_user_store
+
+# supported values for the "dictproxy_layout" setting
+DICTPROXY_LAYOUTS = ("separate", "combined")
+
+# maximum number of User objects kept by Config.get_user
+USER_CACHE_SIZE = 10000
 
 
 def read_config(inipath):
@@ -42,6 +53,11 @@ class Config:
         self.username_min_length = int(params.pop("username_min_length", 9))
         self.username_max_length = int(params.pop("username_max_length", 9))
         self.password_min_length = int(params.pop("password_min_length", 9))
+        self.password_scheme = params.pop("password_scheme", "SHA512-CRYPT").strip()
+        self.password_rounds = int(params.pop("password_rounds", 0))
+        check_scheme(self.password_scheme, self.password_rounds)
+        self.auth_cache_ttl = int(params.pop("auth_cache_ttl", 3600))
+        self.auth_cache_negative_ttl = int(params.pop("auth_cache_negative_ttl", 300))
         self.www_folder = params.pop("www_folder", "")
         self.filtermail_smtp_port = int(params.pop("filtermail_smtp_port", "10080"))
         self.filtermail_smtp_port_incoming = int(
@@ -65,6 +81,33 @@ class Config:
         self.turn_socket_path = params.pop(
             "turn_socket_path", "/run/chatmail-turn/turn.socket"
         )
+        self.dictproxy_engine = params.pop("dictproxy_engine", "threads").strip()
+        self.dictproxy_max_threads = int(params.pop("dictproxy_max_threads", 32))
+        self.dictproxy_max_queue = int(params.pop("dictproxy_max_queue", 1000))
+        self.dictproxy_workers = int(params.pop("dictproxy_workers", 1))
+        queue_budget_ms = int(params.pop("dictproxy_queue_budget_ms", 500))
+        self.dictproxy_queue_budget = (
+            queue_budget_ms / 1000 if queue_budget_ms > 0 else None
+        )
+        self.dictproxy_userdb_cache_size = int(
+            params.pop("dictproxy_userdb_cache_size", 10000)
+        )
+        self.dictproxy_address_filter = (
+            params.pop("dictproxy_address_filter", "true").lower() == "true"
+        )
+        self.dictproxy_hash_processes = int(params.pop("dictproxy_hash_processes", 2))
+        self.dictproxy_creations_per_second = int(
+            params.pop("dictproxy_creations_per_second", 100)
+        )
+        slow_request_ms = int(params.pop("dictproxy_slow_request_ms", 1000))
+        self.dictproxy_slow_request = (
+            slow_request_ms / 1000 if slow_request_ms > 0 else None
+        )
+        self.dictproxy_layout = params.pop("dictproxy_layout", "separate").strip()
+        if self.dictproxy_layout not in DICTPROXY_LAYOUTS:
+            raise ValueError(f"invalid dictproxy_layout {self.dictproxy_layout!r}")
+        metrics_dir = params.pop("dictproxy_metrics_dir", "").strip()
+        self.dictproxy_metrics_dir = Path(metrics_dir) if metrics_dir else None
         iroh_relay = params.pop("iroh_relay", None)
         if iroh_relay is None:
             self.iroh_relay = "https://" + raw_domain
@@ -105,11 +148,33 @@ class Config:
         # deprecated option
         mbdir = params.pop("mailboxes_dir", f"/home/vmail/mail/{raw_domain}")
         self.mailboxes_dir = Path(mbdir.strip())
+        self.mailboxes_layout = params.pop("mailboxes_layout", "flat").strip()
+        if self.mailboxes_layout not in MAILBOXES_LAYOUTS:
+            raise ValueError(f"invalid mailboxes_layout {self.mailboxes_layout!r}")
+
+        self.user_store = params.pop("user_store", "maildir").strip()
+        if self.user_store not in USER_STORES:
+            raise ValueError(f"invalid user_store {self.user_store!r}")
+        user_store_path = params.pop("user_store_path", "").strip()
+        self.user_store_path = Path(user_store_path) if user_store_path else None
+        self._user_store = (None, None)
+        self.user_index = params.pop("user_index", "false").lower() == "true"
+        user_index_path = params.pop("user_index_path", "").strip()
+        self.user_index_path = Path(user_index_path) if user_index_path else None
+        self._user_index = (None, None)
 
         # old unused option (except for first migration from sqlite to maildir store)
         self.passdb_path = Path(params.pop("passdb_path", "/home/vmail/passdb.sqlite"))
         self._unused_keys = list(params)
 
+        self._users = {}
+        self._users_lock = threading.Lock()
+
+    @property
+    def dovecot_mailbox_path(self):
+        """Return the Dovecot path of mailboxes with the configured layout."""
+        return f"{self.mailboxes_dir}/{MAILBOXES_LAYOUTS[self.mailboxes_layout]}"
+
     @property
     def max_mailbox_size_mb(self):
         """Return max_mailbox_size as an integer in megabytes."""
@@ -118,14 +183,68 @@ class Config:
     def _getbytefile(self):
         return open(self._inipath, "rb")
 
+    def get_user_store(self):
+        """Return the store of passwords and last logins of all users."""
+        mailboxes_dir, store = self._user_store
+        # tests and benchmarks point the config to other mailboxes directories
+        if store is None or mailboxes_dir != self.mailboxes_dir:
+            store = make_user_store(
+                self.user_store,
+                self.mailboxes_dir,
+                self.user_store_path,
+                self.mailboxes_layout,
+            )
+            self._user_store = (self.mailboxes_dir, store)
+        return store
+
+    def get_user_index(self):
+        """Return the UserIndex of all users or None if it is disabled."""
+        if not self.user_index:
+            return None
+        path = self.user_index_path or self.mailboxes_dir.joinpath(USER_INDEX_NAME)
+        cached_path, index = self._user_index
+        if index is None or cached_path != path:
+            index = UserIndex(path)
+            self._user_index = (path, index)
+        return index
+
     def get_user(self, addr) -> User:
+        """Return the User for `addr`.
+
+        User objects are shared by all dict proxies using this config
+        and the least recently created ones are dropped
+        when more than USER_CACHE_SIZE are cached.
+        Users of flat mailboxes not migrated to the hashed layout yet
+        are marked as legacy and not cached, so they are found
+        at the hashed location as soon as they are moved.
+        """
+        key = (self.mailboxes_dir, addr)
+        user = self._users.get(key)
+        if user is not None:
+            return user
+
         if not addr or "@" not in addr or "/" in addr:
             raise ValueError(f"invalid address {addr!r}")
 
-        maildir = self.mailboxes_dir.joinpath(addr)
+        maildir = get_mailbox_dir(self.mailboxes_dir, addr, self.mailboxes_layout)
         password_path = maildir.joinpath("password")
 
-        return User(maildir, addr, password_path, uid="vmail", gid="vmail")
+        user = User(
+            maildir,
+            addr,
+            password_path,
+            uid="vmail",
+            gid="vmail",
+            store=self.get_user_store(),
+        )
+        if self.mailboxes_layout != "flat" and maildir.parent == self.mailboxes_dir:
+            user.legacy = True
+            return user
+        with self._users_lock:
+            if len(self._users) >= USER_CACHE_SIZE:
+                del self._users[next(iter(self._users))]
+            self._users[key] = user
+        return user
 
 
 def parse_size_mb(limit):
@@ -0,0 +1,280 @@
+"""
+Request latency and throughput metrics for dict proxies.
+
+A DictProxy only records metrics if its ``metrics`` attribute
+is set to a DictProxyMetrics instance,
+which happens when ``dictproxy_metrics_dir`` is set in chatmail.ini.
+Metrics are then periodically written in Prometheus exposition format
+to ``<dictproxy_metrics_dir>/chatmail-<proxyname>.prom``
+which can be collected by the node_exporter textfile collector.
+Pre-forked worker processes each write their own
+``chatmail-<proxyname>-<worker>.prom`` file with a "worker" label.
+"""
+
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+from .filedict import write_bytes_atomic
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 0.5, 1.0, 5.0)
+
+# handler names of the short dict protocol commands
+COMMAND_NAMES = {
+    "H": "hello",
+    "L": "lookup",
+    "I": "iterate",
+    "B": "begin",
+    "S": "set",
+    "C": "commit",
+    "D": "commit-async",
+    "R": "rollback",
+    "U": "unset",
+    "A": "atomic-inc",
+    "T": "timestamp",
+    "V": "hide-log-values",
+}
+
+DUMP_INTERVAL = 15
+
+
+class CommandStats:
+    def __init__(self):
+        # the last bucket counts observations above the largest bound
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.errors = 0
+        self.slow = 0
+
+
+class DictProxyMetrics:
+    """Thread-safe counters, gauges and latency histograms of one dict proxy."""
+
+    def __init__(self, proxyname, textfile_dir=None, worker=None):
+        self.proxyname = proxyname
+        self.textfile_dir = textfile_dir
+        self.worker = worker
+        self.commands = {}
+        self.connections = 0
+        self.transactions = 0
+        self.queue_depth = 0
+        self.queue_depth_max = 0
+        self.deduplicated = 0
+        self.shed = 0
+        self.userdb_cache_hits = 0
+        self.userdb_cache_misses = 0
+        self._lock = threading.Lock()
+
+    def _get_stats(self, short_command):
+        command = COMMAND_NAMES.get(short_command, "unknown")
+        stats = self.commands.get(command)
+        if stats is None:
+            stats = self.commands[command] = CommandStats()
+        return stats
+
+    def observe(self, short_command, duration, error=False):
+        with self._lock:
+            stats = self._get_stats(short_command)
+            stats.buckets[bisect_left(LATENCY_BUCKETS, duration)] += 1
+            stats.sum += duration
+            stats.count += 1
+            if error:
+                stats.errors += 1
+
+    def add_connections(self, delta):
+        with self._lock:
+            self.connections += delta
+
+    def add_transactions(self, delta):
+        if delta:
+            with self._lock:
+                self.transactions += delta
+
+    def add_queued(self, delta):
+        with self._lock:
+            self.queue_depth += delta
+            if self.queue_depth > self.queue_depth_max:
+                self.queue_depth_max = self.queue_depth
+
+    def add_deduplicated(self):
+        with self._lock:
+            self.deduplicated += 1
+
+    def add_shed(self, num):
+        if num:
+            with self._lock:
+                self.shed += num
+
+    def add_userdb_cache_lookup(self, hit):
+        with self._lock:
+            if hit:
+                self.userdb_cache_hits += 1
+            else:
+                self.userdb_cache_misses += 1
+
+    def add_slow(self, short_command):
+        with self._lock:
+            self._get_stats(short_command).slow += 1
+
+    def get_textfile_content(self):
+        """Return all metrics in Prometheus exposition format."""
+        proxy = f'proxy="{self.proxyname}"'
+        if self.worker is not None:
+            proxy += f',worker="{self.worker}"'
+        lines = []
+        with self._lock:
+            lines.append(
+                "# HELP chatmail_dictproxy_request_duration_seconds"
+                " Dict request handling latency."
+            )
+            lines.append("# TYPE chatmail_dictproxy_request_duration_seconds histogram")
+            for command, stats in sorted(self.commands.items()):
+                labels = f'{proxy},command="{command}"'
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+                    cumulative += count
+                    lines.append(
+                        "chatmail_dictproxy_request_duration_seconds_bucket"
+                        f'{{{labels},le="{bound}"}} {cumulative}'
+                    )
+                lines.append(
+                    "chatmail_dictproxy_request_duration_seconds_bucket"
+                    f'{{{labels},le="+Inf"}} {stats.count}'
+                )
+                lines.append(
+                    "chatmail_dictproxy_request_duration_seconds_sum"
+                    f"{{{labels}}} {stats.sum:.6f}"
+                )
+                lines.append(
+                    "chatmail_dictproxy_request_duration_seconds_count"
+                    f"{{{labels}}} {stats.count}"
+                )
+
+            lines.append("# HELP chatmail_dictproxy_requests_total Handled requests.")
+            lines.append("# TYPE chatmail_dictproxy_requests_total counter")
+            for command, stats in sorted(self.commands.items()):
+                lines.append(
+                    f'chatmail_dictproxy_requests_total{{{proxy},command="{command}"}}'
+                    f" {stats.count}"
+                )
+
+            lines.append(
+                "# HELP chatmail_dictproxy_errors_total Failed or raising requests."
+            )
+            lines.append("# TYPE chatmail_dictproxy_errors_total counter")
+            for command, stats in sorted(self.commands.items()):
+                lines.append(
+                    f'chatmail_dictproxy_errors_total{{{proxy},command="{command}"}}'
+                    f" {stats.errors}"
+                )
+
+            lines.append(
+                "# HELP chatmail_dictproxy_slow_requests_total"
+                " Requests taking longer than dictproxy_slow_request_ms."
+            )
+            lines.append("# TYPE chatmail_dictproxy_slow_requests_total counter")
+            for command, stats in sorted(self.commands.items()):
+                lines.append(
+                    "chatmail_dictproxy_slow_requests_total"
+                    f'{{{proxy},command="{command}"}} {stats.slow}'
+                )
+
+            lines.append("# HELP chatmail_dictproxy_connections Open connections.")
+            lines.append("# TYPE chatmail_dictproxy_connections gauge")
+            lines.append(
+                f"chatmail_dictproxy_connections{{{proxy}}} {self.connections}"
+            )
+
+            lines.append("# HELP chatmail_dictproxy_transactions Open transactions.")
+            lines.append("# TYPE chatmail_dictproxy_transactions gauge")
+            lines.append(
+                f"chatmail_dictproxy_transactions{{{proxy}}} {self.transactions}"
+            )
+
+            lines.append(
+                "# HELP chatmail_dictproxy_queue_depth"
+                " Request batches waiting for or running in the thread pool."
+            )
+            lines.append("# TYPE chatmail_dictproxy_queue_depth gauge")
+            lines.append(
+                f"chatmail_dictproxy_queue_depth{{{proxy}}} {self.queue_depth}"
+            )
+            lines.append(
+                "# HELP chatmail_dictproxy_queue_depth_max"
+                " Highest queue depth since start."
+            )
+            lines.append("# TYPE chatmail_dictproxy_queue_depth_max gauge")
+            lines.append(
+                f"chatmail_dictproxy_queue_depth_max{{{proxy}}} {self.queue_depth_max}"
+            )
+
+            lines.append(
+                "# HELP chatmail_dictproxy_lookups_deduplicated_total"
+                " Lookups answered with the result of an identical concurrent lookup."
+            )
+            lines.append("# TYPE chatmail_dictproxy_lookups_deduplicated_total counter")
+            lines.append(
+                "chatmail_dictproxy_lookups_deduplicated_total"
+                f"{{{proxy}}} {self.deduplicated}"
+            )
+
+            lines.append(
+                "# HELP chatmail_dictproxy_shed_total"
+                " Low priority writes dropped because the request queue was overloaded."
+            )
+            lines.append("# TYPE chatmail_dictproxy_shed_total counter")
+            lines.append(f"chatmail_dictproxy_shed_total{{{proxy}}} {self.shed}")
+
+            if self.userdb_cache_hits or self.userdb_cache_misses:
+                lines.append(
+                    "# HELP chatmail_dictproxy_userdb_cache_hits_total"
+                    " Userdb lookups answered from the in-memory cache."
+                )
+                lines.append(
+                    "# TYPE chatmail_dictproxy_userdb_cache_hits_total counter"
+                )
+                lines.append(
+                    "chatmail_dictproxy_userdb_cache_hits_total"
+                    f"{{{proxy}}} {self.userdb_cache_hits}"
+                )
+                lines.append(
+                    "# HELP chatmail_dictproxy_userdb_cache_misses_total"
+                    " Userdb lookups reading the password file."
+                )
+                lines.append(
+                    "# TYPE chatmail_dictproxy_userdb_cache_misses_total counter"
+                )
+                lines.append(
+                    "chatmail_dictproxy_userdb_cache_misses_total"
+                    f"{{{proxy}}} {self.userdb_cache_misses}"
+                )
+        return "\n".join(lines) + "\n"
+
+    def dump_textfile(self, filepath):
+        content = self.get_textfile_content().encode("ascii")
+        write_bytes_atomic(filepath, content, mode=0o644)
+
+    def get_textfile_path(self):
+        name = f"chatmail-{self.proxyname}"
+        if self.worker is not None:
+            name += f"-{self.worker}"
+        return self.textfile_dir.joinpath(f"{name}.prom")
+
+    def start_textfile_exporter(self, interval=DUMP_INTERVAL):
+        """Start a daemon thread writing the textfile every `interval` seconds."""
+        filepath = self.get_textfile_path()
+
+        def run():
+            while True:
+                try:
+                    self.dump_textfile(filepath)
+                except OSError:
+                    logging.exception(f"could not write metrics to {filepath}")
+                time.sleep(interval)
+
+        thread = threading.Thread(target=run, daemon=True, name="dictmetrics")
+        thread.start()
+        return thread
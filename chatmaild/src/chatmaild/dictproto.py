@@ -0,0 +1,71 @@
+"""
+Parsing of Dovecot dict protocol request lines.
+
+see https://doc.dovecot.org/2.3/developer_manual/design/dict_protocol/#dovecot-dict-protocol
+
+Request lines are decoded as a whole and split on tabs in one pass,
+which measured faster than decoding only the fields after the command byte.
+Keys such as ``shared/passdb/<password>"<user>`` are split
+into namespace, type and unescaped arguments by :func:`parse_key`.
+"""
+
+import re
+
+# flags of iterate requests, see dict_iterate_flags in Dovecot's dict.h
+ITERATE_FLAG_RECURSE = 0x01
+ITERATE_FLAG_SORT_BY_KEY = 0x02
+ITERATE_FLAG_SORT_BY_VALUE = 0x04
+ITERATE_FLAG_NO_VALUE = 0x08
+ITERATE_FLAG_EXACT_KEY = 0x10
+ITERATE_FLAG_ASYNC = 0x20
+
+# a backslash escape (possibly dangling at end of input) or a separator quote
+_ESCAPE_OR_QUOTE = re.compile(r'\\(.?)|"', re.DOTALL)
+
+
+def parse_request(line):
+    """Return a (command, fields) tuple for a request `line`.
+
+    `line` is bytes, bytearray or memoryview without trailing newline
+    and must not be empty.
+    """
+    if isinstance(line, memoryview):
+        line = line.tobytes()
+    msg = line.decode()
+    return msg[0], msg[1:].split("\t")
+
+
+def parse_key(key):
+    """Split a dict key into (namespace, type, args).
+
+    For example ``shared/passdb/pass"user`` becomes
+    ``("shared", "passdb", ["pass", "user"])``.
+    Keys with less than three path parts raise ValueError.
+    """
+    namespace, type, args = key.split("/", 2)
+    return namespace, type, split_and_unescape(args)
+
+
+def split_and_unescape(s):
+    """Split strings using double quote as a separator and backslash as escape character
+    into parts."""
+    if "\\" not in s:
+        return s.split('"')
+
+    parts = []
+    out = []
+    start = 0
+    for match in _ESCAPE_OR_QUOTE.finditer(s):
+        out.append(s[start : match.start()])
+        escaped = match.group(1)
+        if escaped is None:
+            parts.append("".join(out))
+            out = []
+        elif escaped:
+            out.append(escaped)
+        else:
+            raise ValueError(f"dangling escape character in {s!r}")
+        start = match.end()
+    out.append(s[start:])
+    parts.append("".join(out))
+    return parts
@@ -1,39 +1,290 @@
+import asyncio
+import heapq
+import itertools
 import logging
 import os
+import signal
+import socket as socketlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
 
+from .dictmetrics import COMMAND_NAMES, DictProxyMetrics
+from .dictwatchdog import SlowRequestWatchdog
+
+# supported values for the "dictproxy_engine" chatmail.ini setting
+ENGINES = ("threads", "asyncio")
+
+# commands operating on a transaction started with "B"
+TRANSACTION_COMMANDS = "BCDRSUATV"
+
+# commands writing within a transaction, marking it failed if they fail
+TRANSACTION_WRITES = "SUA"
+
+# maximum length of a single dict protocol line read by the asyncio engine
+ASYNC_LINE_LIMIT = 1024 * 1024
+
+# maximum number of bytes taken from a connection's input buffer at once
+READ_SIZE = 64 * 1024
+
+# number of pending connections the kernel queues on the listening socket
+LISTEN_BACKLOG = 1000
+
+# Priority classes of request batches in the asyncio engine's RequestPool.
+# Batches of a lower value run first, PRIORITY_LOW writes may be shed.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# first file descriptor passed with systemd socket activation
+SD_LISTEN_FDS_START = 3
+
+# seconds to wait before restarting a died pre-forked worker process
+PREFORK_RESTART_DELAY = 1
+
 
 class DictProxy:
+    # name of the proxy in logs and metrics
+    name = "dictproxy"
+
+    # DictProxyMetrics instance if metrics are recorded
+    metrics = None
+
+    # SlowRequestWatchdog instance if slow requests are logged
+    watchdog = None
+
+    # When set, all request lines already received on a connection
+    # are handled before their replies are written with a single write call.
+    # Otherwise every reply is written and flushed on its own.
+    pipelining = True
+
+    # When set, concurrent identical lookups share one handle_lookup call.
+    coalesce_lookups = True
+
+    # priority class of this proxy's requests
+    priority = PRIORITY_NORMAL
+
+    def __init__(self):
+        self.lookups = SingleFlight()
+
     def loop_forever(self, rfile, wfile):
         # Transaction storage is local to each handler loop.
         # Dovecot reuses transaction IDs across connections,
         # starting transaction with the name `1`
         # on two different connections to the same proxy sometimes.
         transactions = {}
+        if self.metrics is not None:
+            self.metrics.add_connections(1)
+        try:
+            self._loop_forever(rfile, wfile, transactions)
+        finally:
+            self.close_transactions(transactions)
+            if self.metrics is not None:
+                self.metrics.add_connections(-1)
+
+    def _loop_forever(self, rfile, wfile, transactions):
+        if not self.pipelining:
+            while True:
+                msg = rfile.readline().strip()
+                if not msg:
+                    break
+
+                res = self.handle_dovecot_request(msg, transactions)
+                if res:
+                    self.write_replies(wfile, res)
+            return
 
+        pending = b""
         while True:
-            msg = rfile.readline().strip().decode()
-            if not msg:
+            # read1() returns what is buffered or does at most one read syscall
+            data = rfile.read1(READ_SIZE)
+            lines = (pending + data).split(b"\n")
+            pending = lines.pop() if data else b""
+            res, more = self.handle_request_lines(lines, transactions)
+            if res:
+                self.write_replies(wfile, res)
+            if not data or not more:
                 break
 
+    def write_replies(self, wfile, res):
+        if isinstance(res, str):
+            wfile.write(res.encode("ascii"))
+            wfile.flush()
+            return
+        for chunk in res:
+            wfile.write(chunk.encode("ascii"))
+            wfile.flush()
+
+    def handle_request_lines(self, lines, transactions):
+        """Handle a batch of request lines and return their joined replies
+        and False if an empty line ended the request stream.
+
+        If a handler streams its reply, an iterator of reply chunks
+        is returned instead of a string
+        and the lines after the streaming request
+        are only handled once the iterator is exhausted.
+        """
+        replies = []
+        for i, line in enumerate(lines):
+            msg = line.strip()
+            if not msg:
+                return "".join(replies), False
             res = self.handle_dovecot_request(msg, transactions)
+            if not res:
+                continue
+            if not isinstance(res, str):
+                rest = lines[i + 1 :]
+                more = all(line.strip() for line in rest)
+                return self._stream_replies(replies, res, rest, transactions), more
+            replies.append(res)
+        return "".join(replies), True
+
+    def _stream_replies(self, replies, chunks, lines, transactions):
+        if replies:
+            yield "".join(replies)
+        yield from chunks
+        res, _ = self.handle_request_lines(lines, transactions)
+        if isinstance(res, str):
             if res:
-                wfile.write(res.encode("ascii"))
-                wfile.flush()
+                yield res
+        else:
+            yield from res
+
+    def shed_request_lines(self, lines, transactions):
+        """Like handle_request_lines but drop all writes
+        so that their transactions commit successfully without effect.
+
+        This is called on the event loop when the RequestPool is overloaded
+        and must thus not block.
+        """
+        replies = []
+        shed = 0
+        more = True
+        for line in lines:
+            msg = line.strip()
+            if not msg:
+                more = False
+                break
+            if msg[:1] in (b"S", b"U", b"A"):
+                shed += 1
+                continue
+            res = self.handle_dovecot_request(msg, transactions)
+            if res:
+                replies.append(res)
+        if self.metrics is not None:
+            self.metrics.add_shed(shed)
+        return "".join(replies), more
+
+    async def async_loop_forever(self, reader, writer, pool):
+        """Serve one dovecot connection on the running event loop.
+
+        Request handlers may block on file I/O,
+        so they are run by the RequestPool `pool`,
+        one batch of lines at a time per connection.
+        """
+        transactions = {}
+        if self.metrics is not None:
+            self.metrics.add_connections(1)
+        try:
+            await self._async_loop_forever(reader, writer, pool, transactions)
+        finally:
+            self.close_transactions(transactions)
+            if self.metrics is not None:
+                self.metrics.add_connections(-1)
+
+    async def _async_loop_forever(self, reader, writer, pool, transactions):
+        pending = b""
+        while True:
+            if self.pipelining:
+                data = await reader.read(READ_SIZE)
+            else:
+                data = await reader.readline()
+            if not data and not pending:
+                break
+            lines = (pending + data).split(b"\n")
+            pending = lines.pop() if data else b""
+            res, more = await pool.run(
+                self.handle_request_lines,
+                lines,
+                transactions,
+                priority=self.priority,
+                metrics=self.metrics,
+                shed=self.shed_request_lines if self.priority == PRIORITY_LOW else None,
+            )
+            if isinstance(res, str):
+                if res:
+                    writer.write(res.encode("ascii"))
+                    await writer.drain()
+            else:
+                # produce streamed chunks in the pool, one at a time,
+                # and wait for each to be sent before producing the next
+                while True:
+                    chunk = await pool.run(next, res, None, priority=self.priority)
+                    if chunk is None:
+                        break
+                    writer.write(chunk.encode("ascii"))
+                    await writer.drain()
+            if not data or not more:
+                break
 
     def handle_dovecot_request(self, msg, transactions):
         # see https://doc.dovecot.org/2.3/developer_manual/design/dict_protocol/#dovecot-dict-protocol
-        short_command = msg[0]
-        parts = msg[1:].split("\t")
+        # decoded and split inline like parse_request,
+        # the call overhead made metadata and lastlogin lines slower
+        if not isinstance(msg, str):
+            msg = msg.decode()
+        short_command, parts = msg[0], msg[1:].split("\t")
+
+        watchdog = self.watchdog
+        if watchdog is None:
+            return self._handle_request(short_command, parts, msg, transactions)
+        request = watchdog.begin(short_command, parts)
+        try:
+            return self._handle_request(short_command, parts, msg, transactions)
+        finally:
+            watchdog.end(request)
+
+    def _handle_request(self, short_command, parts, msg, transactions):
+        metrics = self.metrics
+        if metrics is None:
+            return self.dispatch_request(short_command, parts, msg, transactions)
+
+        num_transactions = len(transactions)
+        is_write = short_command in TRANSACTION_WRITES
+        failed_before = (
+            is_write and self._get_transaction_res(parts, transactions) == "F\n"
+        )
+        start = time.perf_counter()
+        try:
+            res = self.dispatch_request(short_command, parts, msg, transactions)
+        except Exception:
+            metrics.observe(short_command, time.perf_counter() - start, error=True)
+            raise
+        if is_write:
+            # failed writes mark their transaction as failed
+            failed_now = self._get_transaction_res(parts, transactions) == "F\n"
+            failed = failed_now and not failed_before
+        else:
+            # iterate replies are streamed as a generator of chunks
+            failed = isinstance(res, str) and "F" in res[:2]
+        metrics.observe(short_command, time.perf_counter() - start, error=failed)
+        metrics.add_transactions(len(transactions) - num_transactions)
+        return res
+
+    def _get_transaction_res(self, parts, transactions):
+        transaction = transactions.get(parts[0])
+        return transaction["res"] if transaction else None
 
+    def dispatch_request(self, short_command, parts, msg, transactions):
         if short_command == "L":
-            return self.handle_lookup(parts)
+            return self.coalesced_lookup(parts)
         elif short_command == "I":
             return self.handle_iterate(parts)
         elif short_command == "H":
             return  # no version checking
 
-        if short_command not in ("BSC"):
+        if short_command not in TRANSACTION_COMMANDS:
             logging.warning(f"unknown dictproxy request: {msg!r}")
             return
 
@@ -41,19 +292,62 @@ class DictProxy:
 
         if short_command == "B":
             return self.handle_begin_transaction(transaction_id, parts, transactions)
-        elif short_command == "C":
+
+        transaction = transactions.get(transaction_id)
+        if transaction is None:
+            logging.error(f"dictproxy request for unknown transaction: {msg!r}")
+            if short_command == "C":
+                return "F\n"
+            elif short_command == "D":
+                return f"AF{transaction_id}\n"
+            return
+
+        if short_command == "C":
             return self.handle_commit_transaction(transaction_id, parts, transactions)
-        elif short_command == "S":
-            addr = transactions[transaction_id]["addr"]
-            if not self.handle_set(addr, parts):
-                transactions[transaction_id]["res"] = "F\n"
-                logging.error(f"dictproxy-set failed for {addr!r}: {msg!r}")
+        elif short_command == "D":
+            # asynchronous commit, the reply carries the transaction ID
+            res = self.handle_commit_transaction(transaction_id, parts, transactions)
+            return f"A{res[0]}{transaction_id}\n"
+        elif short_command == "R":
+            self.handle_rollback_transaction(transaction_id, parts, transactions)
+            return
+        elif short_command in "TV":
+            return  # timestamp and log hiding options don't change our writes
+
+        addr = transaction["addr"]
+        if short_command == "S":
+            ok = self.handle_set(addr, parts)
+        elif short_command == "U":
+            ok = self.handle_unset(addr, parts)
+        else:
+            ok = self.handle_atomic_inc(addr, parts)
+        if not ok:
+            transaction["res"] = "F\n"
+            logging.error(
+                f"dictproxy-{COMMAND_NAMES[short_command]} failed for {addr!r}: {msg!r}"
+            )
+
+    def coalesced_lookup(self, parts):
+        key = self.get_lookup_coalesce_key(parts) if self.coalesce_lookups else None
+        if key is None:
+            return self.handle_lookup(parts)
+        res, shared = self.lookups.do(key, self.handle_lookup, parts)
+        if shared and self.metrics is not None:
+            self.metrics.add_deduplicated()
+        return res
+
+    def get_lookup_coalesce_key(self, parts):
+        """Return a key under which concurrent lookups share one result,
+        or None if the lookup for `parts` must always be handled on its own."""
+        return tuple(parts)
 
     def handle_lookup(self, parts):
         logging.warning(f"lookup ignored: {parts!r}")
         return "N\n"
 
     def handle_iterate(self, parts):
+        # Handlers may return an iterator of reply chunks
+        # instead of a string to stream large results.
         # Empty line means ITER_FINISHED.
         # If we don't return empty line Dovecot will timeout.
         return "\n"
@@ -67,11 +361,106 @@ class DictProxy:
         # https://github.com/dovecot/core/blob/main/src/lib-storage/mailbox-attribute.h
         return False
 
+    def handle_unset(self, addr, parts):
+        # Ux\t<key> removes a key, see handle_set for the key structure
+        return False
+
+    def handle_atomic_inc(self, addr, parts):
+        # Ax\t<key>\t<diff> adds the integer <diff> to the value of key
+        return False
+
     def handle_commit_transaction(self, transaction_id, parts, transactions):
         # return whatever "set" command(s) set as result.
         return transactions.pop(transaction_id)["res"]
 
-    def serve_forever_from_socket(self, socket):
+    def handle_rollback_transaction(self, transaction_id, parts, transactions):
+        # writes are applied immediately, so only the transaction is dropped
+        del transactions[transaction_id]
+
+    def close_transactions(self, transactions):
+        """Drop transactions left open by a closed connection."""
+        num = len(transactions)
+        if num:
+            logging.warning(
+                f"{self.name}: connection closed with {num} open transaction(s)"
+            )
+            for transaction_id in list(transactions):
+                self.handle_rollback_transaction(transaction_id, [], transactions)
+            if self.metrics is not None:
+                self.metrics.add_transactions(-num)
+
+    def serve_from_config(self, socket, config):
+        """Serve on unix `socket` using the dictproxy settings of `config`."""
+        self.init_metrics(config)
+        self.init_watchdog(config)
+        self.serve_forever_from_socket(
+            socket,
+            engine=config.dictproxy_engine,
+            max_threads=config.dictproxy_max_threads,
+            max_queue=config.dictproxy_max_queue,
+            workers=config.dictproxy_workers,
+            queue_budget=config.dictproxy_queue_budget,
+        )
+
+    def init_metrics(self, config):
+        if config.dictproxy_metrics_dir:
+            self.metrics = DictProxyMetrics(
+                self.name, textfile_dir=config.dictproxy_metrics_dir
+            )
+
+    def init_watchdog(self, config):
+        if config.dictproxy_slow_request is not None:
+            self.watchdog = SlowRequestWatchdog(
+                self.name, config.dictproxy_slow_request, metrics=self.metrics
+            )
+
+    def on_worker_start(self, worker):
+        """Called in each serving process before it accepts connections.
+
+        `worker` is None if the proxy runs in a single process
+        and otherwise the index of the pre-forked worker process.
+        """
+        if self.metrics is not None:
+            self.metrics.worker = worker
+            if self.metrics.textfile_dir is not None:
+                self.metrics.start_textfile_exporter()
+        if self.watchdog is not None:
+            self.watchdog.start()
+
+    def on_worker_stop(self, worker):
+        """Called in each serving process when it stops serving,
+        to stop the threads started by :meth:`on_worker_start`."""
+
+    def serve_forever_from_socket(
+        self,
+        socket,
+        engine="threads",
+        max_threads=32,
+        max_queue=1000,
+        workers=1,
+        queue_budget=None,
+    ):
+        """Listen on unix `socket` and serve dovecot dict connections.
+
+        With the "threads" engine every connection gets its own OS thread.
+        With the "asyncio" engine all connections are multiplexed
+        on one event loop and requests are handled
+        by at most `max_threads` pool threads.
+        Queued request batches run in order of the proxy's priority class
+        and connections are not read from while their batch is queued.
+        If batches wait longer than `queue_budget` seconds in the queue
+        or more than `max_queue` batches are waiting,
+        writes of PRIORITY_LOW proxies are dropped instead of queued.
+        If `workers` is larger than one, the listening socket is shared
+        by that many forked worker processes which are restarted if they die.
+        If a listening socket for `socket` was passed with systemd
+        socket activation, it is used instead of binding a new one.
+        """
+        serve_forever(
+            [(self, socket)], engine, max_threads, max_queue, workers, queue_budget
+        )
+
+    def serve_forever_threaded(self, listener):
         dictproxy = self
 
         class Handler(StreamRequestHandler):
@@ -82,17 +471,326 @@ class DictProxy:
                     logging.exception("Exception in the handler")
                     raise
 
+        server = CustomThreadingUnixStreamServer(
+            listener.getsockname(), Handler, bind_and_activate=False
+        )
+        # serve on the already listening socket
+        server.socket.close()
+        server.socket = listener
+        server.serve_forever()
+
+    async def serve_forever_async(self, listener, pool):
+        async def handle(reader, writer):
+            try:
+                await self.async_loop_forever(reader, writer, pool)
+            except Exception:
+                logging.exception("Exception in the handler")
+            finally:
+                writer.close()
+
+        server = await asyncio.start_unix_server(
+            handle,
+            sock=listener,
+            limit=ASYNC_LINE_LIMIT,
+            backlog=LISTEN_BACKLOG,
+        )
+        async with server:
+            await server.serve_forever()
+
+
+def serve_forever(
+    proxies,
+    engine="threads",
+    max_threads=32,
+    max_queue=1000,
+    workers=1,
+    queue_budget=None,
+):
+    """Serve each of the (dictproxy, socket) pairs in `proxies` from this process.
+
+    See :meth:`DictProxy.serve_forever_from_socket` for the parameters.
+    With more than one worker, every worker process serves all sockets.
+    With the "asyncio" engine, all proxies share one RequestPool
+    so that their priority classes apply across proxies.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"unknown dictproxy engine {engine!r}")
+
+    inherited = get_inherited_listeners()
+    listeners = [
+        (dictproxy, inherited.pop(socket, None) or bind_listener(socket))
+        for dictproxy, socket in proxies
+    ]
+    for path, listener in inherited.items():
+        logging.warning(f"closing unused inherited socket {path!r}")
+        listener.close()
+    name = "+".join(dictproxy.name for dictproxy, _ in proxies)
+
+    def run_worker(worker):
+        for dictproxy, _ in proxies:
+            dictproxy.on_worker_start(worker)
         try:
-            os.unlink(socket)
-        except FileNotFoundError:
-            pass
+            serve_listeners()
+        finally:
+            for dictproxy, _ in proxies:
+                dictproxy.on_worker_stop(worker)
+
+    def serve_listeners():
+        if engine == "asyncio":
+            asyncio.run(
+                serve_all_async(listeners, max_threads, max_queue, queue_budget)
+            )
+            return
+        for dictproxy, listener in listeners[1:]:
+            threading.Thread(
+                target=dictproxy.serve_forever_threaded, args=(listener,), daemon=True
+            ).start()
+        dictproxy, listener = listeners[0]
+        dictproxy.serve_forever_threaded(listener)
+
+    try:
+        if workers > 1:
+            serve_forever_prefork(name, run_worker, workers)
+        else:
+            run_worker(None)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for _, listener in listeners:
+            listener.close()
+
+
+async def serve_all_async(listeners, max_threads, max_queue, queue_budget=None):
+    pool = RequestPool(max_threads, max_queue, queue_budget)
+    with pool.executor:
+        await asyncio.gather(
+            *(
+                dictproxy.serve_forever_async(listener, pool)
+                for dictproxy, listener in listeners
+            )
+        )
+
+
+def get_inherited_listeners():
+    """Return a dict mapping socket paths to inherited listening sockets.
+
+    Listening sockets are passed by systemd socket activation
+    or any other supervisor using the same LISTEN_FDS protocol,
+    so that they stay open while the proxy process is restarted.
+    """
+    if os.environ.get("LISTEN_PID") != str(os.getpid()):
+        return {}
+    num = int(os.environ.get("LISTEN_FDS", "0"))
+    # like sd_listen_fds(), don't pass the sockets on to child processes
+    for name in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES"):
+        os.environ.pop(name, None)
+
+    listeners = {}
+    for fd in range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + num):
+        listener = socketlib.socket(fileno=fd)
+        listeners[listener.getsockname()] = listener
+    return listeners
+
+
+def bind_listener(socket):
+    """Return a listening unix socket bound to path `socket`."""
+    try:
+        os.unlink(socket)
+    except FileNotFoundError:
+        pass
+
+    listener = socketlib.socket(socketlib.AF_UNIX, socketlib.SOCK_STREAM)
+    try:
+        listener.bind(socket)
+        listener.listen(LISTEN_BACKLOG)
+    except BaseException:
+        listener.close()
+        raise
+    return listener
 
-        with CustomThreadingUnixStreamServer(socket, Handler) as server:
+
+def serve_forever_prefork(name, run_worker, workers):
+    """Fork `workers` processes calling `run_worker(worker)` and supervise them.
+
+    Per-user state is only modified under file locks
+    so workers can safely handle requests for the same user.
+    """
+    pids = {}
+
+    def spawn(worker):
+        pid = os.fork()
+        if pid == 0:
+            exitcode = 0
             try:
-                server.serve_forever()
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                run_worker(worker)
             except KeyboardInterrupt:
                 pass
+            except BaseException:
+                logging.exception(f"{name} worker {worker} crashed")
+                exitcode = 1
+            finally:
+                os._exit(exitcode)
+        pids[pid] = worker
+
+    def terminate(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        for worker in range(workers):
+            spawn(worker)
+        while True:
+            pid, status = os.wait()
+            worker = pids.pop(pid, None)
+            if worker is None:
+                continue
+            logging.error(
+                f"{name} worker {worker} (pid {pid}) exited"
+                f" with status {status}, restarting"
+            )
+            time.sleep(PREFORK_RESTART_DELAY)
+            spawn(worker)
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            os.waitpid(pid, 0)
+
+
+class SingleFlight:
+    """Let concurrent calls with the same key share one in-flight call.
+
+    The first caller of :meth:`do` for a key runs the function,
+    callers arriving while it runs wait and get the same result or exception.
+    """
+
+    def __init__(self):
+        self.deduplicated = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args):
+        """Return (result, shared) where shared is True
+        if the result was computed for another caller."""
+        with self._lock:
+            call = self._calls.get(key)
+            owner = call is None
+            if owner:
+                call = self._calls[key] = _Call()
+            else:
+                self.deduplicated += 1
+        if not owner:
+            # wait until the owner releases the lock after finishing
+            with call.done:
+                pass
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func(*args)
+        except BaseException as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.release()
+        return call.result, False
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Lock()
+        self.done.acquire()
+        self.result = self.error = None
+
+
+class RequestPool:
+    """Fixed-size thread pool running blocking request handlers
+    for all connections of the asyncio engine.
+
+    Batches are only handed to the pool when a thread is free.
+    Until then they wait in a queue ordered by priority class
+    and their connections are not read from,
+    so a reconnect storm queues up in socket buffers
+    instead of growing threads or memory.
+
+    Batches which can be shed are answered by their `shed` function
+    instead of waiting if the last started batch waited
+    longer than `queue_budget` seconds or if `max_queue` batches are waiting,
+    and instead of running if they waited longer than `queue_budget` themselves.
+    """
+
+    def __init__(self, max_threads, max_queue, queue_budget=None):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_threads, thread_name_prefix="dictproxy"
+        )
+        self.max_threads = max_threads
+        self.max_queue = max_queue
+        self.queue_budget = queue_budget
+        # seconds the most recently started batch waited in the queue
+        self.queue_wait = 0.0
+        self.running = 0
+        self.waiting = []
+        self._counter = itertools.count()
+
+    def is_overloaded(self):
+        if len(self.waiting) >= self.max_queue:
+            return True
+        return self.queue_budget is not None and self.queue_wait > self.queue_budget
+
+    async def run(self, func, *args, priority=PRIORITY_NORMAL, metrics=None, shed=None):
+        if metrics is not None:
+            metrics.add_queued(1)
+        try:
+            if self.running < self.max_threads and not self.waiting:
+                self.running += 1
+                self.queue_wait = 0.0
+            elif shed is not None and self.is_overloaded():
+                return shed(*args)
+            else:
+                waited = await self._wait_for_thread(priority)
+                if shed is not None and self.queue_budget is not None:
+                    if waited > self.queue_budget:
+                        self._release()
+                        return shed(*args)
+            loop = asyncio.get_running_loop()
+            try:
+                return await loop.run_in_executor(self.executor, func, *args)
+            finally:
+                self._release()
+        finally:
+            if metrics is not None:
+                metrics.add_queued(-1)
+
+    async def _wait_for_thread(self, priority):
+        start = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self._counter), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the thread was already handed over, pass it on
+                self._release()
+            raise
+        self.queue_wait = time.monotonic() - start
+        return self.queue_wait
+
+    def _release(self):
+        # hand the thread over to the first waiting batch still interested
+        while self.waiting:
+            _, _, waiter = heapq.heappop(self.waiting)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.running -= 1
 
 
 class CustomThreadingUnixStreamServer(ThreadingUnixStreamServer):
-    request_queue_size = 1000
+    request_queue_size = LISTEN_BACKLOG
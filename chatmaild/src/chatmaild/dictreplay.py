@@ -0,0 +1,399 @@
+"""
+Capture dict protocol traffic of a dict proxy and replay it for load testing.
+
+To record traffic of a running proxy,
+the capture tap moves the proxy's socket aside,
+listens on the original socket path and forwards all connections
+to the moved socket until it is stopped with Ctrl-C:
+
+    chatmail-dict-capture /run/doveauth/doveauth.socket /tmp/doveauth.jsonl
+
+Each request line is written as one JSON line
+with its connection number and seconds since the capture started.
+Addresses, passwords, mailbox GUIDs and device tokens are replaced
+by pseudonyms derived from a random per-capture key,
+and only the status character of replies is kept.
+
+A recording can then be replayed against a proxy
+using a temporary mailboxes directory:
+
+    chatmail-dict-replay /usr/local/lib/chatmaild/chatmail.ini doveauth \\
+        /tmp/doveauth.jsonl --speed 10 --concurrency 100
+
+which reports throughput and latency percentiles per command.
+"""
+
+import hmac
+import itertools
+import json
+import logging
+import os
+import re
+import socket
+import stat
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+from queue import Empty, Queue
+from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+
+from .config import read_config
+from .dictmetrics import COMMAND_NAMES
+from .dictproto import parse_key, parse_request
+
+ADDRESS_RE = re.compile(r'[^\s"/\\@]+@[\w.\-\[\]]+')
+PRIV_KEY_RE = re.compile(r"^priv/([0-9a-f]+)/")
+
+# commands that Dovecot waits for a reply on
+REPLY_COMMANDS = "LICD"
+
+
+class Anonymizer:
+    """Replace identifying parts of request lines with stable pseudonyms."""
+
+    def __init__(self, key=None):
+        self.key = key if key is not None else os.urandom(16)
+
+    def pseudonym(self, value, length):
+        digest = hmac.new(self.key, value.encode(), "sha256").hexdigest()
+        return digest[:length]
+
+    def anonymize_address_string(self, addr):
+        localpart, domain = addr.rsplit("@", 1)
+        return f"{self.pseudonym(localpart, 9)}@{domain}"
+
+    def anonymize_key(self, key):
+        if key.startswith("shared/passdb/"):
+            try:
+                namespace, type, (password, user) = parse_key(key)
+            except ValueError:
+                return self.pseudonym(key, 32)
+            password = self.pseudonym(password, 16)
+            return f'{namespace}/{type}/{password}"{user}'
+        match = PRIV_KEY_RE.match(key)
+        if match:
+            guid = self.pseudonym(match.group(1), 32)
+            return f"priv/{guid}/{key[match.end() :]}"
+        return key
+
+    def anonymize_request(self, line):
+        command, parts = parse_request(line.encode())
+        if command == "L":
+            parts[0] = self.anonymize_key(parts[0])
+        elif command in "SUA" and len(parts) > 1:
+            parts[1] = self.anonymize_key(parts[1])
+            if command == "S" and parts[1].endswith("/devicetoken") and len(parts) > 2:
+                parts[2] = self.pseudonym(parts[2], 64)
+        line = command + "\t".join(parts)
+        return ADDRESS_RE.sub(
+            lambda match: self.anonymize_address_string(match.group(0)), line
+        )
+
+
+class Recorder:
+    """Thread-safe writer of JSON recording lines."""
+
+    def __init__(self, file, anonymizer):
+        self.file = file
+        self.anonymizer = anonymizer
+        self.start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def write(self, **entry):
+        entry["t"] = round(time.monotonic() - self.start, 6)
+        with self._lock:
+            self.file.write(json.dumps(entry) + "\n")
+
+    def record_request(self, conn, line):
+        self.write(c=conn, q=self.anonymizer.anonymize_request(line))
+
+    def record_reply(self, conn, line):
+        self.write(c=conn, r=line[:1])
+
+
+class CaptureServer(ThreadingUnixStreamServer):
+    """Forward connections on `socket_path` to `upstream_path` and record them."""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, upstream_path, recorder):
+        self.upstream_path = upstream_path
+        self.recorder = recorder
+        self.numconns = 0
+        self._conncounter = itertools.count(1)
+        super().__init__(socket_path, CaptureHandler)
+
+
+class CaptureHandler(StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        conn = next(server._conncounter)
+        server.numconns = max(server.numconns, conn)
+        recorder = server.recorder
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as upstream:
+            upstream.connect(server.upstream_path)
+            thread = threading.Thread(
+                target=self.pump_replies, args=(upstream, conn), daemon=True
+            )
+            thread.start()
+            for line in self.rfile:
+                upstream.sendall(line)
+                msg = line.strip().decode()
+                if msg:
+                    recorder.record_request(conn, msg)
+            upstream.shutdown(socket.SHUT_WR)
+            thread.join()
+        recorder.write(c=conn, close=True)
+
+    def pump_replies(self, upstream, conn):
+        with upstream.makefile("rb") as upstream_file:
+            for line in upstream_file:
+                self.wfile.write(line)
+                self.server.recorder.record_reply(conn, line[:1].decode())
+
+
+def capture(socket_path, output, anonymizer=None):
+    """Return a started CaptureServer recording traffic to `socket_path`.
+
+    The proxy socket is moved to ``<socket_path>.captured``
+    and moved back when the returned server's ``stop()`` is called.
+    The capturing socket gets the owner, group and mode of the proxy socket
+    before it accepts connections, so Dovecot can connect as before.
+    """
+    socket_path = str(socket_path)
+    upstream_path = socket_path + ".captured"
+    st = os.stat(socket_path)
+    os.rename(socket_path, upstream_path)
+    recorder = Recorder(output, anonymizer or Anonymizer())
+    try:
+        server = CaptureServer(socket_path, upstream_path, recorder)
+    except BaseException:
+        os.rename(upstream_path, socket_path)
+        raise
+    try:
+        if (st.st_uid, st.st_gid) != (os.getuid(), os.getgid()):
+            os.chown(socket_path, st.st_uid, st.st_gid)
+        os.chmod(socket_path, stat.S_IMODE(st.st_mode))
+    except BaseException:
+        server.server_close()
+        os.rename(upstream_path, socket_path)
+        raise
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        server.shutdown()
+        server.server_close()
+        os.rename(upstream_path, socket_path)
+        output.flush()
+
+    server.stop = stop
+    return server
+
+
+def capture_main(args=None):
+    """Record anonymized dict protocol traffic of a running dict proxy"""
+    parser = ArgumentParser(description=capture_main.__doc__)
+    parser.add_argument("socket", help="unix socket path of the dict proxy")
+    parser.add_argument("output", type=Path, help="JSON lines recording to write")
+    args = parser.parse_args(args)
+
+    with args.output.open("w") as output:
+        server = capture(args.socket, output)
+        print(f"capturing {args.socket} to {args.output}, press Ctrl-C to stop")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.stop()
+        print(f"captured {server.numconns} connections")
+
+
+def read_recording(path):
+    """Return a list of (start_time, [(time, request), ...]) per connection
+    ordered by start time."""
+    conns = {}
+    with open(path) as f:
+        for line in f:
+            entry = json.loads(line)
+            if "q" in entry:
+                conns.setdefault(entry["c"], []).append((entry["t"], entry["q"]))
+    return sorted((requests[0][0], requests) for requests in conns.values())
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+class ReplayStats:
+    def __init__(self):
+        self.latencies = {}
+        self.numrequests = 0
+        self.errors = 0
+        self.duration = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, command, latency):
+        with self._lock:
+            self.latencies.setdefault(COMMAND_NAMES.get(command, command), []).append(
+                latency
+            )
+
+    def get_summary(self):
+        lines = [
+            f"{self.numrequests} requests in {self.duration:.2f} seconds:"
+            f" {self.numrequests / max(self.duration, 1e-9):.0f} requests/s,"
+            f" {self.errors} connection errors",
+            f"{'command': <10} {'count':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}",
+        ]
+        everything = []
+        for command, latencies in sorted(self.latencies.items()):
+            everything.extend(latencies)
+            lines.append(self.format_line(command, sorted(latencies)))
+        lines.append(self.format_line("all", sorted(everything)))
+        return "\n".join(lines)
+
+    def format_line(self, name, latencies):
+        p50, p95, p99 = (percentile(latencies, q) * 1000 for q in (0.5, 0.95, 0.99))
+        return f"{name: <10} {len(latencies):>8} {p50:8.2f} {p95:8.2f} {p99:8.2f}"
+
+
+def replay_connection(socket_path, requests, start, speed, stats):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile("rb") as rfile:
+            for t, request in requests:
+                delay = start + t / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                sent = time.perf_counter()
+                sock.sendall(f"{request}\n".encode())
+                command = request[0]
+                if command in REPLY_COMMANDS:
+                    reply = rfile.readline()
+                    if command == "I":
+                        # iteration replies end with an empty line
+                        while reply not in (b"\n", b""):
+                            reply = rfile.readline()
+                    stats.add(command, time.perf_counter() - sent)
+                with stats._lock:
+                    stats.numrequests += 1
+
+
+def replay(socket_path, connections, speed=1.0, concurrency=100):
+    """Replay recorded `connections` against `socket_path`
+    from at most `concurrency` client threads and return ReplayStats."""
+    stats = ReplayStats()
+    todo = Queue()
+    for conn in sorted(connections):
+        todo.put(conn)
+
+    # the first recorded request is sent immediately
+    start = time.monotonic()
+    if connections:
+        start -= min(connections)[0] / speed
+
+    def run():
+        while True:
+            try:
+                _, requests = todo.get_nowait()
+            except Empty:
+                return
+            try:
+                replay_connection(socket_path, requests, start, speed, stats)
+            except OSError:
+                logging.exception("replayed connection failed")
+                with stats._lock:
+                    stats.errors += 1
+
+    threads = [threading.Thread(target=run) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats.duration = time.monotonic() - start
+    return stats
+
+
+def make_replay_proxy(name, config):
+    """Return a dict proxy of kind `name` working on ``config.mailboxes_dir``."""
+    if name == "doveauth":
+        from .doveauth import AuthDictProxy
+
+        return AuthDictProxy(config=config)
+    if name == "lastlogin":
+        from .lastlogin import LastLoginDictProxy
+
+        return LastLoginDictProxy(config=config)
+    if name == "metadata":
+        from .metadata import Metadata, MetadataDictProxy
+        from .notifier import Notifier
+
+        class ReplayNotifier(Notifier):
+            # never contact the notification server during replays
+            def start_notification_threads(self, remove_token_from_addr, requeue=True):
+                pass
+
+        queue_dir = config.mailboxes_dir.joinpath("pending_notifications")
+        queue_dir.mkdir(exist_ok=True)
+        return MetadataDictProxy(
+            notifier=ReplayNotifier(queue_dir),
+            metadata=Metadata(config.mailboxes_dir, config.mailboxes_layout),
+            iroh_relay=config.iroh_relay,
+            turn_hostname=config.mail_domain,
+            turn_socket_path=config.turn_socket_path,
+        )
+    raise ValueError(f"unknown dict proxy {name!r}")
+
+
+def replay_main(args=None):
+    """Replay a dict protocol recording against a dict proxy on temporary storage"""
+    parser = ArgumentParser(description=replay_main.__doc__)
+    parser.add_argument("chatmail_ini", help="path pointing to chatmail.ini file")
+    parser.add_argument("proxy", choices=["doveauth", "metadata", "lastlogin"])
+    parser.add_argument("recording", type=Path, help="recording to replay")
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="replay N times faster"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=100,
+        help="maximum number of simultaneously replayed connections",
+    )
+    parser.add_argument(
+        "--engine",
+        default=None,
+        help="dictproxy engine to use instead of the configured one",
+    )
+    args = parser.parse_args(args)
+
+    config = read_config(args.chatmail_ini)
+    connections = read_recording(args.recording)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config.mailboxes_dir = Path(tmpdir).joinpath("mailboxes")
+        config.mailboxes_dir.mkdir()
+        dictproxy = make_replay_proxy(args.proxy, config)
+        socket_path = os.path.join(tmpdir, "replay.socket")
+        thread = threading.Thread(
+            target=dictproxy.serve_forever_from_socket,
+            args=(socket_path,),
+            kwargs=dict(
+                engine=args.engine or config.dictproxy_engine,
+                max_threads=config.dictproxy_max_threads,
+                max_queue=config.dictproxy_max_queue,
+                queue_budget=config.dictproxy_queue_budget,
+            ),
+            daemon=True,
+        )
+        thread.start()
+        while not os.path.exists(socket_path):
+            time.sleep(0.01)
+        stats = replay(socket_path, connections, args.speed, args.concurrency)
+        print(stats.get_summary())
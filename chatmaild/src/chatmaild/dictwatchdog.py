@@ -0,0 +1,155 @@
+"""
+Watchdog logging dict requests which take longer than a threshold.
+
+A DictProxy only watches its requests if its ``watchdog`` attribute
+is set to a SlowRequestWatchdog instance,
+which happens unless ``dictproxy_slow_request_ms`` is 0 in chatmail.ini.
+Every handled request is registered with the thread handling it.
+A daemon thread periodically checks for requests running
+longer than the threshold and logs their command, key class,
+duration and the current Python stack of their handler thread,
+so a request stuck on a file lock or a slow socket shows where it waits.
+Requests which complete before being sampled are logged on completion.
+Log messages are rate-limited, every slow request is counted.
+"""
+
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from .dictmetrics import COMMAND_NAMES
+
+# at most LOG_BURST slow request messages are logged per LOG_PERIOD seconds
+LOG_BURST = 10
+LOG_PERIOD = 60
+
+# lower bound in seconds of the interval between two checks
+MIN_CHECK_INTERVAL = 0.01
+
+# maximum number of stack frames logged for a slow request
+STACK_LIMIT = 20
+
+
+def get_key_class(short_command, parts):
+    """Return the class of a request's dict key without user specific parts.
+
+    For example "shared/userdb" for userdb lookups
+    or "priv/devicetoken" for a user's device token,
+    so keys can be logged without addresses or GUIDs.
+    """
+    if short_command == "L":
+        key = parts[0] if parts else ""
+    elif short_command in "SUA":
+        key = parts[1] if len(parts) > 1 else ""
+    else:
+        return ""
+    keyparts = key.split("/")
+    if keyparts[0] == "priv":
+        # the second part is the user's mailbox GUID
+        return f"priv/{keyparts[-1]}" if len(keyparts) > 2 else "priv"
+    return "/".join(keyparts[:2])
+
+
+class InFlightRequest:
+    def __init__(self, short_command, parts, start):
+        self.short_command = short_command
+        self.key_class = get_key_class(short_command, parts)
+        self.start = start
+        self.reported = False
+
+
+class SlowRequestWatchdog:
+    """Track in-flight requests and report those exceeding `threshold` seconds."""
+
+    def __init__(self, proxyname, threshold, metrics=None):
+        self.proxyname = proxyname
+        self.threshold = threshold
+        self.metrics = metrics
+        # requests by the ident of the thread handling them
+        self.inflight = {}
+        self.slow = 0
+        self.suppressed = 0
+        self._log_allowance = LOG_BURST
+        self._log_last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def begin(self, short_command, parts):
+        request = InFlightRequest(short_command, parts, time.monotonic())
+        self.inflight[threading.get_ident()] = request
+        return request
+
+    def end(self, request):
+        self.inflight.pop(threading.get_ident(), None)
+        duration = time.monotonic() - request.start
+        if duration > self.threshold and not request.reported:
+            request.reported = True
+            self.report(request, duration, stack=None)
+
+    def check(self):
+        """Report all requests running longer than the threshold."""
+        now = time.monotonic()
+        frames = None
+        for ident, request in list(self.inflight.items()):
+            if request.reported or now - request.start <= self.threshold:
+                continue
+            if frames is None:
+                frames = sys._current_frames()
+            frame = frames.get(ident)
+            stack = traceback.extract_stack(frame, limit=STACK_LIMIT) if frame else None
+            # the request may have completed meanwhile
+            if self.inflight.get(ident) is request and not request.reported:
+                request.reported = True
+                self.report(request, now - request.start, stack=stack)
+
+    def report(self, request, duration, stack):
+        command = COMMAND_NAMES.get(request.short_command, "unknown")
+        with self._lock:
+            self.slow += 1
+            allowed = self._take_log_allowance()
+            suppressed = self.suppressed if allowed else 0
+            self.suppressed = 0 if allowed else self.suppressed + 1
+        if self.metrics is not None:
+            self.metrics.add_slow(request.short_command)
+        if not allowed:
+            return
+
+        state = "running for" if stack is not None else "took"
+        message = (
+            f"{self.proxyname}: slow {command} request"
+            f" key={request.key_class or '-'} {state} {duration:.3f}s"
+        )
+        if suppressed:
+            message += f" ({suppressed} slow request message(s) suppressed)"
+        if stack is not None:
+            message += "\n" + "".join(traceback.format_list(stack)).rstrip()
+        logging.warning(message)
+
+    def _take_log_allowance(self):
+        now = time.monotonic()
+        self._log_allowance = min(
+            LOG_BURST,
+            self._log_allowance + (now - self._log_last) * LOG_BURST / LOG_PERIOD,
+        )
+        self._log_last = now
+        if self._log_allowance < 1:
+            return False
+        self._log_allowance -= 1
+        return True
+
+    def start(self):
+        """Start a daemon thread checking for slow requests."""
+        interval = max(self.threshold / 4, MIN_CHECK_INTERVAL)
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.check()
+                except Exception:
+                    logging.exception(f"{self.proxyname}: slow request check failed")
+
+        thread = threading.Thread(target=run, daemon=True, name="dictwatchdog")
+        thread.start()
+        return thread
@@ -1,36 +1,62 @@
+import itertools
 import json
 import logging
+import multiprocessing
 import os
 import re
 import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 
-import filelock
-
-try:
-    import crypt_r
-except ImportError:
-    import crypt as crypt_r
-
+from .addrfilter import AddressFilter
+from .authcache import AuthCacheFlusher
 from .config import Config, read_config
-from .dictproxy import DictProxy
+from .dictproto import (
+    ITERATE_FLAG_EXACT_KEY,
+    ITERATE_FLAG_SORT_BY_KEY,
+    ITERATE_FLAG_SORT_BY_VALUE,
+    parse_key,
+)
+from .dictproxy import PRIORITY_HIGH, DictProxy
 from .migrate_db import migrate_from_db_to_maildir
+from .passwords import encrypt_password, needs_rehash, rehash_password
+from .user import UserdbCache
+from .userindex import rebuild_if_missing
 
 NOCREATE_FILE = "/etc/chatmail-nocreate"
 VALID_LOCALPART_RE = re.compile(r"^[a-z0-9._-]+$")
 
+# config settings which take effect without a restart
+POLICY_SETTINGS = (
+    "password_min_length",
+    "username_min_length",
+    "username_max_length",
+    "password_scheme",
+    "password_rounds",
+)
 
-def encrypt_password(password: str):
-    # https://doc.dovecot.org/2.3/configuration_manual/authentication/password_schemes/
-    passhash = crypt_r.crypt(password, crypt_r.METHOD_SHA512)
-    return "{SHA512-CRYPT}" + passhash
+# seconds between two checks for changes of NOCREATE_FILE and chatmail.ini
+POLICY_REFRESH_INTERVAL = 0.5
 
+# seconds between two password verifications for rehashing an address
+REHASH_INTERVAL = 600
+
+# maximum number of addresses whose last rehash verification is remembered
+MAX_REHASH_ADDRESSES = 10000
+
+# maximum number of users per reply chunk written when iterating
+ITERATE_CHUNK_SIZE = 1000
 
-def is_allowed_to_create(config: Config, user, cleartext_password) -> bool:
-    """Return True if user and password are admissable."""
-    if os.path.exists(NOCREATE_FILE):
-        logging.warning(f"blocked account creation because {NOCREATE_FILE!r} exists.")
-        return False
 
+def is_allowed_to_create(
+    config: Config, user, cleartext_password, nocreate=None
+) -> bool:
+    """Return True if user and password are admissable.
+
+    `nocreate` tells whether NOCREATE_FILE exists,
+    the file is checked if it is None.
+    """
     if len(cleartext_password) < config.password_min_length:
         logging.warning(
             "Password needs to be at least %s characters long",
@@ -60,47 +86,244 @@ def is_allowed_to_create(config: Config, user, cleartext_password) -> bool:
         logging.warning("localpart %r contains invalid characters", localpart)
         return False
 
+    # checked last so that invalid addresses are rejected without disk access
+    if nocreate is None:
+        nocreate = os.path.exists(NOCREATE_FILE)
+    if nocreate:
+        logging.warning(f"blocked account creation because {NOCREATE_FILE!r} exists.")
+        return False
+
     return True
 
 
-def split_and_unescape(s):
-    """Split strings using double quote as a separator and backslash as escape character
-    into parts."""
-
-    out = ""
-    i = 0
-    while i < len(s):
-        c = s[i]
-        if c == "\\":
-            # Skip escape character.
-            i += 1
-
-            # This will raise IndexError if there is no character
-            # after escape character. This is expected
-            # as this is an invalid input.
-            out += s[i]
-        elif c == '"':
-            # Separator
-            yield out
-            out = ""
-        else:
-            out += c
-        i += 1
-    yield out
+class CreationDeferred(Exception):
+    """An account can not be created at the moment but may be later."""
+
+
+class PolicyWatcher:
+    """Keep account creation policy state of `config` up to date.
+
+    Once started, a thread stats NOCREATE_FILE and chatmail.ini
+    every `interval` seconds, so that request handlers
+    use the in-memory `nocreate` flag and the POLICY_SETTINGS
+    of the config without any filesystem access.
+    Before it is started, `nocreate` is None.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.nocreate = None
+        self._inistat = self._stat_inipath()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _stat_inipath(self):
+        try:
+            st = os.stat(self.config._inipath)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def is_nocreate(self):
+        """Return True if account creation is blocked by NOCREATE_FILE."""
+        if self.nocreate is None:
+            return os.path.exists(NOCREATE_FILE)
+        return self.nocreate
+
+    def refresh(self):
+        nocreate = os.path.exists(NOCREATE_FILE)
+        if nocreate != self.nocreate and self.nocreate is not None:
+            state = "blocked" if nocreate else "allowed"
+            logging.info(f"account creation {state} by {NOCREATE_FILE!r}")
+        self.nocreate = nocreate
+
+        inistat = self._stat_inipath()
+        if inistat is None or inistat == self._inistat:
+            return
+        self._inistat = inistat
+        try:
+            newconfig = read_config(self.config._inipath)
+        except Exception:
+            logging.exception(f"could not re-read {self.config._inipath}")
+            return
+        for name in POLICY_SETTINGS:
+            value = getattr(newconfig, name)
+            if getattr(self.config, name) != value:
+                logging.info(f"{name} changed to {value}")
+                setattr(self.config, name, value)
+
+    def start(self, interval=POLICY_REFRESH_INTERVAL):
+        self.refresh()
+        self._stopped.clear()
+
+        def run():
+            while not self._stopped.wait(interval):
+                try:
+                    self.refresh()
+                except Exception:
+                    logging.exception("could not refresh account creation policy")
+
+        self._thread = threading.Thread(target=run, daemon=True, name="policywatcher")
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        """Stop the thread started by :meth:`start` and wait for it."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class PasswordHasher:
+    """Hash passwords of new accounts in a pool of `processes`
+    and admit at most `creations_per_second` new accounts.
+
+    crypt hashing holds the GIL, so hashing in the dict handler threads
+    makes all other lookups of the proxy wait for it.
+    With 0 processes, passwords are hashed in the calling thread,
+    with a `creations_per_second` of 0 account creation is not limited.
+
+    Passwords of existing accounts are verified for rehashing
+    in a separate single process pool, at most once per REHASH_INTERVAL
+    for each address, so that logins with wrong passwords
+    can not delay account creations.
+    """
+
+    def __init__(self, processes, creations_per_second):
+        self.processes = processes
+        self.creations_per_second = creations_per_second
+        self.rejected = 0
+        self._allowance = creations_per_second
+        self._last = time.monotonic()
+        self._last_warning = 0.0
+        self._rehashed = {}
+        self._lock = threading.Lock()
+
+    def admit(self):
+        """Return True if another account may be created now."""
+        rate = self.creations_per_second
+        if rate <= 0:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(rate, self._allowance + (now - self._last) * rate)
+            self._last = now
+            if self._allowance >= 1:
+                self._allowance -= 1
+                return True
+            self.rejected += 1
+            if now - self._last_warning < 1:
+                return False
+            self._last_warning = now
+        logging.warning(
+            f"account creation budget of {rate}/s exceeded,"
+            f" {self.rejected} creation(s) rejected so far"
+        )
+        return False
+
+    def admit_rehash(self, addr):
+        """Return True if the password of `addr` may be verified for rehashing."""
+        with self._lock:
+            now = time.monotonic()
+            if len(self._rehashed) >= MAX_REHASH_ADDRESSES:
+                self._rehashed = {
+                    x: last
+                    for x, last in self._rehashed.items()
+                    if now - last < REHASH_INTERVAL
+                }
+            last = self._rehashed.get(addr)
+            if last is not None and now - last < REHASH_INTERVAL:
+                return False
+            if len(self._rehashed) >= MAX_REHASH_ADDRESSES:
+                return False
+            self._rehashed[addr] = now
+            return True
+
+    def encrypt_password(self, password, scheme="SHA512-CRYPT", rounds=0):
+        return self._run(self.processes, encrypt_password, password, scheme, rounds)
+
+    def rehash_password(self, password, enc_password, scheme, rounds):
+        """Return `password` hashed with `scheme` and `rounds`
+        or None if it does not match `enc_password`."""
+        args = (password, enc_password, scheme, rounds)
+        return self._run(min(self.processes, 1), rehash_password, *args, name="rehash")
+
+    def _run(self, processes, func, *args, name="hash"):
+        if processes <= 0:
+            return func(*args)
+        return get_hash_executor(processes, name).submit(func, *args).result()
+
+
+# process pools by name and size, shared by all proxies of a process
+_hash_executors = {}
+_hash_executors_lock = threading.Lock()
+
+
+def get_hash_executor(processes, name="hash"):
+    key = (name, processes)
+    with _hash_executors_lock:
+        executor, pid = _hash_executors.get(key, (None, None))
+        # pre-forked workers must not use a pool of their parent
+        if executor is None or pid != os.getpid():
+            executor = ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            _hash_executors[key] = executor, os.getpid()
+        return executor
 
 
 class AuthDictProxy(DictProxy):
+    name = "doveauth"
+    priority = PRIORITY_HIGH
+
+    # AddressFilter of existing addresses if unknown addresses
+    # are to be answered without disk access
+    address_filter = None
+
     def __init__(self, config):
         super().__init__()
         self.config = config
+        if config.dictproxy_userdb_cache_size > 0:
+            self.userdb_cache = UserdbCache(config.dictproxy_userdb_cache_size)
+        else:
+            self.userdb_cache = None
+        self.hasher = PasswordHasher(
+            config.dictproxy_hash_processes, config.dictproxy_creations_per_second
+        )
+        self.policy = PolicyWatcher(config)
+        # flushes Dovecot's cached negative replies for created accounts
+        self.auth_cache = AuthCacheFlusher() if config.auth_cache_ttl > 0 else None
+
+    def init_address_filter(self):
+        """Build the address filter from the mailboxes directory.
+
+        Accounts must only be created through this proxy afterwards,
+        accounts created otherwise are unknown until the next rebuild.
+        """
+        if self.config.dictproxy_address_filter:
+            self.address_filter = AddressFilter.from_mailboxes_dir(
+                self.config.mailboxes_dir
+            )
+
+    def on_worker_start(self, worker):
+        super().on_worker_start(worker)
+        self.policy.start()
+        if self.auth_cache is not None:
+            self.auth_cache.start()
+        # pre-forked workers share the filter, one of them rebuilds it
+        if self.address_filter is not None and not worker:
+            self.address_filter.start_rebuilder(self.config.mailboxes_dir)
+
+    def on_worker_stop(self, worker):
+        super().on_worker_stop(worker)
+        self.policy.stop()
 
     def handle_lookup(self, parts):
         # Dovecot <2.3.17 has only one part,
         # do not attempt to read any other parts for compatibility.
-        keyname = parts[0]
-
-        namespace, type, args = keyname.split("/", 2)
-        args = list(split_and_unescape(args))
+        namespace, type, args = parse_key(parts[0])
 
         config = self.config
         reply_command = "F"
@@ -116,46 +339,143 @@ class AuthDictProxy(DictProxy):
                     reply_command = "N"
             elif type == "passdb":
                 user = args[1]
+                reply_command = "N"
                 if user.endswith(f"@{config.mail_domain}"):
-                    res = self.lookup_passdb(user, cleartext_password=args[0])
+                    try:
+                        res = self.lookup_passdb(user, cleartext_password=args[0])
+                    except CreationDeferred:
+                        # dovecot caches "N" replies but not failures
+                        reply_command = "F"
                 if res:
                     reply_command = "O"
-                else:
-                    reply_command = "N"
         json_res = json.dumps(res) if res else ""
         return f"{reply_command}{json_res}\n"
 
     def handle_iterate(self, parts):
         # example: I0\t0\tshared/userdb/
-        if parts[2] == "shared/userdb/":
-            result = "".join(
-                f"Oshared/userdb/{user}\t\n" for user in self.iter_userdb()
-            )
-            return f"{result}\n"
-
-    def iter_userdb(self) -> list:
-        """Get a list of all user addresses."""
-        return [x for x in os.listdir(self.config.mailboxes_dir) if "@" in x]
+        flags, max_rows, path = int(parts[0]), int(parts[1]), parts[2]
+        if not path.startswith("shared/userdb/"):
+            return "\n"
+        prefix = path.removeprefix("shared/userdb/")
+        return self.iter_userdb_replies(prefix, flags, max_rows)
+
+    def iter_userdb_replies(self, prefix="", flags=0, max_rows=0):
+        """Yield iterate reply lines of all users starting with `prefix`
+        in chunks of at most ITERATE_CHUNK_SIZE lines,
+        followed by the empty line ending the iteration.
+
+        Unless sorting is requested, the mailboxes directory
+        is scanned lazily so memory use does not depend on the number of users.
+        The user index is sorted already.
+        """
+        users = self.iter_userdb()
+        if prefix:
+            if flags & ITERATE_FLAG_EXACT_KEY:
+                users = (x for x in users if x == prefix)
+            else:
+                users = (x for x in users if x.startswith(prefix))
+        sort_flags = ITERATE_FLAG_SORT_BY_KEY | ITERATE_FLAG_SORT_BY_VALUE
+        if flags & sort_flags and self.config.get_user_index() is None:
+            # values are empty, so sorting by value also sorts by key
+            users = sorted(users)
+        if max_rows > 0:
+            users = itertools.islice(users, max_rows)
+
+        chunk = []
+        for user in users:
+            chunk.append(f"Oshared/userdb/{user}\t\n")
+            if len(chunk) >= ITERATE_CHUNK_SIZE:
+                yield "".join(chunk)
+                chunk = []
+        chunk.append("\n")
+        yield "".join(chunk)
+
+    def iter_userdb(self):
+        """Yield the addresses of all users, from the user index if enabled."""
+        index = self.config.get_user_index()
+        if index is not None:
+            return index.iter_addresses()
+        return self.config.get_user_store().iter_addresses()
+
+    def get_userdb_dict(self, user):
+        if self.userdb_cache is None:
+            return user.get_userdb_dict()
+        userdb, hit = self.userdb_cache.lookup(user)
+        if self.metrics is not None:
+            self.metrics.add_userdb_cache_lookup(hit)
+        return userdb
+
+    def is_unknown(self, addr):
+        """Return True if `addr` definitely has no account."""
+        return self.address_filter is not None and addr not in self.address_filter
 
     def lookup_userdb(self, addr):
-        return self.config.get_user(addr).get_userdb_dict()
+        if self.is_unknown(addr):
+            return {}
+        return self.get_userdb_dict(self.config.get_user(addr))
 
     def lookup_passdb(self, addr, cleartext_password):
-        user = self.config.get_user(addr)
-        userdata = user.get_userdb_dict()
-        if userdata:
-            return userdata
-        if not is_allowed_to_create(self.config, addr, cleartext_password):
+        """Return the userdb dict of `addr`, creating its account if needed,
+        or None if `addr` has no account and can not get one.
+
+        Raises CreationDeferred if the account can not be created
+        at the moment but later.
+        """
+        if not self.is_unknown(addr):
+            user = self.config.get_user(addr)
+            userdata = self.get_userdb_dict(user)
+            if userdata:
+                return self.rehash_if_needed(user, userdata, cleartext_password)
+        if not is_allowed_to_create(
+            self.config, addr, cleartext_password, nocreate=False
+        ):
             return
+        if self.policy.is_nocreate():
+            logging.warning(
+                f"blocked account creation because {NOCREATE_FILE!r} exists."
+            )
+            raise CreationDeferred(f"{NOCREATE_FILE!r} exists")
+        if not self.hasher.admit():
+            raise CreationDeferred("account creation budget exceeded")
 
-        lock = filelock.FileLock(str(user.password_path) + ".lock", timeout=5)
-        with lock:
-            userdata = user.get_userdb_dict()
-            if userdata:
-                return userdata
-            user.set_password(encrypt_password(cleartext_password))
+        user = self.config.get_user(addr)
+        enc_password = self.hasher.encrypt_password(
+            cleartext_password, self.config.password_scheme, self.config.password_rounds
+        )
+        if user.create_password(enc_password):
             print(f"Created address: {addr}", file=sys.stderr)
-        return user.get_userdb_dict()
+            if self.auth_cache is not None:
+                self.auth_cache.flush_later(addr)
+            index = self.config.get_user_index()
+            if index is not None:
+                index.add(addr, time.time())
+        # else a concurrent login created the account first and its password wins
+        if self.address_filter is not None:
+            self.address_filter.add(addr)
+        return self.get_userdb_dict(user)
+
+    def rehash_if_needed(self, user, userdata, cleartext_password):
+        """Replace the password hash of `user` if it was not made
+        with the configured scheme and cost and the login is successful,
+        and return the current userdb dict.
+
+        The password is verified at most once per REHASH_INTERVAL
+        for each address, also if the verification fails.
+        """
+        scheme, rounds = self.config.password_scheme, self.config.password_rounds
+        if not needs_rehash(userdata["password"], scheme, rounds):
+            return userdata
+        if not self.hasher.admit_rehash(user.addr):
+            return userdata
+        enc_password = self.hasher.rehash_password(
+            cleartext_password, userdata["password"], scheme, rounds
+        )
+        if enc_password is None:
+            # wrong password, dovecot fails the login
+            return userdata
+        user.replace_password(enc_password)
+        logging.info(f"rehashed password of {user.addr} with {scheme}")
+        return self.get_userdb_dict(user)
 
 
 def main():
@@ -163,7 +483,9 @@ def main():
     config = read_config(cfgpath)
 
     migrate_from_db_to_maildir(config)
+    rebuild_if_missing(config)
 
     dictproxy = AuthDictProxy(config=config)
+    dictproxy.init_address_filter()
 
-    dictproxy.serve_forever_from_socket(socket)
+    dictproxy.serve_from_config(socket, config)
@@ -3,6 +3,7 @@ Expire old messages and addresses.
 
 """
 
+import itertools
 import os
 import re
 import shutil
@@ -14,7 +15,10 @@ from datetime import datetime
 from pathlib import Path
 from stat import S_ISREG
 
+from chatmaild.authcache import FLUSH_BATCH_SIZE, AuthCacheFlusher
 from chatmaild.config import read_config
+from chatmaild.mailboxes import get_mailbox_dir, iter_mailbox_dirs
+from chatmaild.userindex import rebuild_if_missing
 
 FileEntry = namedtuple("FileEntry", ("path", "mtime", "size"))
 QuotaFileEntry = namedtuple("QuotaFileEntry", ("mtime", "quota_size", "path"))
@@ -22,18 +26,29 @@ QuotaFileEntry = namedtuple("QuotaFileEntry", ("mtime", "quota_size", "path"))
 # Quota cleanup factor of max_mailbox_size. The mailbox is reset to this size.
 QUOTA_CLEANUP_FACTOR = 0.7
 
+# Files left in mailboxes by account creation:
+# lock files of former versions and temporary password files of crashed creations.
+STALE_CREATION_FILE_RE = re.compile(r"^password\.(lock|tmp-[0-9a-f]+)$")
+
 # e.g. "cur/1775324677.M448978P3029757.exam,S=3235,W=3305:2,S"
 _dovecot_fn_rex = re.compile(r".+/(\d+)\..+,S=(\d+)")
 
 
-def iter_mailboxes(basedir, maxnum):
+def iter_mailboxes(basedir, maxnum, store=None):
+    """Yield a MailboxStat for each mailbox in `basedir` of any layout.
+
+    Mailboxes are listed lazily, so with `maxnum` only that many are visited.
+    Last logins are taken from `store` unless it keeps them in the mailboxes.
+    """
     if not os.path.exists(basedir):
         print_info(f"no mailboxes found at: {basedir}")
         return
 
-    for name in os_listdir_if_exists(basedir)[:maxnum]:
-        if "@" in name:
-            yield MailboxStat(basedir + "/" + name)
+    for name, path in itertools.islice(iter_mailbox_dirs(basedir), maxnum):
+        mbox = MailboxStat(path)
+        if store is not None and not store.in_maildir:
+            mbox.last_login = store.get_last_login(name)
+        yield mbox
 
 
 def get_file_entry(path):
@@ -134,14 +149,58 @@ class Expiry:
         self.del_files = 0
         self.all_files = 0
         self.start = time.time()
+        if config.auth_cache_ttl > 0 and not dry:
+            self.auth_cache = AuthCacheFlusher()
+        else:
+            self.auth_cache = None
+        self.user_index = config.get_user_index()
+        self.removed = set()
+        self.unflushed = 0
 
     def remove_mailbox(self, mboxdir):
         if self.verbose:
             print_info(f"removing {mboxdir}")
+        addr = os.path.basename(mboxdir)
         if not self.dry:
-            shutil.rmtree(mboxdir)
+            # remove the account first so that it can not log in meanwhile
+            self.config.get_user_store().delete(addr)
+            if self.user_index is not None:
+                self.user_index.delete(addr)
+            try:
+                shutil.rmtree(mboxdir)
+            except FileNotFoundError:
+                print_info(f"mailbox not found/vanished {mboxdir}")
+        if self.auth_cache is not None:
+            self.auth_cache.flush_later(addr)
+            self.unflushed += 1
+            # flush during long runs, removed accounts may be cached meanwhile
+            if self.unflushed >= FLUSH_BATCH_SIZE:
+                self.flush_auth_cache()
+        self.removed.add(addr)
         self.del_mboxes += 1
 
+    def remove_inactive_users(self, maxnum=None):
+        """Remove mailboxes of users who did not log in for too long
+        according to the user index, without scanning the mailboxes."""
+        cutoff = self.now - int(self.config.delete_inactive_users_after) * 86400
+        mailboxes_dir, layout = self.config.mailboxes_dir, self.config.mailboxes_layout
+        for entry in itertools.islice(self.user_index.iter_entries(), maxnum):
+            if entry.last_login and entry.last_login < cutoff:
+                self.all_mboxes += 1
+                self.remove_mailbox(get_mailbox_dir(mailboxes_dir, entry.addr, layout))
+
+    def compact_user_index(self):
+        """Fold the changes of the last day into the user index."""
+        if self.user_index is not None and not self.dry:
+            self.user_index.compact(self.config.get_user_store())
+
+    def flush_auth_cache(self):
+        """Flush cached authentication entries of removed mailboxes
+        so that Dovecot does not log in to or deliver for them anymore."""
+        if self.auth_cache is not None:
+            self.auth_cache.flush_queued()
+            self.unflushed = 0
+
     def remove_file(self, path, mtime=None):
         if self.verbose:
             if mtime is not None:
@@ -163,12 +222,20 @@ class Expiry:
         cutoff_mails = self.now - int(self.config.delete_mails_after) * 86400
         cutoff_large_mails = self.now - int(self.config.delete_large_after) * 86400
 
+        if os.path.basename(mbox.basedir) in self.removed:
+            return
         self.all_mboxes += 1
         changed = False
         if mbox.last_login and mbox.last_login < cutoff_without_login:
             self.remove_mailbox(mbox.basedir)
             return
 
+        for entry in mbox.extrafiles:
+            name = os.path.basename(entry.path)
+            # a temporary password file is only stale once its creation is over
+            if STALE_CREATION_FILE_RE.match(name) and entry.mtime < self.now - 3600:
+                self.remove_file(entry.path)
+
         mboxname = os.path.basename(mbox.basedir)
         if self.verbose:
             date = datetime.fromtimestamp(mbox.last_login) if mbox.last_login else None
@@ -255,8 +322,15 @@ def daily_expire_main(args=None):
 
     maxnum = int(args.maxnum) if args.maxnum else None
     exp = Expiry(config, dry=not args.remove, now=now, verbose=args.verbose)
-    for mailbox in iter_mailboxes(str(config.mailboxes_dir), maxnum=maxnum):
+    if not exp.dry:
+        rebuild_if_missing(config)
+    if exp.user_index is not None:
+        exp.remove_inactive_users(maxnum)
+    store = config.get_user_store()
+    for mailbox in iter_mailboxes(str(config.mailboxes_dir), maxnum, store):
         exp.process_mailbox_stat(mailbox)
+    exp.flush_auth_cache()
+    exp.compact_user_index()
     print(exp.get_summary())
 
 
@@ -37,8 +37,10 @@ class FileDict:
             return {}
 
 
-def write_bytes_atomic(path, content):
+def write_bytes_atomic(path, content, mode=None):
     rint = randint(0, 10000000)
     tmp = path.with_name(path.name + f".tmp-{rint}")
     tmp.write_bytes(content)
+    if mode is not None:
+        os.chmod(tmp, mode)
     os.rename(tmp, path)
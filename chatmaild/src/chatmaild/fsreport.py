@@ -13,6 +13,10 @@ to show storage summaries only for first 1000 mailboxes
 
     python -m chatmaild.fsreport /path/to/chatmail.ini --maxnum 1000
 
+to only show login stats, from the user index if enabled
+
+    python -m chatmaild.fsreport /path/to/chatmail.ini --logins-only
+
 to write Prometheus textfile for node_exporter
 
     python -m chatmaild.fsreport --textfile /var/lib/prometheus/node-exporter/
@@ -25,6 +29,7 @@ to also write legacy metrics.py style output (default: /var/www/html/metrics):
 
 """
 
+import itertools
 import os
 import tempfile
 from argparse import ArgumentParser
@@ -73,18 +78,22 @@ class Report:
         self.message_buckets = {x: 0 for x in self.message_size_thresholds}
         self.message_count_buckets = {x: 0 for x in self.message_size_thresholds}
 
-    def process_mailbox_stat(self, mailbox):
+    def process_login(self, addr, last_login):
         # categorize login times
-        last_login = mailbox.last_login
         if last_login:
             self.num_all_logins += 1
-            if os.path.basename(mailbox.basedir)[:3] == "ci-":
+            if addr[:3] == "ci-":
                 self.num_ci_logins += 1
             else:
                 for days in self.login_buckets:
                     if last_login >= self.now - days * DAYSECONDS:
                         self.login_buckets[days] += 1
 
+    def process_mailbox_stat(self, mailbox, logins=True):
+        last_login = mailbox.last_login
+        if logins:
+            self.process_login(os.path.basename(mailbox.basedir), last_login)
+
         cutoff_login_date = self.now - self.min_login_age * DAYSECONDS
         if last_login and last_login <= cutoff_login_date:
             # categorize message sizes
@@ -244,6 +253,12 @@ def main(args=None):
         action="store",
         help="maximum number of mailboxes to iterate on",
     )
+    parser.add_argument(
+        "--logins-only",
+        dest="logins_only",
+        action="store_true",
+        help="only gather login stats, without scanning mailbox messages",
+    )
     parser.add_argument(
         "--textfile",
         metavar="PATH",
@@ -270,8 +285,18 @@ def main(args=None):
 
     maxnum = int(args.maxnum) if args.maxnum else None
     rep = Report(now=now, min_login_age=int(args.min_login_age), mdir=args.mdir)
-    for mbox in iter_mailboxes(str(config.mailboxes_dir), maxnum=maxnum):
-        rep.process_mailbox_stat(mbox)
+    store = config.get_user_store()
+    index = config.get_user_index()
+    if index is not None:
+        # login stats come from the user index, without stat'ing passwords
+        for entry in itertools.islice(index.iter_entries(), maxnum):
+            rep.process_login(entry.addr, entry.last_login)
+    if not args.logins_only:
+        for mbox in iter_mailboxes(str(config.mailboxes_dir), maxnum, store):
+            rep.process_mailbox_stat(mbox, logins=index is None)
+    elif index is None:
+        for addr, _, last_login in itertools.islice(store.iter_users(), maxnum):
+            rep.process_login(addr, last_login)
     if args.textfile:
         path = args.textfile
         if os.path.isdir(path):
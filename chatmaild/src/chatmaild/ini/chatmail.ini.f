@@ -42,6 +42,48 @@ mail_domain = {mail_domain}
 # minimum length a password must have
 #password_min_length = 9
 
+# Scheme and cost of stored password hashes, one of
+# SHA512-CRYPT, SHA256-CRYPT (rounds 1000 or more, default 5000)
+# or BLF-CRYPT (log2 rounds between 4 and 31, default 12).
+# 0 uses the default of the scheme. Existing hashes are replaced
+# with the configured scheme and cost on their next successful login.
+# Run "chatmail-hash-calibrate" on the relay to find a cost.
+#password_scheme = SHA512-CRYPT
+#password_rounds = 0
+
+# Seconds Dovecot caches successful authentication lookups
+# and lookups of unknown addresses or wrong passwords (negative).
+# doveauth and chatmail-expire flush the entries of an address
+# when its account is created or removed. Creations rejected by the
+# creation budget or /etc/chatmail-nocreate fail temporarily
+# and are not cached. 0 disables the cache.
+#auth_cache_ttl = 3600
+#auth_cache_negative_ttl = 300
+
+# Where passwords and last-login times of users are stored:
+# "maildir" keeps them in a password file in each mailbox directory,
+# "sqlite" in a single SQLite database at user_store_path
+# (default: userstore.sqlite in the mailboxes directory).
+# Run "chatmail-migrate-userstore" before changing it on a running relay.
+#user_store = maildir
+#user_store_path =
+
+# Keep a compact sorted index of all users and their last-login days
+# which doveauth iteration, chatmail-expire and chatmail-fsreport read
+# instead of walking the mailboxes directory.
+# It is kept in user_index_path (default: userindex in the mailboxes directory)
+# and recreated with "chatmail-rebuild-userindex".
+#user_index = false
+#user_index_path =
+
+# How mailbox directories are arranged in the mailboxes directory:
+# "flat" keeps all of them in one directory,
+# "hashed" spreads them over two levels of subdirectories
+# named after the MD5 sum of the address, for relays with many users.
+# Flat mailboxes keep working with "hashed" and are moved
+# while the relay runs with "chatmail-migrate-mailboxes".
+#mailboxes_layout = flat
+
 # Use externally managed TLS certificates instead of built-in acmetool.
 # Paths refer to files on the deployment server (not the build machine).
 # Both files must already exist before running cmdeploy.
@@ -85,6 +127,68 @@ mail_domain = {mail_domain}
 
 # mtail_address = 127.0.0.1
 
+#
+# Dict proxy tuning (doveauth, chatmail-metadata, lastlogin)
+#
+
+# How the dict proxies serve Dovecot connections:
+# "threads" starts one thread per connection,
+# "asyncio" multiplexes all connections on one event loop
+# and handles requests in a bounded thread pool.
+#dictproxy_engine = threads
+
+# maximum number of threads handling requests with the "asyncio" engine
+#dictproxy_max_threads = 32
+
+# Request batches waiting for those threads are queued
+# with authentication lookups first and last-login updates last,
+# and their connections are not read from until the threads catch up,
+# so overload results in waiting instead of growing memory use.
+# If more than dictproxy_max_queue batches are waiting
+# or batches waited longer than dictproxy_queue_budget_ms milliseconds,
+# last-login updates are dropped instead of queued (0 disables the budget).
+#dictproxy_max_queue = 1000
+#dictproxy_queue_budget_ms = 500
+
+# number of processes serving each dict proxy socket.
+# With more than 1, worker processes are forked which share the socket,
+# can use multiple CPU cores and are restarted if they crash.
+#dictproxy_workers = 1
+
+# number of userdb entries doveauth keeps in memory (0 disables the cache).
+# Entries are validated with a stat of the password file on each lookup.
+#dictproxy_userdb_cache_size = 10000
+
+# If true, doveauth keeps an in-memory filter of all account addresses
+# and answers lookups of unknown addresses which may not be created
+# without disk access. It is built when doveauth starts and rebuilt
+# every 6 hours, so accounts must not be created by other means meanwhile.
+#dictproxy_address_filter = true
+
+# number of processes hashing the passwords of new accounts
+# (0 hashes them in the doveauth request handler threads)
+#dictproxy_hash_processes = 2
+
+# maximum number of accounts created per second (0 disables the limit).
+# Logins creating further accounts fail and are retried by clients.
+#dictproxy_creations_per_second = 100
+
+# Dict requests taking longer than dictproxy_slow_request_ms milliseconds
+# are logged with the Python stack of their handler thread
+# and counted in the metrics (0 disables the watchdog).
+#dictproxy_slow_request_ms = 1000
+
+# "separate" runs doveauth, chatmail-metadata and lastlogin
+# as three services while "combined" serves all their sockets
+# from a single "chatmail-dictproxy" service sharing config and per-user state.
+#dictproxy_layout = separate
+
+# If set, the dict proxies write per-command request latency histograms,
+# request and error counters and connection/transaction gauges
+# every 15 seconds as Prometheus textfiles into this directory,
+# e.g. for the node_exporter textfile collector.
+#dictproxy_metrics_dir = /var/lib/prometheus/node-exporter
+
 #
 # Debugging options 
 #
@@ -1,10 +1,13 @@
 import sys
 
 from .config import read_config
-from .dictproxy import DictProxy
+from .dictproxy import PRIORITY_LOW, DictProxy
 
 
 class LastLoginDictProxy(DictProxy):
+    name = "lastlogin"
+    priority = PRIORITY_LOW
+
     def __init__(self, config):
         super().__init__()
         self.config = config
@@ -17,6 +20,9 @@ class LastLoginDictProxy(DictProxy):
             timestamp = int(value)
             user = self.config.get_user(addr)
             user.set_last_login_timestamp(timestamp)
+            index = self.config.get_user_index()
+            if index is not None and user.can_track:
+                index.set_last_login(addr, timestamp)
             return True
 
         return False
@@ -26,4 +32,4 @@ def main():
     socket, config_path = sys.argv[1:]
     config = read_config(config_path)
     dictproxy = LastLoginDictProxy(config=config)
-    dictproxy.serve_forever_from_socket(socket)
+    dictproxy.serve_from_config(socket, config)
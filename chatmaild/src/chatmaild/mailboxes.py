@@ -0,0 +1,188 @@
+"""
+Layouts of mailbox directories in the mailboxes directory.
+
+With the "flat" layout the mailbox of an address is ``<mailboxes_dir>/<addr>``.
+With the "hashed" layout it is ``<mailboxes_dir>/ab/cd/<addr>``
+where "abcd" are the first hex digits of the MD5 sum of the address,
+the path Dovecot expands from ``%2Mu/%2.2Mu/%u``,
+so that no directory holds more than a few thousand entries.
+
+Flat mailboxes are still found with the hashed layout
+and can be moved while the relay is running:
+
+    chatmail-migrate-mailboxes /usr/local/lib/chatmaild/chatmail.ini
+
+moves them one by one to their hashed location,
+flushes their auth cache entries and disconnects their sessions
+so that Dovecot reconnects them to the new location.
+"""
+
+import hashlib
+import itertools
+import os
+import shutil
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+
+from .authcache import AuthCacheFlusher
+
+# supported values of the "mailboxes_layout" setting
+# with the Dovecot path of a mailbox relative to the mailboxes directory
+MAILBOXES_LAYOUTS = {"flat": "%u", "hashed": "%2Mu/%2.2Mu/%u"}
+
+HEXDIGITS = frozenset("0123456789abcdef")
+
+
+def get_hashed_dir(mailboxes_dir, addr):
+    """Return the mailbox directory of `addr` with the hashed layout."""
+    digest = hashlib.md5(addr.encode()).hexdigest()
+    return mailboxes_dir.joinpath(digest[:2], digest[2:4], addr)
+
+
+def get_mailbox_dir(mailboxes_dir, addr, layout="flat"):
+    """Return the mailbox directory of `addr`.
+
+    With the hashed layout, an existing flat mailbox
+    which was not migrated yet is returned.
+    """
+    if layout == "flat":
+        return mailboxes_dir.joinpath(addr)
+    hashed = get_hashed_dir(mailboxes_dir, addr)
+    if not hashed.exists():
+        flat = mailboxes_dir.joinpath(addr)
+        if flat.exists():
+            return flat
+    return hashed
+
+
+def is_shard_name(name):
+    return len(name) == 2 and HEXDIGITS.issuperset(name)
+
+
+def iter_mailbox_dirs(mailboxes_dir):
+    """Yield (addr, path) of all mailboxes of any layout in `mailboxes_dir`.
+
+    Directories are scanned lazily, one at a time.
+    """
+    try:
+        with os.scandir(mailboxes_dir) as entries:
+            for entry in entries:
+                if "@" in entry.name:
+                    yield entry.name, entry.path
+                elif is_shard_name(entry.name):
+                    yield from _iter_shard(entry.path, depth=1)
+    except FileNotFoundError:
+        return
+
+
+def _iter_shard(path, depth):
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if depth == 2 and "@" in entry.name:
+                    yield entry.name, entry.path
+                elif depth == 1 and is_shard_name(entry.name):
+                    yield from _iter_shard(entry.path, depth=2)
+    except FileNotFoundError:
+        return
+
+
+def iter_flat_mailboxes(mailboxes_dir):
+    """Yield (addr, path) of mailboxes with the flat layout."""
+    try:
+        with os.scandir(mailboxes_dir) as entries:
+            for entry in entries:
+                if "@" in entry.name:
+                    yield entry.name, entry.path
+    except FileNotFoundError:
+        return
+
+
+def migrate_mailbox(mailboxes_dir, addr):
+    """Move the flat mailbox of `addr` to its hashed location
+    and return the new path, or None if a mailbox exists there already."""
+    hashed = get_hashed_dir(mailboxes_dir, addr)
+    hashed.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        # renaming replaces an empty directory but never a non-empty one
+        os.rename(mailboxes_dir.joinpath(addr), hashed)
+    except OSError:
+        if hashed.exists():
+            return None
+        raise
+    return hashed
+
+
+def kick_user(addr):
+    """Disconnect the Dovecot sessions of `addr`."""
+    doveadm = shutil.which("doveadm")
+    if doveadm is None:
+        return
+    subprocess.run(
+        [doveadm, "kick", addr],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    )
+
+
+def migrate_main(args=None):
+    """Move flat mailboxes to the hashed layout while the relay is running.
+
+    Set "mailboxes_layout = hashed" in chatmail.ini and deploy before,
+    new accounts are then created with the hashed layout
+    and flat mailboxes keep working until they are moved.
+    """
+    from .config import read_config
+
+    parser = ArgumentParser(description=migrate_main.__doc__)
+    parser.add_argument("chatmail_ini", help="path pointing to chatmail.ini file")
+    parser.add_argument(
+        "--maxnum",
+        type=int,
+        default=None,
+        help="maximum number of mailboxes to move",
+    )
+    parser.add_argument(
+        "--pause",
+        type=float,
+        default=0.01,
+        help="seconds to wait after each moved mailbox (default 0.01)",
+    )
+    parser.add_argument(
+        "--no-kick",
+        dest="kick",
+        action="store_false",
+        help="do not disconnect the sessions of moved mailboxes",
+    )
+    args = parser.parse_args(args)
+
+    config = read_config(args.chatmail_ini)
+    if config.mailboxes_layout != "hashed":
+        parser.error("set mailboxes_layout = hashed in chatmail.ini and deploy first")
+
+    flusher = AuthCacheFlusher() if config.auth_cache_ttl > 0 else None
+    mailboxes_dir = config.mailboxes_dir
+    moved = conflicts = 0
+    start = time.time()
+    # the directory listing changes while moving, so it is read first
+    addrs = [addr for addr, _ in iter_flat_mailboxes(mailboxes_dir)]
+    for addr in itertools.islice(addrs, args.maxnum):
+        if migrate_mailbox(mailboxes_dir, addr) is None:
+            print(f"not moving {addr}: hashed mailbox exists", file=sys.stderr)
+            conflicts += 1
+            continue
+        moved += 1
+        if flusher is not None:
+            flusher.flush_quietly([addr])
+        if args.kick:
+            kick_user(addr)
+        if moved % 1000 == 0:
+            print(f"migration-progress: {moved} mailboxes moved", file=sys.stderr)
+        time.sleep(args.pause)
+    print(
+        f"moved {moved} of {len(addrs)} flat mailboxes,"
+        f" {conflicts} conflicts, in {time.time() - start:.2f} seconds"
+    )
@@ -7,6 +7,7 @@ from contextlib import contextmanager
 from .config import read_config
 from .dictproxy import DictProxy
 from .filedict import FileDict
+from .mailboxes import get_mailbox_dir
 from .notifier import Notifier
 
 
@@ -27,14 +28,17 @@ def _is_valid_token_timestamp(timestamp, now):
 class Metadata:
     # each SETMETADATA on this key appends to dictionary
     # mapping of unique device tokens
-    # which only ever get removed if the upstream indicates the token is invalid
+    # which get removed if the upstream indicates the token is invalid
+    # or all at once when the client unsets the key
     DEVICETOKEN_KEY = "devicetoken"
 
-    def __init__(self, vmail_dir):
+    def __init__(self, vmail_dir, layout="flat"):
         self.vmail_dir = vmail_dir
+        self.layout = layout
 
     def get_metadata_dict(self, addr):
-        return FileDict(self.vmail_dir / addr / "metadata.json")
+        maildir = get_mailbox_dir(self.vmail_dir, addr, self.layout)
+        return FileDict(maildir / "metadata.json")
 
     @contextmanager
     def _modify_tokens(self, addr):
@@ -63,6 +67,10 @@ class Metadata:
             if token in tokens:
                 del tokens[token]
 
+    def remove_all_tokens_from_addr(self, addr):
+        with self._modify_tokens(addr) as tokens:
+            tokens.clear()
+
     def get_tokens_for_addr(self, addr):
         mdict = self.get_metadata_dict(addr).read()
         tokens = mdict.get(self.DEVICETOKEN_KEY, {})
@@ -87,6 +95,8 @@ class Metadata:
 
 
 class MetadataDictProxy(DictProxy):
+    name = "metadata"
+
     def __init__(
         self,
         notifier,
@@ -94,6 +104,7 @@ class MetadataDictProxy(DictProxy):
         iroh_relay=None,
         turn_hostname=None,
         turn_socket_path=None,
+        workers=1,
     ):
         super().__init__()
         self.notifier = notifier
@@ -101,6 +112,20 @@ class MetadataDictProxy(DictProxy):
         self.iroh_relay = iroh_relay
         self.turn_hostname = turn_hostname
         self.turn_socket_path = turn_socket_path
+        self.workers = workers
+
+    def on_worker_start(self, worker):
+        super().on_worker_start(worker)
+        # Each worker requeues the pending notifications it persisted,
+        # they are lost from memory when it is restarted.
+        self.notifier.use_worker_queue(worker, self.workers)
+        self.notifier.start_notification_threads(self.metadata.remove_token_from_addr)
+
+    def get_lookup_coalesce_key(self, parts):
+        # every TURN lookup must get its own credentials
+        if parts[0].endswith("/turn"):
+            return None
+        return tuple(parts)
 
     def handle_lookup(self, parts):
         # Lpriv/43f5f508a7ea0366dff30200c15250e3/devicetoken\tlkj123poi@c2.testrun.org
@@ -136,7 +161,10 @@ class MetadataDictProxy(DictProxy):
         value = parts[2] if len(parts) > 2 else ""
         match keyname:
             case ["priv", _, key] if key == self.metadata.DEVICETOKEN_KEY:
-                self.metadata.add_token_to_addr(addr, value)
+                if value:
+                    self.metadata.add_token_to_addr(addr, value)
+                else:
+                    self.metadata.remove_all_tokens_from_addr(addr)
                 return True
             case ["priv", _, "messagenew"]:
                 self.notifier.new_message_for_addr(addr, self.metadata)
@@ -144,32 +172,46 @@ class MetadataDictProxy(DictProxy):
 
         return False
 
+    def handle_unset(self, addr, parts):
+        match parts[1].split("/"):
+            case ["priv", _, key] if key == self.metadata.DEVICETOKEN_KEY:
+                # The unset does not tell which of the tokens to remove,
+                # so no device of the address is notified anymore.
+                self.metadata.remove_all_tokens_from_addr(addr)
+                return True
 
-def main():
-    socket, config_path = sys.argv[1:]
+        return False
 
-    config = read_config(config_path)
-    iroh_relay = config.iroh_relay
-    mail_domain = config.mail_domain
-    socket_path = config.turn_socket_path
 
+def create_dictproxy(config):
+    """Return a MetadataDictProxy for `config`
+    or None if the mailboxes directory does not exist."""
     vmail_dir = config.mailboxes_dir
     if not vmail_dir.exists():
         logging.error("vmail dir does not exist: %r", vmail_dir)
-        return 1
+        return None
 
     queue_dir = vmail_dir / "pending_notifications"
     queue_dir.mkdir(exist_ok=True)
-    metadata = Metadata(vmail_dir)
+    metadata = Metadata(vmail_dir, config.mailboxes_layout)
     notifier = Notifier(queue_dir)
-    notifier.start_notification_threads(metadata.remove_token_from_addr)
 
-    dictproxy = MetadataDictProxy(
+    return MetadataDictProxy(
         notifier=notifier,
         metadata=metadata,
-        iroh_relay=iroh_relay,
-        turn_hostname=mail_domain,
-        turn_socket_path=socket_path,
+        iroh_relay=config.iroh_relay,
+        turn_hostname=config.mail_domain,
+        turn_socket_path=config.turn_socket_path,
+        workers=config.dictproxy_workers,
     )
 
-    dictproxy.serve_forever_from_socket(socket)
+
+def main():
+    socket, config_path = sys.argv[1:]
+
+    config = read_config(config_path)
+    dictproxy = create_dictproxy(config)
+    if dictproxy is None:
+        return 1
+
+    dictproxy.serve_from_config(socket, config)
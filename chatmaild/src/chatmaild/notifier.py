@@ -74,6 +74,7 @@ class Notifier:
     DROP_DEADLINE = 5 * 60 * 60  #  drop notifications after 5 hours
 
     def __init__(self, queue_dir):
+        self.base_queue_dir = queue_dir
         self.queue_dir = queue_dir
         max_tries = int(math.log(self.DROP_DEADLINE, self.BASE_DELAY)) + 1
         self.retry_queues = [PriorityQueue() for _ in range(max_tries)]
@@ -89,8 +90,42 @@ class Notifier:
             )
             self.queue_for_retry(queue_item)
 
+    def use_worker_queue(self, worker, workers=1):
+        """Persist notifications in a queue directory of its own for `worker`.
+
+        A restarted worker requeues only the items it persisted itself,
+        so items of a crashed worker are resent when it is restarted
+        and items in flight in other workers are not sent twice.
+        Worker 0 adopts items persisted by a single-process proxy
+        and by workers which no longer run because the number of
+        `workers` was lowered, a single-process proxy (`worker` is None)
+        adopts those of all workers.
+        """
+        base = self.base_queue_dir
+        worker_dirs = {}
+        for path in base.iterdir():
+            num = path.name[len("worker") :]
+            if path.name.startswith("worker") and num.isdigit():
+                worker_dirs[int(num)] = path
+        if worker is None:
+            self.queue_dir = base
+            sources = list(worker_dirs.values())
+        else:
+            self.queue_dir = base.joinpath(f"worker{worker}")
+            self.queue_dir.mkdir(exist_ok=True)
+            sources = []
+            if worker == 0:
+                sources.append(base)
+                sources.extend(x for num, x in worker_dirs.items() if num >= workers)
+        for source in sources:
+            for path in source.iterdir():
+                if path.is_file():
+                    os.rename(path, self.queue_dir.joinpath(path.name))
+
     def requeue_persistent_queue_items(self):
         for queue_path in self.queue_dir.iterdir():
+            if queue_path.is_dir():
+                continue
             if queue_path.name.endswith(".tmp"):
                 logging.warning(f"removing spurious queue item: {queue_path!r}")
                 queue_path.unlink()
@@ -114,8 +149,9 @@ class Notifier:
 
         self.retry_queues[retry_num].put((when, queue_item))
 
-    def start_notification_threads(self, remove_token_from_addr):
-        self.requeue_persistent_queue_items()
+    def start_notification_threads(self, remove_token_from_addr, requeue=True):
+        if requeue:
+            self.requeue_persistent_queue_items()
         threads = {}
         for retry_num in range(len(self.retry_queues)):
             # use 4 threads for first-try tokens and less for subsequent tries
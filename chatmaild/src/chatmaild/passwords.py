@@ -0,0 +1,169 @@
+"""
+Password hashing with the crypt schemes Dovecot supports.
+
+The scheme and its cost are set with ``password_scheme``
+and ``password_rounds`` in chatmail.ini.
+Stored hashes carry their scheme and cost,
+so doveauth can notice hashes made with other settings
+and replace them on the next successful login.
+``chatmail-hash-calibrate`` measures hashing speed on the host
+and recommends a cost for a targeted time per login.
+"""
+
+import sys
+import time
+from argparse import ArgumentParser
+
+try:
+    import crypt_r
+except ImportError:
+    import crypt as crypt_r
+
+# https://doc.dovecot.org/2.3/configuration_manual/authentication/password_schemes/
+# Dovecot scheme name: (crypt method, default rounds, minimum and maximum rounds).
+# The rounds of BLF-CRYPT are the base 2 logarithm of the iterations.
+SCHEMES = {
+    "SHA512-CRYPT": (crypt_r.METHOD_SHA512, 5000, 1000, 999_999_999),
+    "SHA256-CRYPT": (crypt_r.METHOD_SHA256, 5000, 1000, 999_999_999),
+    "BLF-CRYPT": (crypt_r.METHOD_BLOWFISH, 12, 4, 31),
+}
+
+
+def check_scheme(scheme, rounds):
+    """Raise ValueError if `scheme` with `rounds` (0 for the default) is invalid."""
+    if scheme not in SCHEMES:
+        raise ValueError(f"unsupported password_scheme {scheme!r}")
+    _, _, min_rounds, max_rounds = SCHEMES[scheme]
+    if rounds and not min_rounds <= rounds <= max_rounds:
+        raise ValueError(
+            f"password_rounds for {scheme} must be between {min_rounds} and {max_rounds}"
+        )
+
+
+def encrypt_password(password: str, scheme="SHA512-CRYPT", rounds=0):
+    """Return the Dovecot password string of `password`.
+
+    With 0 `rounds` the default cost of the scheme is used.
+    """
+    method = SCHEMES[scheme][0]
+    if rounds and scheme == "BLF-CRYPT":
+        # mksalt takes the number of iterations
+        rounds = 2**rounds
+    salt = crypt_r.mksalt(method, rounds=rounds or None)
+    return f"{{{scheme}}}" + crypt_r.crypt(password, salt)
+
+
+def get_hash_params(enc_password):
+    """Return the (scheme, rounds) a Dovecot password string was made with.
+
+    Rounds are normalized to the effective value, so a default cost
+    equals the same cost given explicitly.
+    """
+    if not enc_password.startswith("{") or "}" not in enc_password:
+        return None, None
+    scheme, passhash = enc_password[1:].split("}", 1)
+    if scheme not in SCHEMES:
+        return scheme, None
+    default_rounds = SCHEMES[scheme][1]
+    if scheme == "BLF-CRYPT":
+        # e.g. $2b$12$<salt and hash>
+        parts = passhash.split("$")
+        return scheme, int(parts[2]) if len(parts) > 3 else None
+    # e.g. $6$rounds=10000$<salt>$<hash> or $6$<salt>$<hash>
+    parts = passhash.split("$")
+    if len(parts) > 2 and parts[2].startswith("rounds="):
+        return scheme, int(parts[2].removeprefix("rounds="))
+    return scheme, default_rounds
+
+
+def needs_rehash(enc_password, scheme, rounds):
+    """Return True if `enc_password` was not made with `scheme` and `rounds`."""
+    wanted = (scheme, rounds or SCHEMES[scheme][1])
+    return get_hash_params(enc_password) != wanted
+
+
+def verify_password(password, enc_password):
+    """Return True if `password` matches the Dovecot password string."""
+    scheme, rounds = get_hash_params(enc_password)
+    if rounds is None:
+        return False
+    passhash = enc_password.split("}", 1)[1]
+    return crypt_r.crypt(password, passhash) == passhash
+
+
+def rehash_password(password, enc_password, scheme, rounds):
+    """Return `password` hashed with `scheme` and `rounds`
+    or None if it does not match `enc_password`."""
+    if not verify_password(password, enc_password):
+        return None
+    return encrypt_password(password, scheme, rounds)
+
+
+def measure_hash_time(scheme, rounds, duration=0.5):
+    """Return the seconds one hash with `scheme` and `rounds` takes on this host."""
+    num = 0
+    start = time.perf_counter()
+    while True:
+        encrypt_password("calibration-password", scheme, rounds)
+        num += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            return elapsed / num
+
+
+def calibrate(scheme, target):
+    """Return the highest rounds of `scheme`
+    for which hashing takes at most `target` seconds."""
+    _, default_rounds, min_rounds, max_rounds = SCHEMES[scheme]
+    hash_time = measure_hash_time(scheme, min_rounds)
+    if scheme == "BLF-CRYPT":
+        # every further round doubles the cost
+        rounds = min_rounds
+        while rounds < max_rounds and hash_time * 2 <= target:
+            hash_time *= 2
+            rounds += 1
+        return rounds
+    # the cost is linear in the rounds
+    rounds = int(min_rounds * target / hash_time)
+    return max(min_rounds, min(rounds, max_rounds))
+
+
+def calibrate_main(args=None):
+    """Measure password hashing speed and recommend password_rounds
+    for each scheme Dovecot supports."""
+    parser = ArgumentParser(description=calibrate_main.__doc__)
+    parser.add_argument(
+        "--target-ms",
+        type=float,
+        default=50,
+        help="targeted milliseconds of CPU time per hash (default 50)",
+    )
+    parser.add_argument(
+        "--scheme",
+        choices=sorted(SCHEMES),
+        default=None,
+        help="only calibrate this scheme",
+    )
+    args = parser.parse_args(args)
+
+    target = args.target_ms / 1000
+    schemes = [args.scheme] if args.scheme else list(SCHEMES)
+    print(f"{'scheme': <14} {'rounds':>10} {'ms/hash':>9} {'hashes/s':>9}")
+    for scheme in schemes:
+        default_rounds = SCHEMES[scheme][1]
+        hash_time = measure_hash_time(scheme, default_rounds)
+        print(
+            f"{scheme: <14} {default_rounds:>10} {hash_time * 1000:9.2f}"
+            f" {1 / hash_time:9.0f}  (default)"
+        )
+        rounds = calibrate(scheme, target)
+        hash_time = measure_hash_time(scheme, rounds)
+        print(
+            f"{scheme: <14} {rounds:>10} {hash_time * 1000:9.2f}"
+            f" {1 / hash_time:9.0f}  (recommended)"
+        )
+    print(
+        f"\nSet password_scheme and password_rounds in chatmail.ini"
+        f" to spend about {args.target_ms:g}ms per login hash.",
+        file=sys.stderr,
+    )
@@ -2,6 +2,7 @@ import importlib.resources
 import itertools
 import os
 import random
+import time
 from email import policy
 from email.parser import BytesParser
 from pathlib import Path
@@ -9,6 +10,59 @@ from pathlib import Path
 import pytest
 
 from chatmaild.config import read_config, write_initial_config
+from chatmaild.doveauth import PolicyWatcher
+
+
+def pytest_configure(config):
+    config._microbenchresults = {}
+
+
+@pytest.fixture
+def microbench(request):
+    """Time `func` over `num` calls and report the fastest of `repeat` runs."""
+
+    def bench(func, num, name=None, repeat=3):
+        if name is None:
+            name = func.__name__
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(num):
+                func()
+            duration = time.perf_counter() - start
+            best = duration if best is None else min(best, duration)
+        request.config._microbenchresults[name] = best / num
+        return best / num
+
+    return bench
+
+
+def pytest_terminal_summary(terminalreporter):
+    tr = terminalreporter
+    results = getattr(tr.config, "_microbenchresults", None)
+    if not results:
+        return
+
+    tr.section("microbenchmark results")
+    tr.write_line(f"{'microbenchmark name': <40} {'usec/call':>10} {'calls/s':>10}")
+    for name, seconds in results.items():
+        tr.write_line(f"{name: <40} {seconds * 1e6:10.2f} {1 / seconds:10.0f}")
+
+
+@pytest.fixture(autouse=True)
+def stop_policy_watchers(monkeypatch):
+    """Stop the PolicyWatcher threads started during a test."""
+    started = []
+    orig_start = PolicyWatcher.start
+
+    def start(self, *args, **kwargs):
+        started.append(self)
+        return orig_start(self, *args, **kwargs)
+
+    monkeypatch.setattr(PolicyWatcher, "start", start)
+    yield
+    for watcher in started:
+        watcher.stop()
 
 
 @pytest.fixture
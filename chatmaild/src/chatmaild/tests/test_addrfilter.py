@@ -0,0 +1,119 @@
+import os
+import shutil
+
+import chatmaild.addrfilter
+from chatmaild.addrfilter import AddressFilter
+
+
+def make_mailboxes(mailboxes_dir, addrs):
+    for addr in addrs:
+        mailboxes_dir.joinpath(addr).mkdir()
+
+
+def test_add_and_contains():
+    addrfilter = AddressFilter(1000)
+    addrs = [f"user{i:05}@chat.example.org" for i in range(1000)]
+    for addr in addrs:
+        addrfilter.add(addr)
+    assert all(addr in addrfilter for addr in addrs)
+    others = [f"other{i:04}@chat.example.org" for i in range(10000)]
+    false_positives = sum(addr in addrfilter for addr in others)
+    assert false_positives < 300
+
+
+def test_from_mailboxes_dir_and_rebuild(tmp_path):
+    make_mailboxes(
+        tmp_path, ["someone12@chat.example.org", "other1234@chat.example.org"]
+    )
+    tmp_path.joinpath("pending_notifications").mkdir()
+    addrfilter = AddressFilter.from_mailboxes_dir(tmp_path)
+    assert addrfilter.capacity == chatmaild.addrfilter.MIN_CAPACITY
+    assert "someone12@chat.example.org" in addrfilter
+    assert "other1234@chat.example.org" in addrfilter
+    assert "unknown12@chat.example.org" not in addrfilter
+
+    # removed accounts are dropped by a rebuild, added ones are kept
+    shutil.rmtree(tmp_path.joinpath("other1234@chat.example.org"))
+    addrfilter.add("added1234@chat.example.org")
+    make_mailboxes(tmp_path, ["added1234@chat.example.org"])
+    assert addrfilter.rebuild(tmp_path) == 2
+    assert "other1234@chat.example.org" not in addrfilter
+    assert "someone12@chat.example.org" in addrfilter
+    assert "added1234@chat.example.org" in addrfilter
+
+
+def test_add_during_rebuild_is_kept(tmp_path, monkeypatch):
+    make_mailboxes(tmp_path, ["someone12@chat.example.org"])
+    addrfilter = AddressFilter.from_mailboxes_dir(tmp_path)
+    orig_iter_addresses = chatmaild.addrfilter.iter_addresses
+
+    def iter_addresses(mailboxes_dir):
+        # another worker creates an account while the directory is scanned
+        addrfilter.add("created12@chat.example.org")
+        yield from orig_iter_addresses(mailboxes_dir)
+
+    monkeypatch.setattr(chatmaild.addrfilter, "iter_addresses", iter_addresses)
+    addrfilter.rebuild(tmp_path)
+    assert "created12@chat.example.org" in addrfilter
+    assert "someone12@chat.example.org" in addrfilter
+
+
+def test_shared_with_forked_processes(tmp_path):
+    make_mailboxes(tmp_path, ["someone12@chat.example.org"])
+    addrfilter = AddressFilter.from_mailboxes_dir(tmp_path)
+    assert "someone12@chat.example.org" in addrfilter
+    pid = os.fork()
+    if pid == 0:
+        try:
+            make_mailboxes(tmp_path, ["forked123@chat.example.org"])
+            addrfilter.add("forked123@chat.example.org")
+            shutil.rmtree(tmp_path.joinpath("someone12@chat.example.org"))
+            addrfilter.rebuild(tmp_path)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    assert "forked123@chat.example.org" in addrfilter
+    # the rebuild in the child switched the active buffer for all processes
+    assert "someone12@chat.example.org" not in addrfilter
+
+
+def test_bench_address_filter(microbench, monkeypatch):
+    # a synthetic tree of one million accounts
+    num = 1_000_000
+    monkeypatch.setattr(
+        chatmaild.addrfilter,
+        "iter_addresses",
+        lambda mailboxes_dir: (f"u{i:08}@chat.example.org" for i in range(num)),
+    )
+    addrfilter = AddressFilter(2 * num)
+    assert addrfilter.rebuild("/nonexistent") == num
+    assert "u00012345@chat.example.org" in addrfilter
+
+    unknown = "unknown12@chat.example.org"
+    password_path = f"/nonexistent/{unknown}/password"
+    microbench(lambda: unknown in addrfilter, 20000, name="addrfilter-unknown-1M")
+    microbench(
+        lambda: os.path.exists(password_path), 20000, name="stat-unknown-password"
+    )
+
+
+def test_bits_are_packed():
+    addrfilter = AddressFilter(1000)
+    assert addrfilter.numbytes == (addrfilter.numbits + 7) // 8
+    assert len(addrfilter._mem) == 1 + 2 * addrfilter.numbytes
+
+
+def test_from_mailboxes_dir_scans_once(tmp_path, monkeypatch):
+    make_mailboxes(tmp_path, ["someone12@chat.example.org"])
+    orig_iter_addresses = chatmaild.addrfilter.iter_addresses
+    scans = []
+
+    def iter_addresses(mailboxes_dir):
+        scans.append(mailboxes_dir)
+        return orig_iter_addresses(mailboxes_dir)
+
+    monkeypatch.setattr(chatmaild.addrfilter, "iter_addresses", iter_addresses)
+    addrfilter = AddressFilter.from_mailboxes_dir(tmp_path)
+    assert len(scans) == 1
+    assert "someone12@chat.example.org" in addrfilter
+    assert "unknown12@chat.example.org" not in addrfilter
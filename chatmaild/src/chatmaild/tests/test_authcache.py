@@ -0,0 +1,149 @@
+import socket
+import threading
+import time
+
+import pytest
+
+import chatmaild.authcache
+import chatmaild.expire
+from chatmaild.authcache import AuthCacheFlusher
+from chatmaild.doveauth import AuthDictProxy
+from chatmaild.expire import daily_expire_main
+
+
+class FakeAuthMaster:
+    """Answer CACHE-FLUSH commands like the Dovecot auth-master socket."""
+
+    def __init__(self, path, reply="OK"):
+        self.path = str(path)
+        self.reply = reply
+        self.flushed = []
+        self.commands = 0
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen()
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with conn:
+                conn.sendall(b"VERSION\t1\t2\nSPID\t1234\n")
+                rfile = conn.makefile("r")
+                assert rfile.readline().startswith("VERSION\t1\t")
+                cmd, request_id, *users = rfile.readline().rstrip("\n").split("\t")
+                assert cmd == "CACHE-FLUSH"
+                self.commands += 1
+                self.flushed.extend(users)
+                conn.sendall(f"{self.reply}\t{request_id}\t{len(users)}\n".encode())
+
+    def wait_flushed(self, num, timeout=5):
+        deadline = time.time() + timeout
+        while len(self.flushed) < num:
+            assert time.time() < deadline, self.flushed
+            time.sleep(0.01)
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def auth_master(tmp_path, monkeypatch):
+    path = tmp_path / "auth-master"
+    monkeypatch.setattr(chatmaild.authcache, "AUTH_MASTER_SOCKET", str(path))
+    server = FakeAuthMaster(path)
+    yield server
+    server.close()
+
+
+def test_flush(auth_master):
+    flusher = AuthCacheFlusher()
+    assert flusher.flush(["a@chat.example.org", "b@chat.example.org"]) == 2
+    assert flusher.flush([]) == 0
+    assert auth_master.flushed == ["a@chat.example.org", "b@chat.example.org"]
+    assert auth_master.commands == 1
+
+
+def test_flush_failed(auth_master, caplog):
+    auth_master.reply = "FAIL"
+    flusher = AuthCacheFlusher()
+    with pytest.raises(ValueError):
+        flusher.flush(["a@chat.example.org"])
+    with pytest.raises(ValueError):
+        flusher.flush(["a\t@chat.example.org"])
+    assert flusher.flush_quietly(["a@chat.example.org"]) == 0
+    assert flusher.failed == 1
+    assert "could not flush auth cache" in caplog.text
+
+
+def test_flush_without_dovecot(tmp_path):
+    flusher = AuthCacheFlusher(str(tmp_path / "missing"))
+    with pytest.raises(FileNotFoundError):
+        flusher.flush(["a@chat.example.org"])
+    assert flusher.flush_quietly(["a@chat.example.org"]) == 0
+    assert flusher.failed == 0
+
+
+def test_flush_queued_batches(auth_master, monkeypatch):
+    monkeypatch.setattr(chatmaild.authcache, "FLUSH_BATCH_SIZE", 3)
+    flusher = AuthCacheFlusher()
+    addrs = [f"user{i}@chat.example.org" for i in range(7)]
+    for addr in addrs:
+        flusher.flush_later(addr)
+    flusher.flush_queued()
+    assert auth_master.flushed == addrs
+    assert auth_master.commands == 3
+
+
+def test_account_creation_flushes(auth_master, example_config):
+    dictproxy = AuthDictProxy(example_config)
+    dictproxy.auth_cache.start()
+    addr = "flushme12@chat.example.org"
+    assert dictproxy.lookup_passdb(addr, "q9mr3faue")
+    auth_master.wait_flushed(1)
+    assert auth_master.flushed == [addr]
+
+    # logins to existing accounts do not flush
+    assert dictproxy.lookup_passdb(addr, "q9mr3faue")
+    time.sleep(0.05)
+    assert auth_master.flushed == [addr]
+
+
+def test_auth_cache_disabled(make_config):
+    config = make_config("chat.example.org", {"auth_cache_ttl": "0"})
+    assert AuthDictProxy(config).auth_cache is None
+
+
+def test_expire_flushes_removed_mailboxes(auth_master, example_config):
+    dictproxy = AuthDictProxy(example_config)
+    old = time.time() - (example_config.delete_inactive_users_after + 1) * 86400
+    addrs = ["oldold001@chat.example.org", "oldold002@chat.example.org"]
+    for addr in addrs + ["newnew001@chat.example.org"]:
+        assert dictproxy.lookup_passdb(addr, "q9mr3faue")
+    for addr in addrs:
+        example_config.get_user(addr).set_last_login_timestamp(old)
+
+    # a dry run removes nothing and flushes nothing
+    daily_expire_main([str(example_config._inipath)])
+    assert auth_master.flushed == []
+
+    daily_expire_main(["--remove", str(example_config._inipath)])
+    assert sorted(auth_master.flushed) == addrs
+    assert auth_master.commands == 1
+
+
+def test_expire_flushes_in_batches(auth_master, example_config, monkeypatch):
+    monkeypatch.setattr(chatmaild.expire, "FLUSH_BATCH_SIZE", 2)
+    dictproxy = AuthDictProxy(example_config)
+    old = time.time() - (example_config.delete_inactive_users_after + 1) * 86400
+    addrs = [f"oldold{i:03}@chat.example.org" for i in range(5)]
+    for addr in addrs:
+        assert dictproxy.lookup_passdb(addr, "q9mr3faue")
+        example_config.get_user(addr).set_last_login_timestamp(old)
+
+    daily_expire_main(["--remove", str(example_config._inipath)])
+    assert sorted(auth_master.flushed) == addrs
+    assert auth_master.commands == 3
@@ -0,0 +1,68 @@
+import os
+import threading
+
+from chatmaild.authstorm import AuthStorm, FsOpCounter, run_storm, storm_main
+from chatmaild.dictreplay import percentile
+
+# regression gate of the small storm below,
+# one account creation currently needs 8 filesystem operations
+MAX_FS_OPS_PER_CREATION = 10
+MAX_LOGIN_P99 = 0.1
+
+
+def test_fs_op_counter(tmp_path):
+    path = tmp_path.joinpath("file")
+    with FsOpCounter() as counter:
+        path.write_text("hello")
+        os.stat(path)
+        path.unlink()
+        # operations of other threads are not counted
+        thread = threading.Thread(target=os.stat, args=(tmp_path,))
+        thread.start()
+        thread.join()
+    assert counter.counts == {"open": 1, "stat": 1, "unlink": 1}
+    os.stat(tmp_path)
+    assert sum(counter.counts.values()) == 3
+
+
+def test_new_address(make_config):
+    config = make_config("chat.example.org", {"username_max_length": "12"})
+    storm = AuthStorm(config)
+    addrs = {storm.new_address() for _ in range(100)}
+    assert len(addrs) == 100
+    for addr in addrs:
+        localpart, domain = addr.split("@")
+        assert len(localpart) == 12 and domain == "chat.example.org"
+
+
+def test_storm_regression(make_config, tmp_path):
+    config = make_config("chat.example.org", {"dictproxy_creations_per_second": "0"})
+    tmp_path.joinpath("storm").mkdir()
+    stats = run_storm(config, tmp_path / "storm", clients=4, duration=1, existing=20)
+
+    assert stats.errors == 0
+    assert stats.rejected == 0
+    assert stats.fs_ops_per_creation <= MAX_FS_OPS_PER_CREATION, stats.fs_ops
+    assert stats.created > 0
+    assert len(stats.creation_latencies) == stats.created
+    assert stats.login_latencies
+    assert percentile(sorted(stats.login_latencies), 0.99) < MAX_LOGIN_P99
+    created = list(config.mailboxes_dir.iterdir())
+    assert len(created) == 20 + 10 + stats.created
+
+
+def test_storm_main_budget(example_config, capsys):
+    storm_main(
+        [
+            str(example_config._inipath),
+            "--clients=2",
+            "--duration=0.5",
+            "--existing=10",
+            "--creations-per-second=20",
+        ]
+    )
+    out, err = capsys.readouterr()
+    created = int(out.split()[0])
+    # the budget allows a burst of one second of creations
+    assert 0 < created <= 20 + 20 * 0.5 + 1
+    assert "filesystem operations per creation" in out
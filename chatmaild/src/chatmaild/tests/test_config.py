@@ -1,5 +1,6 @@
 import pytest
 
+import chatmaild.config
 from chatmaild.config import (
     is_valid_ipv4,
     parse_size_mb,
@@ -45,9 +46,44 @@ def test_read_config_basic_using_defaults(tmp_path, maildomain):
     assert example_config.username_min_length == 9
     assert example_config.username_max_length == 9
     assert example_config.password_min_length == 9
+    assert example_config.dictproxy_engine == "threads"
+    assert example_config.dictproxy_max_threads == 32
+    assert example_config.dictproxy_layout == "separate"
+    assert example_config.dictproxy_queue_budget == 0.5
+    assert example_config.dictproxy_slow_request == 1.0
+    assert example_config.dictproxy_userdb_cache_size == 10000
+    assert example_config.dictproxy_address_filter is True
+    assert example_config.auth_cache_ttl == 3600
+    assert example_config.auth_cache_negative_ttl == 300
     assert example_config._unused_keys == []
 
 
+def test_config_password_scheme(make_config):
+    config = make_config("chat.example.org")
+    assert (config.password_scheme, config.password_rounds) == ("SHA512-CRYPT", 0)
+    config = make_config(
+        "chat.example.org", {"password_scheme": "BLF-CRYPT", "password_rounds": "10"}
+    )
+    assert (config.password_scheme, config.password_rounds) == ("BLF-CRYPT", 10)
+    with pytest.raises(ValueError):
+        make_config("chat.example.org", {"password_scheme": "PLAIN"})
+
+
+def test_config_invalid_dictproxy_layout(make_config):
+    with pytest.raises(ValueError):
+        make_config("chat.example.org", {"dictproxy_layout": "xyz"})
+
+
+def test_get_user_cached(example_config, monkeypatch):
+    monkeypatch.setattr(chatmaild.config, "USER_CACHE_SIZE", 2)
+    user = example_config.get_user("user1@chat.example.org")
+    assert example_config.get_user("user1@chat.example.org") is user
+    example_config.get_user("user2@chat.example.org")
+    example_config.get_user("user3@chat.example.org")
+    assert example_config.get_user("user1@chat.example.org") is not user
+    assert len(example_config._users) == 2
+
+
 def test_config_unused_keys(make_config):
     config = make_config("chat.example.org", {"passthrough_senders": "x@y.org"})
     assert config._unused_keys == ["passthrough_senders"]
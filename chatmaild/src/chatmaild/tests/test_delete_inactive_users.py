@@ -19,6 +19,8 @@ def test_delete_inactive_users(example_config):
     new = time.time()
     old = new - (example_config.delete_inactive_users_after * 86400) - 1
     dictproxy = AuthDictProxy(example_config)
+    # create accounts faster than the creation budget allows
+    dictproxy.hasher.creations_per_second = 0
 
     def create_user(addr, last_login):
         dictproxy.lookup_passdb(addr, "q9mr3faue")
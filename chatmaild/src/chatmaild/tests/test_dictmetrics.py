@@ -0,0 +1,147 @@
+import io
+
+from chatmaild.dictmetrics import DictProxyMetrics
+from chatmaild.doveauth import AuthDictProxy
+from chatmaild.lastlogin import LastLoginDictProxy
+
+
+def parse_textfile(content):
+    samples = {}
+    for line in content.splitlines():
+        if not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+
+def test_metrics_disabled_by_default(example_config):
+    dictproxy = AuthDictProxy(config=example_config)
+    assert dictproxy.metrics is None
+    assert example_config.dictproxy_metrics_dir is None
+
+
+def test_lookup_metrics(example_config, testaddr):
+    dictproxy = AuthDictProxy(config=example_config)
+    dictproxy.metrics = DictProxyMetrics(dictproxy.name)
+    rfile = io.BytesIO(
+        f"H3\t2\t0\t\tauth\n"
+        f'Lshared/passdb/q9mr3faue1"{testaddr}\t{testaddr}\n'
+        f"Lshared/userdb/{testaddr}\t{testaddr}\n"
+        f"Lshared/other/{testaddr}\t{testaddr}\n".encode()
+    )
+    dictproxy.loop_forever(rfile, io.BytesIO())
+
+    samples = parse_textfile(dictproxy.metrics.get_textfile_content())
+    labels = 'proxy="doveauth",command="lookup"'
+    assert samples[f"chatmail_dictproxy_requests_total{{{labels}}}"] == 3
+    assert samples[f"chatmail_dictproxy_errors_total{{{labels}}}"] == 1
+    assert (
+        samples[f"chatmail_dictproxy_request_duration_seconds_count{{{labels}}}"] == 3
+    )
+    inf_bucket = (
+        f'chatmail_dictproxy_request_duration_seconds_bucket{{{labels},le="+Inf"}}'
+    )
+    assert samples[inf_bucket] == 3
+    hello = 'proxy="doveauth",command="hello"'
+    assert samples[f"chatmail_dictproxy_requests_total{{{hello}}}"] == 1
+    assert samples['chatmail_dictproxy_connections{proxy="doveauth"}'] == 0
+
+
+def test_transaction_metrics(example_config, testaddr):
+    AuthDictProxy(config=example_config).lookup_passdb(testaddr, "q9mr3faue1")
+    dictproxy = LastLoginDictProxy(config=example_config)
+    metrics = dictproxy.metrics = DictProxyMetrics(dictproxy.name)
+    transactions = {}
+    dictproxy.handle_dovecot_request(f"B1\t{testaddr}", transactions)
+    dictproxy.handle_dovecot_request(f"B2\t{testaddr}", transactions)
+    assert metrics.transactions == 2
+    dictproxy.handle_dovecot_request(
+        f"S1\tshared/last-login/{testaddr}\t1000000", transactions
+    )
+    dictproxy.handle_dovecot_request(f"S1\tshared/unknown/{testaddr}\t1", transactions)
+    dictproxy.handle_dovecot_request(f"S1\tshared/unknown/{testaddr}\t1", transactions)
+    assert dictproxy.handle_dovecot_request("C1", transactions) == "F\n"
+    assert metrics.transactions == 1
+    assert metrics.commands["set"].count == 3
+    assert metrics.commands["set"].errors == 1
+    assert metrics.commands["commit"].errors == 1
+
+
+def test_connection_closed_with_open_transaction(example_config, testaddr):
+    dictproxy = LastLoginDictProxy(config=example_config)
+    metrics = dictproxy.metrics = DictProxyMetrics(dictproxy.name)
+    dictproxy.loop_forever(io.BytesIO(f"B1\t{testaddr}\n".encode()), io.BytesIO())
+    assert metrics.transactions == 0
+    assert metrics.connections == 0
+
+
+def test_dump_textfile(tmp_path):
+    metrics = DictProxyMetrics("metadata")
+    metrics.observe("L", 0.002)
+    metrics.observe("L", 7.0)
+    path = tmp_path.joinpath("chatmail-metadata.prom")
+    metrics.dump_textfile(path)
+    assert path.stat().st_mode & 0o777 == 0o644
+    samples = parse_textfile(path.read_text())
+    labels = 'proxy="metadata",command="lookup"'
+    bucket = "chatmail_dictproxy_request_duration_seconds_bucket"
+    assert samples[f'{bucket}{{{labels},le="0.001"}}'] == 0
+    assert samples[f'{bucket}{{{labels},le="0.0025"}}'] == 1
+    assert samples[f'{bucket}{{{labels},le="5.0"}}'] == 1
+    assert samples[f'{bucket}{{{labels},le="+Inf"}}'] == 2
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_metrics_overhead(microbench, example_config, testaddr):
+    dictproxy = AuthDictProxy(config=example_config)
+    dictproxy.lookup_passdb(testaddr, "q9mr3faue1")
+    msg = f"Lshared/userdb/{testaddr}\t{testaddr}".encode()
+
+    def lookup():
+        dictproxy.handle_dovecot_request(msg, {})
+
+    microbench(lookup, 2000, name="userdb-lookup-metrics-disabled")
+    dictproxy.metrics = DictProxyMetrics(dictproxy.name)
+    microbench(lookup, 2000, name="userdb-lookup-metrics-enabled")
+
+
+def test_worker_textfile(tmp_path):
+    metrics = DictProxyMetrics("doveauth", textfile_dir=tmp_path, worker=2)
+    metrics.observe("L", 0.001)
+    path = metrics.get_textfile_path()
+    assert path == tmp_path.joinpath("chatmail-doveauth-2.prom")
+    metrics.dump_textfile(path)
+    samples = parse_textfile(path.read_text())
+    labels = 'proxy="doveauth",worker="2",command="lookup"'
+    assert samples[f"chatmail_dictproxy_requests_total{{{labels}}}"] == 1
+
+
+def test_userdb_cache_metrics(example_config, testaddr):
+    dictproxy = AuthDictProxy(config=example_config)
+    dictproxy.lookup_passdb(testaddr, "q9mr3faue1")
+    dictproxy.metrics = DictProxyMetrics(dictproxy.name)
+    dictproxy.lookup_userdb(testaddr)
+    dictproxy.lookup_userdb(testaddr)
+    dictproxy.lookup_userdb("unknown12@chat.example.org")
+
+    samples = parse_textfile(dictproxy.metrics.get_textfile_content())
+    proxy = 'proxy="doveauth"'
+    assert samples[f"chatmail_dictproxy_userdb_cache_hits_total{{{proxy}}}"] == 2
+    assert samples[f"chatmail_dictproxy_userdb_cache_misses_total{{{proxy}}}"] == 1
+
+
+def test_iterate_metrics(make_config, tmp_path, testaddr):
+    config = make_config(
+        "chat.example.org",
+        {"dictproxy_metrics_dir": str(tmp_path), "dictproxy_slow_request_ms": "1000"},
+    )
+    AuthDictProxy(config=config).lookup_passdb(testaddr, "q9mr3faue1")
+    dictproxy = AuthDictProxy(config=config)
+    dictproxy.init_metrics(config)
+    dictproxy.init_watchdog(config)
+    assert dictproxy.metrics is not None and dictproxy.watchdog is not None
+    wfile = io.BytesIO()
+    dictproxy.loop_forever(io.BytesIO(b"I0\t0\tshared/userdb/\n"), wfile)
+    assert wfile.getvalue() == f"Oshared/userdb/{testaddr}\t\n\n".encode()
+    assert dictproxy.metrics.commands["iterate"].count == 1
+    assert dictproxy.metrics.commands["iterate"].errors == 0
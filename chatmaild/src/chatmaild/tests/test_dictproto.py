@@ -0,0 +1,110 @@
+import pytest
+
+from chatmaild.dictproto import parse_key, parse_request, split_and_unescape
+
+PASSDB_LINE = (
+    b'Lshared/passdb/laksjdlaksjdlak\\\\sjdlk\\"12j\\\'3l1/k2j3123"'
+    b"some42123@chat.example.org\tsome42123@chat.example.org"
+)
+PASSDB_PLAIN_LINE = (
+    b'Lshared/passdb/q9mr3faue1kd"some42123@chat.example.org'
+    b"\tsome42123@chat.example.org"
+)
+USERDB_LINE = b"Lshared/userdb/some42123@chat.example.org\tsome42123@chat.example.org"
+METADATA_LINE = (
+    b"S1\tpriv/43f5f508a7ea0366dff30200c15250e3/devicetoken\t"
+    b"e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855"
+)
+LASTLOGIN_LINE = b"S1\tshared/last-login/some42123@chat.example.org\t1747000000"
+
+
+def legacy_split_and_unescape(s):
+    # character by character implementation used before the dictproto module
+    out = ""
+    i = 0
+    while i < len(s):
+        c = s[i]
+        if c == "\\":
+            i += 1
+            out += s[i]
+        elif c == '"':
+            yield out
+            out = ""
+        else:
+            out += c
+        i += 1
+    yield out
+
+
+def legacy_parse(line):
+    msg = line.strip().decode()
+    command, parts = msg[0], msg[1:].split("\t")
+    if command == "L":
+        namespace, type, args = parts[0].split("/", 2)
+        return command, parts, list(legacy_split_and_unescape(args))
+    return command, parts, parts[1].split("/")
+
+
+def new_parse(line):
+    # as DictProxy.handle_dovecot_request, which inlines parse_request
+    msg = line.strip().decode()
+    command, parts = msg[0], msg[1:].split("\t")
+    if command == "L":
+        return command, parts, parse_key(parts[0])[2]
+    return command, parts, parts[1].split("/")
+
+
+def test_parse_request():
+    assert parse_request(b"C1") == ("C", ["1"])
+    assert parse_request(b"B1\tuser@example.org") == ("B", ["1", "user@example.org"])
+    command, parts = parse_request(memoryview(METADATA_LINE))
+    assert command == "S"
+    assert parts[1] == "priv/43f5f508a7ea0366dff30200c15250e3/devicetoken"
+    assert parse_request("Iä\tx".encode()) == ("I", ["ä", "x"])
+
+
+def test_parse_key():
+    namespace, type, args = parse_key('shared/passdb/pass\\/word"u@example.org')
+    assert (namespace, type) == ("shared", "passdb")
+    assert args == ["pass/word", "u@example.org"]
+    with pytest.raises(ValueError):
+        parse_key("shared")
+
+
+@pytest.mark.parametrize(
+    "s",
+    [
+        "",
+        "abc",
+        'a"b"c',
+        '"',
+        '\\""',
+        'laksjdlaksjdlak\\\\sjdlk\\"12j\\\'3l1/k2j3123"some42123@chat.example.org',
+        '\\\\\\\\"\\"',
+        'ä\\ö"ü',
+    ],
+)
+def test_split_and_unescape_matches_legacy(s):
+    assert split_and_unescape(s) == list(legacy_split_and_unescape(s))
+
+
+def test_split_and_unescape_dangling_escape():
+    with pytest.raises(ValueError):
+        split_and_unescape('abc"def\\')
+
+
+@pytest.mark.parametrize(
+    "name,line",
+    [
+        ("passdb", PASSDB_LINE),
+        ("passdb-plain", PASSDB_PLAIN_LINE),
+        ("userdb", USERDB_LINE),
+        ("metadata", METADATA_LINE),
+        ("lastlogin", LASTLOGIN_LINE),
+    ],
+)
+def test_bench_parse(microbench, name, line):
+    assert new_parse(line) == legacy_parse(line)
+    legacy = microbench(lambda: legacy_parse(line), 20000, name=f"legacy-parse-{name}")
+    new = microbench(lambda: new_parse(line), 20000, name=f"dictproto-parse-{name}")
+    print(f"{name}: legacy {legacy * 1e6:.2f}us dictproto {new * 1e6:.2f}us")
@@ -0,0 +1,715 @@
+import asyncio
+import io
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import chatmaild.dictproxy
+import chatmaild.doveauth
+from chatmaild.combined import serve_combined
+from chatmaild.dictmetrics import DictProxyMetrics
+from chatmaild.dictproxy import (
+    PRIORITY_HIGH,
+    PRIORITY_LOW,
+    PRIORITY_NORMAL,
+    DictProxy,
+    RequestPool,
+    SingleFlight,
+    get_inherited_listeners,
+)
+from chatmaild.doveauth import AuthDictProxy
+from chatmaild.lastlogin import LastLoginDictProxy
+from chatmaild.metadata import Metadata, MetadataDictProxy
+from chatmaild.notifier import Notifier
+from chatmaild.user import User
+
+
+@pytest.fixture
+def serve(tmp_path):
+    """Serve a dictproxy from a background thread and return its socket path."""
+
+    def serve(dictproxy, **kwargs):
+        path = str(tmp_path.joinpath(f"dict{next(counter)}.socket"))
+        thread = threading.Thread(
+            target=dictproxy.serve_forever_from_socket,
+            args=(path,),
+            kwargs=kwargs,
+            daemon=True,
+        )
+        thread.start()
+        for _ in range(100):
+            try:
+                with connect(path):
+                    return path
+            except (FileNotFoundError, ConnectionRefusedError):
+                time.sleep(0.05)
+        pytest.fail(f"dictproxy did not start listening on {path}")
+
+    counter = iter(range(1000))
+    return serve
+
+
+def connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(10)
+    sock.connect(path)
+    return sock
+
+
+def roundtrip(path, *lines, numreplies=None):
+    """Send dict protocol lines and read one reply line per request."""
+    if numreplies is None:
+        numreplies = len([x for x in lines if x[0] not in "HBS"])
+    with connect(path) as sock:
+        sock.sendall("".join(f"{line}\n" for line in lines).encode())
+        with sock.makefile("rb") as rfile:
+            return [rfile.readline().decode() for _ in range(numreplies)]
+
+
+def test_unknown_engine(tmp_path):
+    with pytest.raises(ValueError):
+        DictProxy().serve_forever_from_socket(str(tmp_path / "x"), engine="xyz")
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_auth_lookups(serve, engine, example_config):
+    path = serve(AuthDictProxy(config=example_config), engine=engine)
+    addr = "someuser1@chat.example.org"
+    replies = roundtrip(
+        path,
+        "H3\t2\t0\t\tauth",
+        f"Lshared/userdb/{addr}\t{addr}",
+        f'Lshared/passdb/q9mr3faue1"{addr}\t{addr}',
+        f"Lshared/userdb/{addr}\t{addr}",
+    )
+    assert replies[0] == "N\n"
+    assert replies[1][0] == "O" and addr in replies[1]
+    assert replies[2] == replies[1]
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_lastlogin_transaction(serve, engine, example_config, testaddr):
+    AuthDictProxy(config=example_config).lookup_passdb(testaddr, "q9mr3faue1")
+    path = serve(LastLoginDictProxy(config=example_config), engine=engine)
+    replies = roundtrip(
+        path,
+        f"B1\t{testaddr}",
+        f"S1\tshared/last-login/{testaddr}\t172800",
+        "C1",
+    )
+    assert replies == ["O\n"]
+    user = example_config.get_user(testaddr)
+    assert user.get_last_login_timestamp() == 172800
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_metadata_devicetoken(serve, engine, tmp_path, testaddr):
+    vmail_dir = tmp_path.joinpath("vmail")
+    vmail_dir.joinpath("pending").mkdir(parents=True)
+    metadata = Metadata(vmail_dir)
+    dictproxy = MetadataDictProxy(
+        notifier=Notifier(vmail_dir / "pending"), metadata=metadata
+    )
+    path = serve(dictproxy, engine=engine)
+    key = "priv/43f5f508a7ea0366dff30200c15250e3/devicetoken"
+    replies = roundtrip(
+        path,
+        f"B1\t{testaddr}",
+        f"S1\t{key}\t01234",
+        "C1",
+        f"L{key}\t{testaddr}",
+    )
+    assert replies == ["O\n", "O01234\n"]
+
+
+def test_asyncio_many_idle_connections(serve, example_config):
+    path = serve(AuthDictProxy(config=example_config), engine="asyncio")
+    threads_before = threading.active_count()
+    idle = [connect(path) for _ in range(200)]
+    try:
+        # idle connections don't cost a thread each
+        assert threading.active_count() < threads_before + 10
+        addr = "someuser2@chat.example.org"
+        reply = roundtrip(path, f'Lshared/passdb/q9mr3faue1"{addr}\t{addr}')
+        assert reply[0][0] == "O"
+    finally:
+        for sock in idle:
+            sock.close()
+
+
+class CountingWriter(io.BytesIO):
+    """Writer counting write calls, each of which is a send syscall on sockets."""
+
+    numwrites = 0
+
+    def write(self, data):
+        self.numwrites += 1
+        return super().write(data)
+
+
+@pytest.mark.parametrize("pipelining", [True, False])
+def test_loop_forever_modes_same_replies(example_config, pipelining):
+    dictproxy = AuthDictProxy(config=example_config)
+    dictproxy.pipelining = pipelining
+    lines = [f"Lshared/userdb/user{i}@chat.example.org\t" for i in range(3)]
+    # last line is not terminated, it is handled at end of input
+    rfile = io.BytesIO("\n".join(["H3\t2\t0\t\tauth", *lines]).encode())
+    wfile = CountingWriter()
+    dictproxy.loop_forever(rfile, wfile)
+    assert wfile.getvalue() == b"N\n" * 3
+
+
+def test_loop_forever_stops_at_empty_line(example_config):
+    dictproxy = AuthDictProxy(config=example_config)
+    rfile = io.BytesIO(b"Lshared/userdb/a@chat.example.org\n\nLshared/userdb/x\n")
+    wfile = CountingWriter()
+    dictproxy.loop_forever(rfile, wfile)
+    assert wfile.getvalue() == b"N\n"
+
+
+def test_pipelining_coalesces_writes(example_config, testaddr):
+    dictproxy = AuthDictProxy(config=example_config)
+    dictproxy.lookup_passdb(testaddr, "q9mr3faue1")
+    num = 500
+    data = f"Lshared/userdb/{testaddr}\t{testaddr}\n".encode() * num
+
+    results = {}
+    for pipelining in (False, True):
+        dictproxy.pipelining = pipelining
+        wfile = CountingWriter()
+        start = time.perf_counter()
+        dictproxy.loop_forever(io.BufferedReader(io.BytesIO(data)), wfile)
+        duration = time.perf_counter() - start
+        assert wfile.getvalue().count(b"\n") == num
+        results[pipelining] = wfile.numwrites
+        print(
+            f"pipelining={pipelining}: {num / duration:.0f} commands/s, "
+            f"{wfile.numwrites / num:.3f} writes per command"
+        )
+
+    assert results[False] == num
+    assert results[True] == 1
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_pipelined_socket_roundtrip(serve, engine, example_config):
+    path = serve(AuthDictProxy(config=example_config), engine=engine)
+    addrs = [f"pipe{i:05}@chat.example.org" for i in range(50)]
+    lines = [f'Lshared/passdb/q9mr3faue1"{addr}\t{addr}' for addr in addrs]
+    replies = roundtrip(path, *lines)
+    for addr, reply in zip(addrs, replies):
+        assert reply[0] == "O" and addr in reply
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_streamed_iterate_socket_roundtrip(serve, engine, example_config, monkeypatch):
+    monkeypatch.setattr(chatmaild.doveauth, "ITERATE_CHUNK_SIZE", 7)
+    for i in range(30):
+        example_config.mailboxes_dir.joinpath(f"iter{i:05}@chat.example.org").mkdir()
+    path = serve(AuthDictProxy(config=example_config), engine=engine)
+    addr = "iter00000@chat.example.org"
+    replies = roundtrip(
+        path,
+        "I0\t0\tshared/userdb/",
+        f"Lshared/userdb/{addr}\t{addr}",
+        "I0\t0\tshared/userdb/",
+        numreplies=63,
+    )
+    assert len([x for x in replies[:30] if x.startswith("Oshared/userdb/")]) == 30
+    assert replies[30:32] == ["\n", "N\n"]
+    assert replies[32:62] == replies[:30]
+    assert replies[62] == "\n"
+
+
+def get_child_pids(pid):
+    children = []
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                stat = open(f"/proc/{entry}/stat").read()
+            except OSError:
+                continue
+            # the ppid is the second field after the parenthesized command name
+            if int(stat.rsplit(")", 1)[1].split()[1]) == pid:
+                children.append(int(entry))
+    return children
+
+
+def wait_for(func, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        res = func()
+        if res:
+            return res
+        time.sleep(0.05)
+    pytest.fail(f"timed out waiting for {func}")
+
+
+@pytest.fixture
+def prefork_doveauth(tmp_path, example_config):
+    path = str(tmp_path.joinpath("prefork.socket"))
+    code = (
+        "import sys\n"
+        "from chatmaild.config import read_config\n"
+        "from chatmaild.doveauth import AuthDictProxy\n"
+        "config = read_config(sys.argv[1])\n"
+        "AuthDictProxy(config=config).serve_forever_from_socket(\n"
+        "    sys.argv[2], engine=sys.argv[3], workers=3)\n"
+    )
+
+    procs = []
+
+    def start(engine):
+        proc = subprocess.Popen(
+            [sys.executable, "-c", code, str(example_config._inipath), path, engine]
+        )
+        procs.append(proc)
+        wait_for(lambda: len(get_child_pids(proc.pid)) == 3)
+        wait_for(lambda: os.path.exists(path))
+        return proc, path
+
+    yield start
+
+    for proc in procs:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_prefork_restarts_workers(prefork_doveauth, engine):
+    proc, path = prefork_doveauth(engine)
+    workers = get_child_pids(proc.pid)
+    os.kill(workers[0], signal.SIGKILL)
+    wait_for(lambda: len(set(get_child_pids(proc.pid)) - set(workers)) == 1)
+    assert len(get_child_pids(proc.pid)) == 3
+
+    addr = "prefork01@chat.example.org"
+    reply = roundtrip(path, f'Lshared/passdb/q9mr3faue1"{addr}\t{addr}')
+    assert reply[0][0] == "O"
+
+    proc.terminate()
+    proc.wait(timeout=10)
+    wait_for(lambda: not get_child_pids(proc.pid))
+    assert all(not os.path.exists(f"/proc/{pid}") for pid in workers[1:])
+
+
+def test_prefork_concurrent_creation_same_account(prefork_doveauth, example_config):
+    proc, path = prefork_doveauth("threads")
+    addr = "prefork02@chat.example.org"
+    request = f'Lshared/passdb/q9mr3faue1"{addr}\t{addr}'
+    # many connections get spread over the worker processes
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.extend(roundtrip(path, request)))
+        for _ in range(30)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 30
+    assert len(set(results)) == 1
+    password = example_config.get_user(addr).password_path.read_text()
+    assert password in results[0]
+
+
+class SlowDictProxy(DictProxy):
+    def handle_lookup(self, parts):
+        time.sleep(0.1)
+        return f"O{parts[0]}\n"
+
+
+def test_asyncio_pool_backpressure(serve):
+    dictproxy = SlowDictProxy()
+    dictproxy.metrics = DictProxyMetrics(dictproxy.name)
+    path = serve(dictproxy, engine="asyncio", max_threads=2, max_queue=4)
+    threads_before = threading.active_count()
+
+    results = {}
+
+    def lookup(i):
+        results[i] = roundtrip(path, f"Lkey{i}")
+
+    clients = [threading.Thread(target=lookup, args=(i,)) for i in range(12)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+
+    # all requests were served, in order of the queue
+    assert results == {i: [f"Okey{i}\n"] for i in range(12)}
+    wait_for(lambda: dictproxy.metrics.queue_depth == 0)
+    assert dictproxy.metrics.queue_depth_max > 2
+    # but only two pool threads were ever started
+    assert threading.active_count() <= threads_before + 2
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_combined_serves_all_sockets(tmp_path, make_config, engine):
+    testaddr = f"combined{len(engine)}@chat.example.org"
+    config = make_config("chat.example.org", {"dictproxy_engine": engine})
+    sockets = [str(tmp_path.joinpath(f"{name}.socket")) for name in ("a", "m", "l")]
+    thread = threading.Thread(
+        target=serve_combined, args=(config, *sockets), daemon=True
+    )
+    thread.start()
+    wait_for(lambda: all(os.path.exists(path) for path in sockets))
+    auth_socket, metadata_socket, lastlogin_socket = sockets
+
+    reply = roundtrip(auth_socket, f'Lshared/passdb/q9mr3faue1"{testaddr}\t{testaddr}')
+    assert reply[0][0] == "O"
+    key = "priv/43f5f508a7ea0366dff30200c15250e3/devicetoken"
+    replies = roundtrip(
+        metadata_socket,
+        f"B1\t{testaddr}",
+        f"S1\t{key}\t01234",
+        "C1",
+        f"L{key}\t{testaddr}",
+    )
+    assert replies == ["O\n", "O01234\n"]
+    replies = roundtrip(
+        lastlogin_socket,
+        f"B1\t{testaddr}",
+        f"S1\tshared/last-login/{testaddr}\t172800",
+        "C1",
+    )
+    assert replies == ["O\n"]
+    assert config.get_user(testaddr).get_last_login_timestamp() == 172800
+
+
+def test_async_commit(example_config, testaddr):
+    dictproxy = LastLoginDictProxy(config=example_config)
+    AuthDictProxy(config=example_config).lookup_passdb(testaddr, "q9mr3faue1")
+    transactions = {}
+    for line in (
+        f"B7\t{testaddr}",
+        "T7\t172800\t0",
+        "V7",
+        f"S7\tshared/last-login/{testaddr}\t172800",
+    ):
+        assert dictproxy.handle_dovecot_request(line, transactions) is None
+    assert dictproxy.handle_dovecot_request("D7", transactions) == "AO7\n"
+    assert not transactions
+    assert example_config.get_user(testaddr).get_last_login_timestamp() == 172800
+
+    dictproxy.handle_dovecot_request(f"B8\t{testaddr}", transactions)
+    dictproxy.handle_dovecot_request("S8\tshared/unknown/x\t1", transactions)
+    assert dictproxy.handle_dovecot_request("D8", transactions) == "AF8\n"
+
+
+def test_rollback_and_unknown_transactions(example_config, testaddr):
+    dictproxy = LastLoginDictProxy(config=example_config)
+    transactions = {}
+    dictproxy.handle_dovecot_request(f"B1\t{testaddr}", transactions)
+    assert dictproxy.handle_dovecot_request("R1", transactions) is None
+    assert not transactions
+    # writes and commits of unknown transactions don't raise
+    assert dictproxy.handle_dovecot_request("S1\tshared/x/y\t1", transactions) is None
+    assert dictproxy.handle_dovecot_request("C1", transactions) == "F\n"
+    assert dictproxy.handle_dovecot_request("D1", transactions) == "AF1\n"
+
+
+def test_unset_and_atomic_inc_fail_by_default(example_config, testaddr):
+    dictproxy = LastLoginDictProxy(config=example_config)
+    transactions = {}
+    for command in ("U1\tshared/last-login/x", "A1\tshared/counter/x\t1"):
+        dictproxy.handle_dovecot_request(f"B1\t{testaddr}", transactions)
+        dictproxy.handle_dovecot_request(command, transactions)
+        assert dictproxy.handle_dovecot_request("C1", transactions) == "F\n"
+
+
+def test_metadata_unset_devicetoken(tmp_path, testaddr):
+    queue_dir = tmp_path.joinpath("pending")
+    queue_dir.mkdir()
+    metadata = Metadata(tmp_path)
+    tmp_path.joinpath(testaddr).mkdir()
+    metadata.add_token_to_addr(testaddr, "01234")
+    metadata.add_token_to_addr(testaddr, "56789")
+    dictproxy = MetadataDictProxy(notifier=Notifier(queue_dir), metadata=metadata)
+    transactions = {}
+    key = "priv/43f5f508a7ea0366dff30200c15250e3/devicetoken"
+    dictproxy.handle_dovecot_request(f"B1\t{testaddr}", transactions)
+    dictproxy.handle_dovecot_request(f"U1\t{key}", transactions)
+    assert dictproxy.handle_dovecot_request("C1", transactions) == "O\n"
+    assert metadata.get_tokens_for_addr(testaddr) == []
+
+
+def test_open_transactions_dropped_on_close(example_config, testaddr):
+    rolled_back = []
+
+    class RecordingDictProxy(LastLoginDictProxy):
+        def handle_rollback_transaction(self, transaction_id, parts, transactions):
+            rolled_back.append(transaction_id)
+            super().handle_rollback_transaction(transaction_id, parts, transactions)
+
+    dictproxy = RecordingDictProxy(config=example_config)
+    dictproxy.metrics = DictProxyMetrics(dictproxy.name)
+    rfile = io.BytesIO(f"B1\t{testaddr}\nB2\t{testaddr}\nC1\n".encode())
+    dictproxy.loop_forever(rfile, CountingWriter())
+    assert rolled_back == ["2"]
+    assert dictproxy.metrics.transactions == 0
+
+
+SOCKET_ACTIVATED_DOVEAUTH = """
+import os, sys
+from chatmaild.config import read_config
+from chatmaild.doveauth import AuthDictProxy
+os.dup2(int(sys.argv[3]), 3)
+os.environ["LISTEN_FDS"] = "1"
+os.environ["LISTEN_PID"] = str(os.getpid())
+config = read_config(sys.argv[1])
+AuthDictProxy(config=config).serve_forever_from_socket(sys.argv[2])
+"""
+
+
+def test_get_inherited_listeners(tmp_path, monkeypatch):
+    path = str(tmp_path.joinpath("inherited.socket"))
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen()
+    fd = listener.detach()
+    # lower file descriptors are in use by pytest
+    monkeypatch.setattr(chatmaild.dictproxy, "SD_LISTEN_FDS_START", fd)
+    monkeypatch.setenv("LISTEN_FDS", "1")
+    monkeypatch.setenv("LISTEN_PID", "1")
+    assert get_inherited_listeners() == {}
+
+    monkeypatch.setenv("LISTEN_PID", str(os.getpid()))
+    listeners = get_inherited_listeners()
+    assert list(listeners) == [path]
+    assert "LISTEN_FDS" not in os.environ
+    assert listeners[path].fileno() == fd
+    listeners[path].close()
+
+
+def test_restart_with_inherited_socket_under_load(tmp_path, example_config):
+    path = str(tmp_path.joinpath("activated.socket"))
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1000)
+
+    def start_proxy():
+        return subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                SOCKET_ACTIVATED_DOVEAUTH,
+                str(example_config._inipath),
+                path,
+                str(listener.fileno()),
+            ],
+            pass_fds=[listener.fileno()],
+        )
+
+    proc = start_proxy()
+    stop = threading.Event()
+    results = dict(ok=0, connect_failed=0, aborted=0)
+
+    def load(i):
+        addr = f"restart{i:02}@chat.example.org"
+        request = f'Lshared/passdb/q9mr3faue1"{addr}\t{addr}'
+        while not stop.is_set():
+            try:
+                sock = connect(path)
+            except OSError:
+                results["connect_failed"] += 1
+                continue
+            try:
+                with sock:
+                    sock.sendall(f"{request}\n".encode())
+                    with sock.makefile("rb") as rfile:
+                        reply = rfile.readline()
+            except OSError:
+                reply = b""
+            if reply.startswith(b"O"):
+                results["ok"] += 1
+            else:
+                # the request was accepted by the terminated process
+                results["aborted"] += 1
+
+    clients = [threading.Thread(target=load, args=(i,)) for i in range(10)]
+    try:
+        for thread in clients:
+            thread.start()
+        wait_for(lambda: results["ok"] > 100)
+        for _ in range(3):
+            proc.terminate()
+            proc.wait(timeout=10)
+            proc = start_proxy()
+            ok = results["ok"]
+            wait_for(lambda: results["ok"] > ok + 100)
+    finally:
+        stop.set()
+        for thread in clients:
+            thread.join()
+        proc.terminate()
+        proc.wait(timeout=10)
+        listener.close()
+
+    assert results["connect_failed"] == 0
+    # at most one request per client was in flight on each terminated process
+    assert results["aborted"] <= 3 * len(clients)
+
+
+def run_concurrently(func, num):
+    results = [None] * num
+    errors = []
+
+    def run(i):
+        try:
+            results[i] = func()
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(num)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+def test_singleflight_shares_result_and_error():
+    singleflight = SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def compute(value):
+        calls.append(value)
+        release.wait(10)
+        if value == "error":
+            raise ValueError(value)
+        return value
+
+    for value in ("ok", "error"):
+        calls.clear()
+        release.clear()
+        timer = threading.Timer(0.2, release.set)
+        timer.start()
+        results, errors = run_concurrently(
+            lambda: singleflight.do(value, compute, value), 10
+        )
+        assert calls == [value]
+        if value == "ok":
+            assert sorted(results) == [("ok", False)] + [("ok", True)] * 9
+        else:
+            assert len(errors) == 10
+    assert singleflight.deduplicated == 18
+    assert not singleflight._calls
+    # later calls compute again
+    release.set()
+    assert singleflight.do("ok", compute, "ok") == ("ok", False)
+
+
+def test_coalesced_userdb_lookups(example_config, monkeypatch):
+    dictproxy = AuthDictProxy(config=example_config)
+    # make every lookup read the password file
+    dictproxy.userdb_cache = None
+    dictproxy.metrics = DictProxyMetrics(dictproxy.name)
+    addr = "coalesce1@chat.example.org"
+    dictproxy.lookup_passdb(addr, "q9mr3faue1")
+
+    reads = []
+    orig_get_userdb_dict = User.get_userdb_dict
+
+    def slow_get_userdb_dict(self):
+        reads.append(self.addr)
+        time.sleep(0.2)
+        return orig_get_userdb_dict(self)
+
+    monkeypatch.setattr(User, "get_userdb_dict", slow_get_userdb_dict)
+    request = f"Lshared/userdb/{addr}\t{addr}"
+    results, errors = run_concurrently(
+        lambda: dictproxy.handle_dovecot_request(request, {}), 20
+    )
+    assert not errors
+    assert len(set(results)) == 1 and results[0].startswith("O")
+    assert len(reads) < 20
+    assert dictproxy.metrics.deduplicated == 20 - len(reads)
+    content = dictproxy.metrics.get_textfile_content()
+    assert (
+        'chatmail_dictproxy_lookups_deduplicated_total{proxy="doveauth"}'
+        f" {20 - len(reads)}"
+    ) in content
+
+
+def test_metadata_turn_lookups_not_coalesced(tmp_path):
+    dictproxy = MetadataDictProxy(notifier=None, metadata=Metadata(tmp_path))
+    key = "shared/vendor/vendor.dovecot/pvt/server/vendor/deltachat/turn"
+    assert dictproxy.get_lookup_coalesce_key([key, "x@example.org"]) is None
+    key = "priv/43f5f508a7ea0366dff30200c15250e3/devicetoken"
+    assert dictproxy.get_lookup_coalesce_key([key, "x@example.org"]) is not None
+
+
+def test_request_pool_runs_by_priority():
+    order = []
+
+    async def main():
+        pool = RequestPool(max_threads=1, max_queue=100)
+        with pool.executor:
+            blocker = asyncio.ensure_future(pool.run(time.sleep, 0.2))
+            await asyncio.sleep(0.05)
+            jobs = [
+                asyncio.ensure_future(pool.run(order.append, prio, priority=prio))
+                for prio in (PRIORITY_LOW, PRIORITY_NORMAL, PRIORITY_HIGH)
+            ]
+            await asyncio.gather(blocker, *jobs)
+        assert pool.running == 0
+
+    asyncio.run(main())
+    assert order == [PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW]
+
+
+def test_request_pool_sheds_low_priority():
+    ran = []
+
+    def shed(name):
+        return f"shed {name}"
+
+    def run(name):
+        ran.append(name)
+        return f"ran {name}"
+
+    async def main():
+        pool = RequestPool(max_threads=1, max_queue=2, queue_budget=0.05)
+        with pool.executor:
+            blocker = asyncio.ensure_future(pool.run(time.sleep, 0.2))
+            await asyncio.sleep(0.01)
+            # waits longer than the budget and is shed when its turn comes
+            waited = asyncio.ensure_future(pool.run(run, "waited", shed=shed))
+            normal = asyncio.ensure_future(pool.run(run, "normal"))
+            await asyncio.sleep(0.01)
+            # the queue is full so it is shed right away
+            assert await pool.run(run, "full", shed=shed) == "shed full"
+            results = await asyncio.gather(blocker, waited, normal)
+            assert results[1:] == ["shed waited", "ran normal"]
+            # the last started batch waited too long
+            assert pool.is_overloaded()
+            assert await pool.run(run, "idle", shed=shed) == "ran idle"
+        assert pool.running == 0
+
+    asyncio.run(main())
+    assert ran == ["normal", "idle"]
+
+
+def test_lastlogin_shed_request_lines(example_config, testaddr):
+    AuthDictProxy(config=example_config).lookup_passdb(testaddr, "q9mr3faue1")
+    dictproxy = LastLoginDictProxy(config=example_config)
+    dictproxy.metrics = DictProxyMetrics(dictproxy.name)
+    user = example_config.get_user(testaddr)
+    before = user.get_last_login_timestamp()
+    lines = [
+        f"B1\t{testaddr}".encode(),
+        f"S1\tshared/last-login/{testaddr}\t172800".encode(),
+        b"C1",
+    ]
+    assert dictproxy.shed_request_lines(lines, {}) == ("O\n", True)
+    assert user.get_last_login_timestamp() == before
+    assert dictproxy.metrics.shed == 1
+    assert "chatmail_dictproxy_shed_total" in dictproxy.metrics.get_textfile_content()
@@ -0,0 +1,168 @@
+import io
+import json
+import os
+import socket
+import stat
+import threading
+import time
+
+import pytest
+
+from chatmaild.dictreplay import (
+    Anonymizer,
+    capture,
+    percentile,
+    read_recording,
+    replay,
+    replay_main,
+)
+from chatmaild.doveauth import AuthDictProxy
+from chatmaild.lastlogin import LastLoginDictProxy
+
+
+@pytest.fixture
+def serve_proxy(tmp_path):
+    def serve(dictproxy):
+        path = str(tmp_path.joinpath("proxy.socket"))
+        thread = threading.Thread(
+            target=dictproxy.serve_forever_from_socket, args=(path,), daemon=True
+        )
+        thread.start()
+        for _ in range(100):
+            if tmp_path.joinpath("proxy.socket").exists():
+                return path
+            time.sleep(0.05)
+        pytest.fail("dict proxy did not start")
+
+    return serve
+
+
+def send(path, *lines):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(10)
+        sock.connect(path)
+        sock.sendall("".join(f"{line}\n" for line in lines).encode())
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile("rb") as rfile:
+            return rfile.read().decode()
+
+
+def test_anonymizer():
+    anonymizer = Anonymizer(key=b"k" * 16)
+    addr = "someuser1@chat.example.org"
+    line = anonymizer.anonymize_request(f'Lshared/passdb/secret\\"pw"{addr}\t{addr}')
+    assert "secret" not in line and "someuser1" not in line
+    assert line.startswith("Lshared/passdb/")
+    pseudonym = anonymizer.anonymize_address_string(addr)
+    assert line.endswith(f"\t{pseudonym}")
+    assert len(pseudonym.split("@")[0]) == 9
+    assert pseudonym.endswith("@chat.example.org")
+    # pseudonyms are stable within one capture
+    assert anonymizer.anonymize_request(f"Lshared/userdb/{addr}\t{addr}") == (
+        f"Lshared/userdb/{pseudonym}\t{pseudonym}"
+    )
+    assert Anonymizer().anonymize_address_string(addr) != pseudonym
+
+    guid = "43f5f508a7ea0366dff30200c15250e3"
+    line = anonymizer.anonymize_request(f"S1\tpriv/{guid}/devicetoken\tsecrettoken")
+    assert guid not in line and "secrettoken" not in line
+    assert line.startswith("S1\tpriv/") and "/devicetoken\t" in line
+
+
+def test_capture_keeps_socket_permissions(serve_proxy, example_config):
+    path = serve_proxy(AuthDictProxy(config=example_config))
+    os.chmod(path, 0o660)
+    server = capture(path, io.StringIO())
+    try:
+        st = os.stat(path)
+        assert stat.S_IMODE(st.st_mode) == 0o660
+        assert (st.st_uid, st.st_gid) == (os.getuid(), os.getgid())
+    finally:
+        server.stop()
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 0.5) == 51
+    assert percentile(values, 0.99) == 100
+    assert percentile([], 0.5) == 0.0
+
+
+def test_capture(serve_proxy, example_config, tmp_path):
+    path = serve_proxy(AuthDictProxy(config=example_config))
+    recording = io.StringIO()
+    server = capture(path, recording)
+    addr = "capture01@chat.example.org"
+    try:
+        replies = send(path, f'Lshared/passdb/q9mr3faue1"{addr}\t{addr}')
+        assert replies.startswith("O") and addr in replies
+    finally:
+        server.stop()
+
+    # the proxy socket is back in place
+    assert send(path, f"Lshared/userdb/{addr}\t{addr}").startswith("O")
+
+    entries = [json.loads(x) for x in recording.getvalue().splitlines()]
+    assert "capture01" not in recording.getvalue()
+    assert "q9mr3faue1" not in recording.getvalue()
+    assert [sorted(x) for x in entries] == [
+        ["c", "q", "t"],
+        ["c", "r", "t"],
+        ["c", "close", "t"],
+    ]
+    assert entries[1]["r"] == "O"
+
+
+def write_recording(path, numconns, numlookups):
+    with path.open("w") as f:
+        for conn in range(numconns):
+            addr = f"replay{conn:03}@chat.example.org"
+            t = conn * 0.01
+            f.write(json.dumps(dict(t=t, c=conn, q=f"B1\t{addr}")) + "\n")
+            f.write(
+                json.dumps(dict(t=t, c=conn, q=f"S1\tshared/last-login/{addr}\t172800"))
+                + "\n"
+            )
+            f.write(json.dumps(dict(t=t, c=conn, q="C1")) + "\n")
+            f.write(json.dumps(dict(t=t, c=conn, r="O")) + "\n")
+            for i in range(numlookups):
+                q = f"Lshared/userdb/{addr}\t{addr}"
+                f.write(json.dumps(dict(t=t + i * 0.001, c=conn, q=q)) + "\n")
+
+
+def test_replay(serve_proxy, example_config, tmp_path):
+    recording = tmp_path.joinpath("recording.jsonl")
+    write_recording(recording, numconns=20, numlookups=5)
+    connections = read_recording(recording)
+    assert len(connections) == 20
+    assert [x[0] for x in connections] == sorted(x[0] for x in connections)
+
+    path = serve_proxy(LastLoginDictProxy(config=example_config))
+    stats = replay(path, connections, speed=10, concurrency=4)
+    assert stats.numrequests == 20 * 8
+    assert stats.errors == 0
+    assert len(stats.latencies["commit"]) == 20
+    assert len(stats.latencies["lookup"]) == 20 * 5
+    summary = stats.get_summary()
+    assert "160 requests" in summary
+    print(summary)
+
+
+@pytest.mark.parametrize("proxy", ["doveauth", "lastlogin", "metadata"])
+def test_replay_main(example_config, tmp_path, capsys, proxy):
+    recording = tmp_path.joinpath("recording.jsonl")
+    write_recording(recording, numconns=5, numlookups=2)
+    replay_main(
+        [
+            str(example_config._inipath),
+            proxy,
+            str(recording),
+            "--speed",
+            "100",
+            "--engine",
+            "asyncio",
+        ]
+    )
+    out = capsys.readouterr().out
+    assert "25 requests" in out
+    assert out.splitlines()[-1].startswith("all")
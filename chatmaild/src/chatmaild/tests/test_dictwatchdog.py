@@ -0,0 +1,103 @@
+import logging
+import threading
+
+import pytest
+
+from chatmaild import dictwatchdog
+from chatmaild.dictmetrics import DictProxyMetrics
+from chatmaild.dictproxy import DictProxy
+from chatmaild.dictwatchdog import SlowRequestWatchdog, get_key_class
+
+
+@pytest.mark.parametrize(
+    "short_command,parts,key_class",
+    [
+        ("L", ["shared/userdb/user@example.org", "user@example.org"], "shared/userdb"),
+        ("L", ['shared/passdb/pw"user@example.org', "user"], "shared/passdb"),
+        ("S", ["1", "shared/last-login/user@example.org", "1"], "shared/last-login"),
+        (
+            "U",
+            ["1", "priv/43f5f508a7ea0366dff30200c15250e3/devicetoken"],
+            "priv/devicetoken",
+        ),
+        ("H", ["3", "2", "0", "", "auth"], ""),
+    ],
+)
+def test_get_key_class(short_command, parts, key_class):
+    assert get_key_class(short_command, parts) == key_class
+
+
+class BlockingDictProxy(DictProxy):
+    name = "blocking"
+
+    def __init__(self):
+        super().__init__()
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def handle_lookup(self, parts):
+        self.started.set()
+        self.release.wait(timeout=10)
+        return "O\n"
+
+
+def test_stuck_request_is_sampled(caplog):
+    dictproxy = BlockingDictProxy()
+    dictproxy.metrics = DictProxyMetrics(dictproxy.name)
+    watchdog = dictproxy.watchdog = SlowRequestWatchdog(
+        dictproxy.name, threshold=0.0, metrics=dictproxy.metrics
+    )
+    thread = threading.Thread(
+        target=dictproxy.handle_dovecot_request,
+        args=("Lshared/userdb/someuser1@example.org\tsomeuser1@example.org", {}),
+    )
+    thread.start()
+    assert dictproxy.started.wait(timeout=10)
+    with caplog.at_level(logging.WARNING):
+        watchdog.check()
+        watchdog.check()
+    dictproxy.release.set()
+    thread.join()
+
+    assert watchdog.slow == 1
+    assert watchdog.inflight == {}
+    assert dictproxy.metrics.commands["lookup"].slow == 1
+    [record] = caplog.records
+    assert "slow lookup request key=shared/userdb running for" in record.message
+    assert "in handle_lookup" in record.message
+    assert "someuser1" not in record.message
+
+
+def test_slow_request_reported_on_completion(caplog, monkeypatch):
+    dictproxy = BlockingDictProxy()
+    dictproxy.release.set()
+    watchdog = dictproxy.watchdog = SlowRequestWatchdog(dictproxy.name, threshold=0.0)
+    with caplog.at_level(logging.WARNING):
+        dictproxy.handle_dovecot_request("Lshared/userdb/x\tx", {})
+    assert watchdog.slow == 1
+    assert "slow lookup request key=shared/userdb took" in caplog.text
+
+    # fast requests are not reported
+    watchdog.threshold = 10
+    dictproxy.handle_dovecot_request("Lshared/userdb/x\tx", {})
+    assert watchdog.slow == 1
+
+
+def test_slow_request_log_is_rate_limited(caplog, monkeypatch):
+    monkeypatch.setattr(dictwatchdog, "LOG_BURST", 3)
+    dictproxy = BlockingDictProxy()
+    dictproxy.release.set()
+    watchdog = dictproxy.watchdog = SlowRequestWatchdog(dictproxy.name, threshold=0.0)
+    with caplog.at_level(logging.WARNING):
+        for _ in range(10):
+            dictproxy.handle_dovecot_request("Lshared/userdb/x\tx", {})
+    assert watchdog.slow == 10
+    assert len(caplog.records) == 3
+    assert watchdog.suppressed == 7
+
+    # once the allowance refills, the suppressed messages are mentioned
+    watchdog._log_last -= dictwatchdog.LOG_PERIOD
+    with caplog.at_level(logging.WARNING):
+        dictproxy.handle_dovecot_request("Lshared/userdb/x\tx", {})
+    assert "(7 slow request message(s) suppressed)" in caplog.records[-1].message
+    assert watchdog.suppressed == 0
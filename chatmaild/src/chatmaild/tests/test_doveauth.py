@@ -1,17 +1,27 @@
 import io
+import itertools
 import json
 import queue
+import shutil
 import threading
+import time
 import traceback
+import tracemalloc
 
 import pytest
 
 import chatmaild.doveauth
+from chatmaild.config import write_initial_config
+from chatmaild.dictreplay import percentile
 from chatmaild.doveauth import (
     AuthDictProxy,
+    CreationDeferred,
+    PasswordHasher,
+    get_hash_executor,
     is_allowed_to_create,
 )
 from chatmaild.newemail import create_newemail_dict
+from chatmaild.passwords import verify_password
 
 
 @pytest.fixture
@@ -39,6 +49,84 @@ def test_iterate_addresses(dictproxy):
     assert set(res) == set(addresses)
 
 
+class RecordingFile(io.BytesIO):
+    def __init__(self):
+        super().__init__()
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(bytes(data))
+        return super().write(data)
+
+
+def test_iterate_streams_chunks(dictproxy, monkeypatch):
+    monkeypatch.setattr(chatmaild.doveauth, "ITERATE_CHUNK_SIZE", 3)
+    mailboxes_dir = dictproxy.config.mailboxes_dir
+    for i in range(7):
+        mailboxes_dir.joinpath(f"iterate{i:02}@chat.example.org").mkdir()
+    addr = "iterate00@chat.example.org"
+    rfile = io.BytesIO(
+        f"H3\t2\t0\t\tauth\nI0\t0\tshared/userdb/\nLshared/userdb/{addr}\t{addr}\n".encode()
+    )
+    wfile = RecordingFile()
+    dictproxy.loop_forever(rfile, wfile)
+
+    # 7 users are written in three chunks, the last one ending the iteration,
+    # and the lookup following the iterate request is answered after it
+    assert [x.count(b"\n") for x in wfile.writes] == [3, 3, 2, 1]
+    lines = wfile.getvalue().decode("ascii").split("\n")
+    assert sorted(lines[:7]) == [
+        f"Oshared/userdb/iterate{i:02}@chat.example.org\t" for i in range(7)
+    ]
+    assert lines[7] == ""
+    assert lines[8] == "N"
+
+
+@pytest.mark.parametrize(
+    "flags,max_rows,path,expected",
+    [
+        (0, 2, "shared/userdb/", 2),
+        (0, 0, "shared/userdb/iterate1", 4),
+        (0x10, 0, "shared/userdb/iterate11@chat.example.org", 1),
+        (0x10, 0, "shared/userdb/iterate1", 0),
+        (0x02, 3, "shared/userdb/", 3),
+        (0, 0, "shared/other/", 0),
+    ],
+)
+def test_iterate_flags(dictproxy, flags, max_rows, path, expected):
+    for i in range(5, 14):
+        dictproxy.config.mailboxes_dir.joinpath(
+            f"iterate{i:02}@chat.example.org"
+        ).mkdir()
+    res = dictproxy.handle_dovecot_request(f"I{flags}\t{max_rows}\t{path}", {})
+    lines = "".join(res).split("\n")
+    assert lines[-2:] == ["", ""]
+    users = [x.removeprefix("Oshared/userdb/").rstrip("\t") for x in lines[:-2]]
+    assert len(users) == expected
+    if flags & 0x02:
+        assert users == [f"iterate{i:02}@chat.example.org" for i in range(5, 8)]
+    if path.startswith("shared/userdb/iterate1"):
+        assert all(x.startswith("iterate1") for x in users)
+
+
+def test_iterate_memory_is_flat(dictproxy):
+    num = 20000
+    for i in range(num):
+        dictproxy.config.mailboxes_dir.joinpath(f"many{i:05}@chat.example.org").mkdir()
+
+    tracemalloc.start()
+    try:
+        count = 0
+        for chunk in dictproxy.handle_iterate(["0", "0", "shared/userdb/"]):
+            count += chunk.count("\n")
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert count == num + 1
+    # a single reply string for all users would take about 1MB
+    assert peak < 300 * 1024
+
+
 def test_invalid_username_length(example_config):
     config = example_config
     config.username_min_length = 6
@@ -68,7 +156,8 @@ def test_nocreate_file(monkeypatch, tmpdir, dictproxy):
     p = tmpdir.join("nocreate")
     p.write("")
     monkeypatch.setattr(chatmaild.doveauth, "NOCREATE_FILE", str(p))
-    dictproxy.lookup_passdb("newuser12@chat.example.org", "zequ0Aimuchoodaechik")
+    with pytest.raises(CreationDeferred):
+        dictproxy.lookup_passdb("newuser12@chat.example.org", "zequ0Aimuchoodaechik")
     assert not dictproxy.lookup_userdb("newuser12@chat.example.org")
 
 
@@ -178,6 +267,8 @@ def test_50_concurrent_lookups_different_accounts(gencreds, dictproxy):
     num_threads = 50
     req_per_thread = 5
     results = queue.Queue()
+    # create accounts faster than the creation budget allows
+    dictproxy.hasher.creations_per_second = 0
 
     def lookup():
         for i in range(req_per_thread):
@@ -202,3 +293,266 @@ def test_50_concurrent_lookups_different_accounts(gencreds, dictproxy):
         res = results.get()
         if res is not None:
             pytest.fail(f"concurrent lookup failed\n{res}")
+
+
+def test_userdb_cache(dictproxy, gencreds):
+    cache = dictproxy.userdb_cache
+    addr, password = gencreds()
+    assert dictproxy.lookup_userdb(addr) == {}
+    userdata = dictproxy.lookup_passdb(addr, password)
+    assert (cache.hits, cache.misses) == (0, 3)
+    assert dictproxy.lookup_userdb(addr) == userdata
+    assert dictproxy.lookup_passdb(addr, password) == userdata
+    assert (cache.hits, cache.misses) == (2, 3)
+    assert len(cache) == 1
+
+
+def test_userdb_cache_password_change(dictproxy, gencreds):
+    addr, password = gencreds()
+    userdata = dictproxy.lookup_passdb(addr, password)
+    user = dictproxy.config.get_user(addr)
+    user.set_password("{SHA512-CRYPT}changed")
+    assert dictproxy.lookup_userdb(addr)["password"] == "{SHA512-CRYPT}changed"
+    assert userdata["password"] != "{SHA512-CRYPT}changed"
+
+    # last-login updates change the mtime and are noticed as well
+    user.set_last_login_timestamp(86400 * 3)
+    hits = dictproxy.userdb_cache.hits
+    assert dictproxy.lookup_userdb(addr)["password"] == "{SHA512-CRYPT}changed"
+    assert dictproxy.userdb_cache.hits == hits
+
+
+def test_userdb_cache_expired_user(dictproxy, gencreds):
+    addr, password = gencreds()
+    dictproxy.lookup_passdb(addr, password)
+    assert dictproxy.lookup_userdb(addr)
+    # chatmail-expire removes the whole mailbox directory
+    shutil.rmtree(dictproxy.config.get_user(addr).maildir)
+    assert dictproxy.lookup_userdb(addr) == {}
+    assert len(dictproxy.userdb_cache) == 0
+
+
+def test_userdb_cache_is_bounded(make_config, gencreds):
+    config = make_config("chat.example.org", {"dictproxy_userdb_cache_size": "3"})
+    dictproxy = AuthDictProxy(config=config)
+    addrs = []
+    for _ in range(5):
+        addr, password = gencreds()
+        dictproxy.lookup_passdb(addr, password)
+        addrs.append(addr)
+    assert len(dictproxy.userdb_cache) == 3
+    assert list(dictproxy.userdb_cache._entries) == addrs[2:]
+
+
+def test_userdb_cache_disabled(make_config, gencreds):
+    config = make_config("chat.example.org", {"dictproxy_userdb_cache_size": "0"})
+    dictproxy = AuthDictProxy(config=config)
+    assert dictproxy.userdb_cache is None
+    addr, password = gencreds()
+    assert dictproxy.lookup_passdb(addr, password)
+    assert dictproxy.lookup_userdb(addr)
+
+
+def test_bench_userdb_cache(microbench, make_config):
+    addr, password = "userdbben@chat.example.org", "q9mr3faue1"
+    for size in ("0", "10000"):
+        config = make_config("chat.example.org", {"dictproxy_userdb_cache_size": size})
+        dictproxy = AuthDictProxy(config=config)
+        dictproxy.lookup_passdb(addr, password)
+        msg = f"Lshared/userdb/{addr}\t{addr}".encode()
+        assert dictproxy.handle_dovecot_request(msg, {}).startswith("O")
+
+        def lookup():
+            dictproxy.handle_dovecot_request(msg, {})
+
+        microbench(lookup, 2000, name=f"userdb-lookup-cache-size-{size}")
+
+
+def test_address_filter(dictproxy, monkeypatch):
+    known = "known1234@chat.example.org"
+    dictproxy.lookup_passdb(known, "q9mr3faue1")
+    dictproxy.init_address_filter()
+    assert dictproxy.address_filter is not None
+
+    def get_user(addr):
+        raise AssertionError(f"disk access for {addr}")
+
+    # unknown addresses which may not be created are answered from memory
+    with monkeypatch.context() as m:
+        m.setattr(dictproxy.config, "get_user", get_user)
+        m.setattr(chatmaild.doveauth, "NOCREATE_FILE", "/nonexistent/raises")
+        m.setattr(chatmaild.doveauth.os.path, "exists", get_user)
+        assert dictproxy.lookup_userdb("unknown12@chat.example.org") == {}
+        assert dictproxy.lookup_passdb("unknown12@chat.example.org", "short") is None
+        assert (
+            dictproxy.lookup_passdb("toolongaddr@chat.example.org", "q9mr3faue1")
+            is None
+        )
+
+    assert dictproxy.lookup_userdb(known)
+    new = "created12@chat.example.org"
+    assert dictproxy.lookup_passdb(new, "q9mr3faue1")
+    assert new in dictproxy.address_filter
+    assert dictproxy.lookup_userdb(new)
+
+
+def test_address_filter_disabled(make_config):
+    config = make_config("chat.example.org", {"dictproxy_address_filter": "false"})
+    dictproxy = AuthDictProxy(config=config)
+    dictproxy.init_address_filter()
+    assert dictproxy.address_filter is None
+
+
+def test_password_hasher_pool():
+    hasher = PasswordHasher(processes=2, creations_per_second=0)
+    enc_password = hasher.encrypt_password("q9mr3faue1")
+    assert enc_password.startswith("{SHA512-CRYPT}$6$")
+    assert verify_password("q9mr3faue1", enc_password)
+    assert get_hash_executor(2) is get_hash_executor(2)
+    assert get_hash_executor(1, "rehash") is not get_hash_executor(1)
+
+
+def test_admit_rehash(monkeypatch):
+    monkeypatch.setattr(chatmaild.doveauth, "MAX_REHASH_ADDRESSES", 3)
+    hasher = PasswordHasher(processes=0, creations_per_second=0)
+    addrs = [f"rehash{i:03}@chat.example.org" for i in range(4)]
+    assert all(hasher.admit_rehash(addr) for addr in addrs[:3])
+    assert not hasher.admit_rehash(addrs[0])
+    # the remembered addresses are not forgotten before REHASH_INTERVAL
+    assert not hasher.admit_rehash(addrs[3])
+
+    monkeypatch.setattr(chatmaild.doveauth, "REHASH_INTERVAL", 0)
+    assert hasher.admit_rehash(addrs[3])
+    assert hasher.admit_rehash(addrs[0])
+
+
+def test_creation_budget(make_config):
+    config = make_config("chat.example.org", {"dictproxy_creations_per_second": "3"})
+    dictproxy = AuthDictProxy(config=config)
+    domain = config.mail_domain
+    replies = [
+        dictproxy.handle_lookup([f'shared/passdb/q9mr3faue1"budget{i:03}@{domain}'])
+        for i in range(5)
+    ]
+    # rejected creations fail temporarily, so that dovecot does not cache them
+    assert [x[0] for x in replies] == ["O", "O", "O", "F", "F"]
+    assert dictproxy.hasher.rejected == 2
+    with pytest.raises(CreationDeferred):
+        dictproxy.lookup_passdb("budget005@chat.example.org", "q9mr3faue1")
+    # existing accounts are not limited
+    assert dictproxy.lookup_passdb("budget000@chat.example.org", "q9mr3faue1")
+
+
+@pytest.mark.parametrize("processes", [0, 2])
+def test_bench_creation_storm(make_config, processes):
+    config = make_config(
+        "chat.example.org",
+        {
+            "dictproxy_hash_processes": str(processes),
+            "dictproxy_creations_per_second": "0",
+        },
+    )
+    dictproxy = AuthDictProxy(config=config)
+    dictproxy.hasher.encrypt_password("warmup123")
+    known = "storm0000@chat.example.org"
+    dictproxy.lookup_passdb(known, "q9mr3faue1")
+    msg = f"Lshared/userdb/{known}\t{known}".encode()
+
+    counter = itertools.count(1)
+    stop = threading.Event()
+
+    def create():
+        while not stop.is_set():
+            addr = f"storm{next(counter):04}@chat.example.org"
+            assert dictproxy.lookup_passdb(addr, "q9mr3faue1")
+
+    creators = [threading.Thread(target=create) for _ in range(4)]
+    start = time.perf_counter()
+    for thread in creators:
+        thread.start()
+    latencies = []
+    while time.perf_counter() - start < 1.0:
+        sent = time.perf_counter()
+        dictproxy.handle_dovecot_request(msg, {})
+        latencies.append(time.perf_counter() - sent)
+        time.sleep(0.001)
+    stop.set()
+    for thread in creators:
+        thread.join()
+    duration = time.perf_counter() - start
+
+    created = len(list(dictproxy.iter_userdb())) - 1
+    p99 = percentile(sorted(latencies), 0.99)
+    print(
+        f"hash processes {processes}: {created / duration:.0f} creations/s,"
+        f" lookup p99 {p99 * 1000:.2f}ms"
+    )
+    assert created > 0
+
+
+def test_policy_watcher(dictproxy, tmp_path, monkeypatch):
+    nocreate = tmp_path.joinpath("nocreate")
+    monkeypatch.setattr(chatmaild.doveauth, "NOCREATE_FILE", str(nocreate))
+    config = dictproxy.config
+    watcher = dictproxy.policy
+    assert watcher.nocreate is None
+    watcher.start(interval=0.05)
+    assert watcher.nocreate is False
+
+    def wait_for(func):
+        for _ in range(20):
+            if func():
+                return
+            time.sleep(0.05)
+        pytest.fail("policy change was not noticed within a second")
+
+    nocreate.write_text("")
+    wait_for(lambda: watcher.nocreate)
+    nocreate.unlink()
+    wait_for(lambda: not watcher.nocreate)
+
+    overrides = dict(mailboxes_dir=str(config.mailboxes_dir), password_min_length=20)
+    write_initial_config(config._inipath, config.mail_domain, overrides)
+    wait_for(lambda: config.password_min_length == 20)
+
+    dictproxy.on_worker_stop(None)
+    assert not any(x.name == "policywatcher" for x in threading.enumerate())
+
+
+def test_policy_checked_without_filesystem_access(dictproxy, monkeypatch):
+    dictproxy.policy.refresh()
+
+    def exists(path):
+        raise AssertionError(f"filesystem access for {path}")
+
+    monkeypatch.setattr(chatmaild.doveauth.os.path, "exists", exists)
+    assert dictproxy.lookup_passdb("nostat123@chat.example.org", "q9mr3faue1")
+    dictproxy.policy.nocreate = True
+    with pytest.raises(CreationDeferred):
+        dictproxy.lookup_passdb("nostat456@chat.example.org", "q9mr3faue1")
+
+
+def test_rehash_on_login(dictproxy, monkeypatch):
+    addr = "rehash123@chat.example.org"
+    user = dictproxy.config.get_user(addr)
+    userdata = dictproxy.lookup_passdb(addr, "q9mr3faue1")
+    assert userdata["password"].startswith("{SHA512-CRYPT}")
+    user.allow_incoming_cleartext()
+    user.set_last_login_timestamp(86400 * 10)
+
+    dictproxy.config.password_scheme = "BLF-CRYPT"
+    dictproxy.config.password_rounds = 4
+    # a wrong password does not replace the hash
+    assert dictproxy.lookup_passdb(addr, "wrongpassword") == userdata
+    # and the address is not verified again within REHASH_INTERVAL
+    assert dictproxy.lookup_passdb(addr, "q9mr3faue1") == userdata
+
+    monkeypatch.setattr(chatmaild.doveauth, "REHASH_INTERVAL", 0)
+    userdata = dictproxy.lookup_passdb(addr, "q9mr3faue1")
+    assert userdata["password"].startswith("{BLF-CRYPT}$2b$04$")
+    assert verify_password("q9mr3faue1", userdata["password"])
+    assert user.password_path.read_text() == userdata["password"]
+    # last login and the cleartext flag are kept
+    assert user.get_last_login_timestamp() == 86400 * 10
+    assert user.is_incoming_cleartext_ok()
+    assert dictproxy.lookup_passdb(addr, "q9mr3faue1") == userdata
@@ -191,6 +191,22 @@ def test_expiry_cli_old_files(capsys, example_config, mbox1):
     assert "shouldstay" not in err
 
 
+def test_expiry_removes_stale_creation_files(example_config, mbox1):
+    mboxdir = Path(mbox1.basedir)
+    old = time.time() - 7200
+    for name in ("password.lock", "password.tmp-0123abcd", "password.tmp-4567ef01"):
+        mboxdir.joinpath(name).write_text("")
+    os.utime(mboxdir.joinpath("password.lock"), (old, old))
+    os.utime(mboxdir.joinpath("password.tmp-0123abcd"), (old, old))
+
+    expiry_main((str(example_config._inipath), "--remove"))
+    assert not mboxdir.joinpath("password.lock").exists()
+    assert not mboxdir.joinpath("password.tmp-0123abcd").exists()
+    # a recent temporary file may belong to an ongoing creation
+    assert mboxdir.joinpath("password.tmp-4567ef01").exists()
+    assert mboxdir.joinpath("password").exists()
+
+
 def test_get_file_entry(tmp_path):
     assert get_file_entry(str(tmp_path.joinpath("123123"))) is None
     p = tmp_path.joinpath("x")
@@ -0,0 +1,181 @@
+import hashlib
+
+import pytest
+
+from chatmaild.doveauth import AuthDictProxy
+from chatmaild.expire import daily_expire_main, iter_mailboxes
+from chatmaild.fsreport import main as report_main
+from chatmaild.mailboxes import (
+    get_hashed_dir,
+    get_mailbox_dir,
+    iter_mailbox_dirs,
+    migrate_mailbox,
+    migrate_main,
+)
+from chatmaild.metadata import Metadata
+
+
+@pytest.fixture
+def hashed_config(make_config):
+    return make_config("chat.example.org", {"mailboxes_layout": "hashed"})
+
+
+def create_flat_user(config, addr, password="{SHA512-CRYPT}xyz"):
+    maildir = config.mailboxes_dir.joinpath(addr)
+    maildir.joinpath("cur").mkdir(parents=True)
+    maildir.joinpath("password").write_text(password)
+    return maildir
+
+
+def test_hashed_dir(tmp_path):
+    addr = "someuser1@chat.example.org"
+    digest = hashlib.md5(addr.encode()).hexdigest()
+    path = get_hashed_dir(tmp_path, addr)
+    assert path == tmp_path.joinpath(digest[:2], digest[2:4], addr)
+    assert get_mailbox_dir(tmp_path, addr) == tmp_path.joinpath(addr)
+    assert get_mailbox_dir(tmp_path, addr, "hashed") == path
+
+    tmp_path.joinpath(addr).mkdir()
+    assert get_mailbox_dir(tmp_path, addr, "hashed") == tmp_path.joinpath(addr)
+    path.mkdir(parents=True)
+    assert get_mailbox_dir(tmp_path, addr, "hashed") == path
+
+
+def test_config_layout(make_config, hashed_config):
+    config = make_config("chat.example.org")
+    assert config.mailboxes_layout == "flat"
+    assert config.dovecot_mailbox_path == f"{config.mailboxes_dir}/%u"
+    assert hashed_config.dovecot_mailbox_path.endswith("/%2Mu/%2.2Mu/%u")
+    with pytest.raises(ValueError):
+        make_config("chat.example.org", {"mailboxes_layout": "deep"})
+
+
+def test_iter_mailbox_dirs(tmp_path):
+    assert list(iter_mailbox_dirs(tmp_path.joinpath("missing"))) == []
+    addrs = [f"user{i:05}@chat.example.org" for i in range(20)]
+    for addr in addrs[:10]:
+        tmp_path.joinpath(addr).mkdir()
+    for addr in addrs[10:]:
+        get_hashed_dir(tmp_path, addr).mkdir(parents=True)
+    tmp_path.joinpath("pending_notifications").mkdir()
+    tmp_path.joinpath("xy", "ab").mkdir(parents=True)
+
+    found = dict(iter_mailbox_dirs(tmp_path))
+    assert sorted(found) == addrs
+    for addr, path in found.items():
+        assert path == str(get_mailbox_dir(tmp_path, addr, "hashed"))
+
+
+def test_iter_mailboxes_maxnum_is_lazy(tmp_path, monkeypatch):
+    for i in range(10):
+        get_hashed_dir(tmp_path, f"user{i:05}@chat.example.org").mkdir(parents=True)
+    scanned = []
+    monkeypatch.setattr(
+        "chatmaild.expire.MailboxStat", lambda path: scanned.append(path) or path
+    )
+    assert len(list(iter_mailboxes(str(tmp_path), 3))) == 3
+    assert len(scanned) == 3
+    assert len(list(iter_mailboxes(str(tmp_path), None))) == 10
+
+
+def test_create_hashed_account(hashed_config):
+    dictproxy = AuthDictProxy(config=hashed_config)
+    addr = "someuser1@chat.example.org"
+    assert dictproxy.lookup_passdb(addr, "q9mr3faue1w")
+    maildir = get_hashed_dir(hashed_config.mailboxes_dir, addr)
+    assert maildir.joinpath("password").exists()
+    assert maildir.joinpath("enforceE2EEincoming").exists()
+    assert not hashed_config.mailboxes_dir.joinpath(addr).exists()
+
+    userdb = dictproxy.lookup_userdb(addr)
+    assert userdb["home"] == str(maildir)
+    assert "mail" not in userdb
+    assert list(dictproxy.iter_userdb()) == [addr]
+
+
+def test_legacy_flat_mailbox(hashed_config):
+    dictproxy = AuthDictProxy(config=hashed_config)
+    addr = "someuser1@chat.example.org"
+    maildir = create_flat_user(hashed_config, addr)
+
+    user = hashed_config.get_user(addr)
+    assert user.legacy and user.maildir == maildir
+    userdb = dictproxy.lookup_userdb(addr)
+    assert userdb["home"] == str(maildir)
+    assert userdb["mail"] == f"maildir:{maildir}"
+    assert list(dictproxy.iter_userdb()) == [addr]
+
+    # legacy users are not cached and found at the new location once moved
+    newdir = migrate_mailbox(hashed_config.mailboxes_dir, addr)
+    user = hashed_config.get_user(addr)
+    assert not user.legacy and user.maildir == newdir
+    userdb = dictproxy.lookup_userdb(addr)
+    assert userdb["home"] == str(newdir)
+    assert "mail" not in userdb
+
+
+def test_legacy_flat_mailbox_without_password(hashed_config):
+    addr = "someuser1@chat.example.org"
+    hashed_config.mailboxes_dir.joinpath(addr).mkdir()
+    user = hashed_config.get_user(addr)
+    assert user.legacy
+    assert not user.create_password("{SHA512-CRYPT}xyz")
+    assert not user.maildir.joinpath("password").exists()
+
+
+def test_metadata_hashed(hashed_config):
+    metadata = Metadata(hashed_config.mailboxes_dir, "hashed")
+    addr = "someuser1@chat.example.org"
+    get_hashed_dir(hashed_config.mailboxes_dir, addr).mkdir(parents=True)
+    metadata.add_token_to_addr(addr, "01234")
+    maildir = get_hashed_dir(hashed_config.mailboxes_dir, addr)
+    assert maildir.joinpath("metadata.json").exists()
+    assert metadata.get_tokens_for_addr(addr) == ["01234"]
+
+
+def test_migrate_mailbox_conflict(tmp_path):
+    addr = "someuser1@chat.example.org"
+    tmp_path.joinpath(addr, "cur").mkdir(parents=True)
+    get_hashed_dir(tmp_path, addr).joinpath("cur").mkdir(parents=True)
+    assert migrate_mailbox(tmp_path, addr) is None
+    assert tmp_path.joinpath(addr).exists()
+
+
+def test_migrate_main(hashed_config, make_config, capsys):
+    addrs = [f"user{i:05}@chat.example.org" for i in range(5)]
+    for addr in addrs:
+        create_flat_user(hashed_config, addr)
+    inipath = str(hashed_config._inipath)
+
+    migrate_main([inipath, "--maxnum", "2", "--pause", "0", "--no-kick"])
+    assert "moved 2 of 5 flat mailboxes" in capsys.readouterr().out
+    migrate_main([inipath, "--pause", "0", "--no-kick"])
+    assert "moved 3 of 3 flat mailboxes" in capsys.readouterr().out
+
+    for addr in addrs:
+        assert not hashed_config.mailboxes_dir.joinpath(addr).exists()
+        maildir = get_hashed_dir(hashed_config.mailboxes_dir, addr)
+        assert maildir.joinpath("password").read_text() == "{SHA512-CRYPT}xyz"
+        assert maildir.joinpath("cur").exists()
+
+    make_config("chat.example.org")
+    with pytest.raises(SystemExit):
+        migrate_main([inipath])
+
+
+def test_expire_and_report_hashed(hashed_config, capsys):
+    old = "olduser1@chat.example.org"
+    flat = "flatuser@chat.example.org"
+    create_flat_user(hashed_config, flat)
+    hashed_config.get_user(old).set_password("{SHA512-CRYPT}xyz")
+    maildir = get_hashed_dir(hashed_config.mailboxes_dir, old)
+    assert maildir.joinpath("password").exists()
+
+    report_main([str(hashed_config._inipath)])
+    # the password files of both mailboxes
+    assert "Mailbox data total size:  0.03K" in capsys.readouterr().out
+
+    days = int(hashed_config.delete_inactive_users_after) + 1
+    daily_expire_main([str(hashed_config._inipath), "--remove", "--days", f"-{days}"])
+    assert not maildir.exists()
+    assert not hashed_config.mailboxes_dir.joinpath(flat).exists()
@@ -398,3 +398,49 @@ def test_shared_lookup(dictproxy, suffix, expected):
     rfile, wfile = io.BytesIO(b"H\n" + key), io.BytesIO()
     dictproxy.loop_forever(rfile, wfile)
     assert wfile.getvalue() == expected
+
+
+def test_worker_queues(metadata, notifier, testaddr):
+    metadata.add_token_to_addr(testaddr, "01234")
+    # persisted by a single-process proxy before workers were configured
+    notifier.new_message_for_addr(testaddr, metadata)
+    base = notifier.queue_dir
+
+    worker1 = Notifier(base)
+    worker1.use_worker_queue(1, workers=2)
+    worker1.new_message_for_addr(testaddr, metadata)
+    assert len(list(base.joinpath("worker1").iterdir())) == 1
+
+    # worker 0 adopts the single-process items, but not those of worker 1
+    worker0 = Notifier(base)
+    worker0.use_worker_queue(0, workers=2)
+    worker0.requeue_persistent_queue_items()
+    assert worker0.retry_queues[0].qsize() == 1
+
+    # a restarted worker 1 requeues its own items only
+    restarted = Notifier(base)
+    restarted.use_worker_queue(1, workers=2)
+    restarted.requeue_persistent_queue_items()
+    assert restarted.retry_queues[0].qsize() == 1
+
+    single = Notifier(base)
+    single.use_worker_queue(None)
+    single.requeue_persistent_queue_items()
+    assert single.retry_queues[0].qsize() == 2
+
+
+def test_worker_queues_of_removed_workers(metadata, notifier, testaddr):
+    metadata.add_token_to_addr(testaddr, "01234")
+    base = notifier.queue_dir
+    for worker in range(4):
+        notifier = Notifier(base)
+        notifier.use_worker_queue(worker, workers=4)
+        notifier.new_message_for_addr(testaddr, metadata)
+
+    # worker 0 adopts the items of workers 2 and 3 after lowering to 2 workers
+    worker0 = Notifier(base)
+    worker0.use_worker_queue(0, workers=2)
+    worker0.requeue_persistent_queue_items()
+    assert worker0.retry_queues[0].qsize() == 3
+    assert list(base.joinpath("worker1").iterdir())
+    assert not list(base.joinpath("worker3").iterdir())
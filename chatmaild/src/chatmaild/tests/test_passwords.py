@@ -0,0 +1,91 @@
+import pytest
+
+from chatmaild.passwords import (
+    SCHEMES,
+    calibrate,
+    calibrate_main,
+    check_scheme,
+    encrypt_password,
+    get_hash_params,
+    needs_rehash,
+    rehash_password,
+    verify_password,
+)
+
+
+@pytest.mark.parametrize(
+    "scheme,rounds,params",
+    [
+        ("SHA512-CRYPT", 0, ("SHA512-CRYPT", 5000)),
+        ("SHA512-CRYPT", 2000, ("SHA512-CRYPT", 2000)),
+        ("SHA256-CRYPT", 0, ("SHA256-CRYPT", 5000)),
+        ("BLF-CRYPT", 5, ("BLF-CRYPT", 5)),
+    ],
+)
+def test_encrypt_and_verify(scheme, rounds, params):
+    enc_password = encrypt_password("q9mr3faue1", scheme, rounds)
+    assert enc_password.startswith(f"{{{scheme}}}$")
+    assert get_hash_params(enc_password) == params
+    assert verify_password("q9mr3faue1", enc_password)
+    assert not verify_password("wrong", enc_password)
+    assert not needs_rehash(enc_password, scheme, rounds)
+    assert needs_rehash(enc_password, scheme, params[1] + 1)
+
+
+def test_get_hash_params_unknown():
+    assert get_hash_params("plaintext") == (None, None)
+    assert get_hash_params("{PLAIN}secret") == ("PLAIN", None)
+    assert not verify_password("secret", "{PLAIN}secret")
+
+
+def test_rehash_password():
+    enc_password = encrypt_password("q9mr3faue1")
+    assert rehash_password("wrong", enc_password, "BLF-CRYPT", 4) is None
+    new = rehash_password("q9mr3faue1", enc_password, "BLF-CRYPT", 4)
+    assert get_hash_params(new) == ("BLF-CRYPT", 4)
+    assert verify_password("q9mr3faue1", new)
+
+
+def test_check_scheme():
+    check_scheme("SHA512-CRYPT", 0)
+    check_scheme("BLF-CRYPT", 31)
+    with pytest.raises(ValueError):
+        check_scheme("MD5-CRYPT", 0)
+    with pytest.raises(ValueError):
+        check_scheme("BLF-CRYPT", 32)
+    with pytest.raises(ValueError):
+        check_scheme("SHA256-CRYPT", 999)
+
+
+def test_calibrate():
+    rounds = calibrate("SHA256-CRYPT", target=0.005)
+    assert 1000 <= rounds
+    assert calibrate("BLF-CRYPT", target=0.0) == 4
+
+
+def test_calibrate_main(capsys):
+    calibrate_main(["--scheme", "BLF-CRYPT", "--target-ms", "5"])
+    out = capsys.readouterr().out.splitlines()
+    assert out[1].startswith("BLF-CRYPT") and out[1].endswith("(default)")
+    assert out[2].endswith("(recommended)")
+
+
+@pytest.mark.parametrize(
+    "scheme,rounds",
+    [
+        ("SHA512-CRYPT", 0),
+        ("SHA512-CRYPT", 20000),
+        ("SHA256-CRYPT", 0),
+        ("BLF-CRYPT", 8),
+        ("BLF-CRYPT", 10),
+    ],
+)
+def test_bench_login_verify(microbench, scheme, rounds):
+    # every login verifies the password hash once
+    enc_password = encrypt_password("q9mr3faue1", scheme, rounds)
+    rounds = rounds or SCHEMES[scheme][1]
+    microbench(
+        lambda: verify_password("q9mr3faue1", enc_password),
+        2,
+        name=f"login-verify-{scheme}-{rounds}",
+    )
@@ -1,3 +1,7 @@
+import os
+import threading
+
+
 def test_login_timestamp(testaddr, example_config):
     user = example_config.get_user(testaddr)
     user.set_password("someeqkjwelkqwjleqwe")
@@ -54,3 +58,50 @@ def test_set_get_cleartext_flag(testaddr, example_config, tmp_path):
     assert not user.is_incoming_cleartext_ok()
     user.allow_incoming_cleartext()
     assert user.is_incoming_cleartext_ok()
+
+
+def test_create_password_exactly_one_wins(example_config):
+    user = example_config.get_user("racetest2@chat.example.org")
+    num_procs, num_threads = 4, 8
+    read_fd, write_fd = os.pipe()
+
+    def run_threads(prefix):
+        wins = []
+        barrier = threading.Barrier(num_threads)
+
+        def create(i):
+            barrier.wait()
+            if user.create_password(f"{prefix}-{i}"):
+                wins.append(f"{prefix}-{i}")
+
+        threads = [
+            threading.Thread(target=create, args=(i,)) for i in range(num_threads)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return wins
+
+    pids = []
+    for proc in range(num_procs):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                wins = run_threads(f"proc{proc}")
+                os.write(write_fd, "".join(f"{x}\n" for x in wins).encode())
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    os.close(write_fd)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    with os.fdopen(read_fd) as f:
+        wins = f.read().split()
+
+    assert len(wins) == 1
+    assert user.password_path.read_text() == wins[0]
+    assert user.enforce_E2EE_path.exists()
+    # no lock or temporary files are left
+    assert sorted(os.listdir(user.maildir)) == ["enforceE2EEincoming", "password"]
+    assert not user.create_password("other")
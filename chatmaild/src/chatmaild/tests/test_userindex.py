@@ -0,0 +1,258 @@
+import threading
+import time
+
+import pytest
+
+import chatmaild.combined
+from chatmaild.doveauth import AuthDictProxy
+from chatmaild.expire import daily_expire_main
+from chatmaild.fsreport import main as report_main
+from chatmaild.lastlogin import LastLoginDictProxy
+from chatmaild.userindex import FLAG_DELETED, IndexEntry, UserIndex, rebuild_main
+from chatmaild.userstore import MaildirUserStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return MaildirUserStore(tmp_path.joinpath("mailboxes"))
+
+
+@pytest.fixture
+def index(tmp_path, store):
+    index = UserIndex(tmp_path.joinpath("userindex"))
+    index.rebuild(store)
+    return index
+
+
+@pytest.fixture
+def index_config(make_config):
+    return make_config("chat.example.org", {"user_index": "true"})
+
+
+def test_empty(tmp_path, store):
+    index = UserIndex(tmp_path.joinpath("userindex"))
+    assert not index.exists()
+    assert index.get("someuser1@chat.example.org") is None
+    assert list(index.iter_entries()) == []
+    assert index.compact(store) == 0
+    assert index.exists()
+    assert list(index.iter_entries()) == []
+
+
+def test_compact_without_base_rebuilds(tmp_path, store):
+    old, new = "olduser1@chat.example.org", "newuser1@chat.example.org"
+    store.set_password(old, "{SHA512-CRYPT}xyz")
+    store.set_password(new, "{SHA512-CRYPT}xyz")
+    index = UserIndex(tmp_path.joinpath("userindex"))
+    # the journal only knows users created since the index was enabled
+    index.add(new, time.time())
+    assert index.compact(store) == 2
+    assert [x.addr for x in index.iter_entries()] == [new, old]
+
+
+def test_add_get_delete(index):
+    addr = "someuser1@chat.example.org"
+    index.add(addr, 86400 * 10 + 5)
+    entry = index.get(addr)
+    assert entry == IndexEntry(addr, 10, 0)
+    assert entry.last_login == 86400 * 10
+    assert addr in index
+
+    index.set_last_login(addr, 86400 * 12)
+    assert index.get(addr).last_login_day == 12
+    index.delete(addr)
+    assert index.get(addr) is None
+    assert addr not in index
+
+
+def test_set_last_login_does_not_add_users(index, store):
+    addr = "someuser1@chat.example.org"
+    index.set_last_login(addr, 86400 * 10)
+    assert index.get(addr) is None
+    index.add(addr, 86400 * 10)
+    index.delete(addr)
+    index.set_last_login(addr, 86400 * 12)
+    assert index.get(addr) is None
+    index.compact(store)
+    assert list(index.iter_entries()) == []
+
+
+def test_set_last_login_same_day_does_not_write(index):
+    addr = "someuser1@chat.example.org"
+    index.add(addr, 86400 * 10)
+    size = index.journal_path.stat().st_size
+    index.set_last_login(addr, 86400 * 10 + 3600)
+    assert index.journal_path.stat().st_size == size
+
+
+def test_compact_and_other_readers(index, store):
+    addrs = [f"user{i:05}@chat.example.org" for i in range(100)]
+    for i, addr in enumerate(reversed(addrs)):
+        index.add(addr, 86400 * i)
+    reader = UserIndex(index.path)
+    assert len(list(reader.iter_entries())) == 100
+
+    assert index.compact(store) == 100
+    assert not index.journal_path.exists()
+    assert [x.addr for x in index.iter_entries()] == addrs
+
+    index.delete(addrs[0])
+    index.add("zzz@chat.example.org", 0)
+    index.add("aaa@chat.example.org", 0)
+    index.set_last_login(addrs[50], 86400 * 1000)
+    expected = ["aaa@chat.example.org"] + addrs[1:] + ["zzz@chat.example.org"]
+    for idx in (index, reader):
+        assert [x.addr for x in idx.iter_entries()] == expected
+        assert idx.get(addrs[50]).last_login_day == 1000
+        assert idx.get(addrs[0]) is None
+
+    assert index.compact(store) == 101
+    assert [x.addr for x in reader.iter_entries()] == expected
+    assert reader.get(addrs[50]).last_login_day == 1000
+
+
+def test_incomplete_journal_line_is_skipped(index):
+    index.add("someuser1@chat.example.org", 0)
+    with open(index.journal_path, "ab") as f:
+        f.write(b"someuser2@chat.example.org\t0")
+    assert index.get("someuser2@chat.example.org") is None
+    with open(index.journal_path, "ab") as f:
+        f.write(b"\t0\n")
+    assert index.get("someuser2@chat.example.org") is not None
+
+
+def test_rotated_journal_is_read(index, store):
+    index.add("someuser1@chat.example.org", 0)
+    # as left by an interrupted compaction
+    index.journal_path.rename(index.path.joinpath("journal.1"))
+    index.add("someuser2@chat.example.org", 0)
+    reader = UserIndex(index.path)
+    assert len(list(reader.iter_entries())) == 2
+    assert index.compact(store) == 2
+    assert list(index.path.glob("journal*")) == []
+
+
+def test_concurrent_writes_and_compaction(index, store):
+    addrs = [f"user{i:05}@chat.example.org" for i in range(400)]
+
+    def add(addrs):
+        for addr in addrs:
+            index.add(addr, 0)
+
+    threads = [threading.Thread(target=add, args=(addrs[i::4],)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        index.compact(store)
+    for thread in threads:
+        thread.join()
+    assert [x.addr for x in UserIndex(index.path).iter_entries()] == addrs
+    index.compact(store)
+    assert [x.addr for x in UserIndex(index.path).iter_entries()] == addrs
+
+
+def test_invalid_address(index):
+    with pytest.raises(ValueError):
+        index.add("some\tuser@chat.example.org", 0)
+    index.delete("someuser1@chat.example.org")
+    assert index.journal_path.read_text().endswith(f"\t0\t{FLAG_DELETED}\n")
+
+
+def test_config(make_config, index_config):
+    assert make_config("chat.example.org").get_user_index() is None
+    index = index_config.get_user_index()
+    assert index is index_config.get_user_index()
+    assert index.path == index_config.mailboxes_dir.joinpath("userindex")
+
+
+def test_rebuild(index_config, capsys):
+    addrs = [f"user{i:05}@chat.example.org" for i in range(10)]
+    for addr in addrs:
+        index_config.get_user(addr).set_password("{SHA512-CRYPT}xyz")
+    index = index_config.get_user_index()
+    index.add("stale@chat.example.org", 0)
+
+    rebuild_main([str(index_config._inipath)])
+    assert "indexed 10 users" in capsys.readouterr().err
+    entries = list(index.iter_entries())
+    assert [x.addr for x in entries] == addrs
+    assert entries[0].last_login_day == int(time.time()) // 86400
+
+
+def test_rebuild_disabled(example_config):
+    with pytest.raises(SystemExit):
+        rebuild_main([str(example_config._inipath)])
+
+
+def test_doveauth_and_lastlogin(index_config):
+    dictproxy = AuthDictProxy(config=index_config)
+    index = index_config.get_user_index()
+    addr = "someuser1@chat.example.org"
+    assert dictproxy.lookup_passdb(addr, "q9mr3faue1w")
+    assert index.get(addr).last_login_day == int(time.time()) // 86400
+    assert list(dictproxy.iter_userdb()) == [addr]
+
+    # users created without doveauth are only iterated after a rebuild
+    index_config.get_user("other0001@chat.example.org").set_password("{X}y")
+    assert list(dictproxy.iter_userdb()) == [addr]
+
+    lastlogin = LastLoginDictProxy(config=index_config)
+    timestamp = int(time.time()) - 86400 * 3
+    lastlogin.handle_set(None, ["S", f"shared/last-login/{addr}", str(timestamp)])
+    assert index.get(addr).last_login == timestamp // 86400 * 86400
+
+
+def test_combined_builds_missing_index(index_config, monkeypatch):
+    addr = "olduser01@chat.example.org"
+    index_config.get_user(addr).set_password("{SHA512-CRYPT}xyz")
+    served = []
+    monkeypatch.setattr(
+        chatmaild.combined, "serve_combined", lambda *args: served.append(args)
+    )
+    monkeypatch.setattr(
+        chatmaild.combined.sys, "argv", ["combined", "a", "m", "l", "ini"]
+    )
+    monkeypatch.setattr(chatmaild.combined, "read_config", lambda path: index_config)
+    chatmaild.combined.main()
+    assert len(served) == 1
+    dictproxy = AuthDictProxy(config=index_config)
+    assert dictproxy.lookup_passdb("newuser01@chat.example.org", "q9mr3faue1w")
+    assert sorted(dictproxy.iter_userdb()) == [
+        "newuser01@chat.example.org",
+        "olduser01@chat.example.org",
+    ]
+
+
+def test_expire_builds_missing_index(index_config):
+    old, active = "olduser01@chat.example.org", "newuser01@chat.example.org"
+    index_config.get_user(old).set_password("{SHA512-CRYPT}xyz")
+    dictproxy = AuthDictProxy(config=index_config)
+    assert dictproxy.lookup_passdb(active, "q9mr3faue1w")
+    index = index_config.get_user_index()
+    assert not index.exists()
+
+    daily_expire_main([str(index_config._inipath), "--remove"])
+    assert [x.addr for x in index.iter_entries()] == [active, old]
+
+
+def test_expire_removes_inactive_users_from_index(index_config, tmp_path):
+    old, active = "olduser1@chat.example.org", "newuser1@chat.example.org"
+    index = index_config.get_user_index()
+    for addr in (old, active):
+        index_config.get_user(addr).set_password("{SHA512-CRYPT}xyz")
+    index.rebuild(index_config.get_user_store())
+    days = int(index_config.delete_inactive_users_after) + 1
+    index.set_last_login(old, time.time() - days * 86400)
+
+    daily_expire_main([str(index_config._inipath), "--remove"])
+    assert not index_config.mailboxes_dir.joinpath(old).exists()
+    assert index_config.mailboxes_dir.joinpath(active).exists()
+    assert [x.addr for x in index.iter_entries()] == [active]
+    # the journal was compacted
+    assert not index.journal_path.exists()
+
+    textfile = tmp_path.joinpath("fsreport.prom")
+    report_main(
+        [str(index_config._inipath), "--logins-only", "--textfile", str(textfile)]
+    )
+    assert 'chatmail_accounts{kind="all"} 1\n' in textfile.read_text()
@@ -0,0 +1,205 @@
+import os
+import threading
+import time
+
+import pytest
+
+import chatmaild.userstore
+from chatmaild.doveauth import AuthDictProxy
+from chatmaild.expire import daily_expire_main
+from chatmaild.lastlogin import LastLoginDictProxy
+from chatmaild.user import get_daytimestamp
+from chatmaild.userstore import (
+    MaildirUserStore,
+    SqliteUserStore,
+    UserStore,
+    make_user_store,
+    migrate_main,
+)
+
+
+@pytest.fixture(params=["maildir", "sqlite"])
+def store_config(request, make_config):
+    return make_config("chat.example.org", {"user_store": request.param})
+
+
+@pytest.fixture
+def store(store_config):
+    return store_config.get_user_store()
+
+
+def test_make_user_store(tmp_path):
+    assert isinstance(make_user_store("maildir", tmp_path), MaildirUserStore)
+    store = make_user_store("sqlite", tmp_path)
+    assert store.path == tmp_path.joinpath("userstore.sqlite")
+    store = make_user_store("sqlite", tmp_path, tmp_path / "x.sqlite")
+    assert store.path == tmp_path.joinpath("x.sqlite")
+    with pytest.raises(ValueError):
+        make_user_store("ldap", tmp_path)
+
+
+def test_user_store_is_abstract():
+    class PasswordOnlyStore(UserStore):
+        def get_password(self, addr):
+            return None
+
+    with pytest.raises(TypeError):
+        PasswordOnlyStore()
+
+
+def test_config_user_store(make_config, tmp_path):
+    config = make_config("chat.example.org")
+    assert config.user_store == "maildir"
+    assert config.get_user_store() is config.get_user_store()
+    config.mailboxes_dir = tmp_path.joinpath("other")
+    assert config.get_user_store().mailboxes_dir == config.mailboxes_dir
+    config = make_config(
+        "chat.example.org", {"user_store": "sqlite", "user_store_path": "/x/y.sqlite"}
+    )
+    assert str(config.get_user_store().path) == "/x/y.sqlite"
+    with pytest.raises(ValueError):
+        make_config("chat.example.org", {"user_store": "ldap"})
+
+
+def test_password(store_config, store):
+    addr = "someuser1@chat.example.org"
+    store_config.get_user(addr).maildir.mkdir()
+    assert store.get_password(addr) is None
+    assert store.get_version(addr) is None
+    assert store.create_password(addr, "{SHA512-CRYPT}one")
+    assert not store.create_password(addr, "{SHA512-CRYPT}two")
+    assert store.get_password(addr) == "{SHA512-CRYPT}one"
+    version = store.get_version(addr)
+    assert version is not None
+
+    store.set_last_login(addr, 86400)
+    store.replace_password(addr, "{SHA512-CRYPT}three")
+    assert store.get_password(addr) == "{SHA512-CRYPT}three"
+    assert store.get_last_login(addr) == 86400
+    assert store.get_version(addr) != version
+
+    store.delete(addr)
+    assert store.get_password(addr) is None
+    assert store.get_last_login(addr) is None
+
+    # a recreated user does not get a version of its deleted predecessor
+    versions = {version, store.get_version(addr)}
+    for i in range(3):
+        assert store.create_password(addr, "{SHA512-CRYPT}one")
+        assert store.get_version(addr) not in versions
+        versions.add(store.get_version(addr))
+        store.delete(addr)
+
+
+def test_last_login(store_config, caplog):
+    user = store_config.get_user("someuser1@chat.example.org")
+    user.set_last_login_timestamp(100000)
+    assert "Can not get last login" in caplog.text
+    assert user.get_last_login_timestamp() is None
+
+    user.set_password("{SHA512-CRYPT}one")
+    assert abs(user.get_last_login_timestamp() - time.time()) < 10
+    version = user.store.get_version(user.addr)
+    user.set_last_login_timestamp(100000)
+    assert user.get_last_login_timestamp() == get_daytimestamp(100000)
+    assert user.store.get_version(user.addr) != version
+
+
+def test_iter_users(store_config, store, monkeypatch):
+    monkeypatch.setattr(chatmaild.userstore, "SQLITE_ITERATE_CHUNK_SIZE", 3)
+    addrs = [f"user{i:05}@chat.example.org" for i in range(10)]
+    for addr in addrs:
+        store_config.get_user(addr).set_password(f"pw-{addr}")
+    assert sorted(store.iter_addresses()) == addrs
+    users = sorted(store.iter_users())
+    assert [x[0] for x in users] == addrs
+    assert users[0][1] == f"pw-{addrs[0]}"
+    assert all(x[2] for x in users)
+
+
+def test_sqlite_connection_per_thread_and_process(tmp_path):
+    store = SqliteUserStore(tmp_path.joinpath("users.sqlite"))
+    store.set_password("main@chat.example.org", "pw")
+
+    def run():
+        assert store.get_password("main@chat.example.org") == "pw"
+        store.set_password("thread@chat.example.org", "pw")
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            store.set_password("child@chat.example.org", "pw")
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    assert store.get_password("thread@chat.example.org") == "pw"
+    assert store.get_password("child@chat.example.org") == "pw"
+    assert store._get_conn().execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+def test_doveauth_and_lastlogin(store_config):
+    dictproxy = AuthDictProxy(store_config)
+    addr = "someuser1@chat.example.org"
+    userdb = dictproxy.lookup_passdb(addr, "q9mr3faue1")
+    assert userdb["password"].startswith("{SHA512-CRYPT}")
+    assert dictproxy.lookup_userdb(addr) == userdb
+    assert list(dictproxy.iter_userdb()) == [addr]
+    user = store_config.get_user(addr)
+    assert not user.is_incoming_cleartext_ok()
+    if store_config.user_store == "sqlite":
+        assert not user.password_path.exists()
+
+    lastlogin = LastLoginDictProxy(store_config)
+    lastlogin.handle_set(None, ["", f"shared/last-login/{addr}", "200000"])
+    assert user.get_last_login_timestamp() == 86400 * 2
+    # the cache notices the last-login update
+    assert dictproxy.lookup_userdb(addr) == userdb
+
+
+def test_expire(store_config):
+    dictproxy = AuthDictProxy(store_config)
+    old = time.time() - (store_config.delete_inactive_users_after + 1) * 86400
+    for addr in ("oldold001@chat.example.org", "newnew001@chat.example.org"):
+        dictproxy.lookup_passdb(addr, "q9mr3faue1")
+    store_config.get_user("oldold001@chat.example.org").set_last_login_timestamp(old)
+
+    daily_expire_main(["--remove", str(store_config._inipath)])
+    store = store_config.get_user_store()
+    assert list(store.iter_addresses()) == ["newnew001@chat.example.org"]
+    assert store.get_password("oldold001@chat.example.org") is None
+    assert not store_config.mailboxes_dir.joinpath(
+        "oldold001@chat.example.org"
+    ).exists()
+
+
+def test_migrate(make_config, capsys):
+    config = make_config("chat.example.org")
+    addrs = [f"user{i:05}@chat.example.org" for i in range(5)]
+    for i, addr in enumerate(addrs):
+        user = config.get_user(addr)
+        user.set_password(f"pw-{addr}")
+        user.set_last_login_timestamp(86400 * (i + 1))
+
+    migrate_main([str(config._inipath), "sqlite"])
+    out, _ = capsys.readouterr()
+    assert out.startswith("copied 5 users from maildir to sqlite store")
+
+    sqlite_store = make_user_store("sqlite", config.mailboxes_dir)
+    assert sorted(sqlite_store.iter_users()) == [
+        (addr, f"pw-{addr}", 86400 * (i + 1)) for i, addr in enumerate(addrs)
+    ]
+
+    # and back into an empty maildir store
+    for addr in addrs:
+        config.get_user_store().delete(addr)
+    migrate_main([str(config._inipath), "maildir", "--source", "sqlite"])
+    assert sorted(config.get_user_store().iter_users()) == sorted(
+        sqlite_store.iter_users()
+    )
+
+    with pytest.raises(SystemExit):
+        migrate_main([str(config._inipath), "maildir"])
@@ -1,7 +1,8 @@
 import logging
-import os
+import threading
+from collections import OrderedDict
 
-from chatmaild.filedict import write_bytes_atomic
+from chatmaild.userstore import MaildirUserStore
 
 
 def get_daytimestamp(timestamp) -> int:
@@ -9,13 +10,19 @@ def get_daytimestamp(timestamp) -> int:
 
 
 class User:
-    def __init__(self, maildir, addr, password_path, uid, gid):
+    # True for a flat mailbox with the hashed mailboxes layout
+    legacy = False
+
+    def __init__(self, maildir, addr, password_path, uid, gid, store=None):
         self.maildir = maildir
         self.addr = addr
         self.password_path = password_path
         self.enforce_E2EE_path = maildir.joinpath("enforceE2EEincoming")
         self.uid = uid
         self.gid = gid
+        if store is None:
+            store = MaildirUserStore(maildir.parent)
+        self.store = store
 
     @property
     def can_track(self):
@@ -24,9 +31,8 @@ class User:
     def get_userdb_dict(self):
         """Return a non-empty dovecot 'userdb' style dict
         if the user has an existing non-empty password"""
-        try:
-            pw = self.password_path.read_text()
-        except FileNotFoundError:
+        pw = self.store.get_password(self.addr)
+        if pw is None:
             return {}
 
         if not pw:
@@ -34,7 +40,13 @@ class User:
             return {}
 
         home = str(self.maildir)
-        return dict(addr=self.addr, home=home, uid=self.uid, gid=self.gid, password=pw)
+        userdb = dict(
+            addr=self.addr, home=home, uid=self.uid, gid=self.gid, password=pw
+        )
+        if self.legacy:
+            # overrides the hashed mail_location until the mailbox is moved
+            userdb["mail"] = f"maildir:{home}"
+        return userdb
 
     def is_incoming_cleartext_ok(self):
         return not self.enforce_E2EE_path.exists()
@@ -50,33 +62,100 @@ class User:
         but there is no guarantee which of the password-set calls will win.
         """
         self.maildir.mkdir(exist_ok=True, parents=True)
-        password = enc_password.encode("ascii")
+        try:
+            self.store.set_password(self.addr, enc_password)
+        except PermissionError:
+            logging.error(f"could not write password for: {self.addr}")
+            raise
+        self.enforce_E2EE_path.touch()
 
+    def replace_password(self, enc_password):
+        """Atomically replace the password of this existing user
+        keeping the last login time."""
+        self.store.replace_password(self.addr, enc_password)
+
+    def create_password(self, enc_password):
+        """Set the specified password for this new user
+        and return True, or return False if the user already has a password.
+
+        Concurrent calls from any thread or process
+        are race-free and exactly one of them wins.
+        """
+        if self.legacy:
+            # a flat mailbox without password is left to chatmail-expire
+            return False
+        self.maildir.mkdir(exist_ok=True, parents=True)
         try:
-            write_bytes_atomic(self.password_path, password)
+            if not self.store.create_password(self.addr, enc_password):
+                return False
         except PermissionError:
             logging.error(f"could not write password for: {self.addr}")
             raise
         self.enforce_E2EE_path.touch()
+        return True
 
     def set_last_login_timestamp(self, timestamp):
         """Track login time with daily granularity
         to minimize touching files and to minimize metadata leakage."""
         if not self.can_track:
             return
-        try:
-            mtime = int(os.stat(self.password_path).st_mtime)
-        except FileNotFoundError:
-            logging.error(f"Can not get last login timestamp for {self.addr}")
-            return
-
-        timestamp = get_daytimestamp(timestamp)
-        if mtime != timestamp:
-            os.utime(self.password_path, (timestamp, timestamp))
+        self.store.set_last_login(self.addr, get_daytimestamp(timestamp))
 
     def get_last_login_timestamp(self):
         if self.can_track:
-            try:
-                return int(self.password_path.stat().st_mtime)
-            except FileNotFoundError:
-                pass
+            return self.store.get_last_login(self.addr)
+
+
+class UserdbCache:
+    """Bounded LRU cache of userdb dicts of existing users.
+
+    Entries are validated by the version of the user in its store
+    on every lookup, with the maildir store a stat of the password file,
+    so password changes, last-login updates
+    and deletions by chatmail-expire are noticed
+    without reading the password or any invalidation messages.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, user):
+        """Return the userdb dict of `user` and whether it came from the cache."""
+        statkey = user.store.get_version(user.addr)
+        if statkey is None:
+            with self._lock:
+                self._entries.pop(user.addr, None)
+                self.misses += 1
+            return {}, False
+
+        with self._lock:
+            entry = self._entries.get(user.addr)
+            if entry is not None and entry[0] == statkey:
+                self._entries.move_to_end(user.addr)
+                self.hits += 1
+                return entry[1], True
+            self.misses += 1
+
+        # the password may be replaced after getting its version,
+        # this only results in a stale key and a miss on the next lookup
+        userdb = user.get_userdb_dict()
+        with self._lock:
+            if userdb:
+                self._entries[user.addr] = (statkey, userdb)
+                self._entries.move_to_end(user.addr)
+                if len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+            else:
+                self._entries.pop(user.addr, None)
+        return userdb, False
+
+    def invalidate(self, addr):
+        with self._lock:
+            self._entries.pop(addr, None)
+
+    def __len__(self):
+        return len(self._entries)
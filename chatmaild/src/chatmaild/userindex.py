@@ -0,0 +1,413 @@
+"""
+Compact sorted index of all users and their last-login days.
+
+The index lets doveauth iteration, chatmail-expire and chatmail-fsreport
+learn all addresses with their last-login day without walking
+the mailboxes directory and stat'ing a password file per user.
+
+It consists of a sorted base file which readers memory-map
+and search with bisection, and a journal of changes since the base
+was written: doveauth appends created users, lastlogin changed
+last-login days and chatmail-expire removed users.
+Appending a line is atomic, so all processes write concurrently
+and readers apply the journal on top of the base.
+chatmail-expire compacts the journal into a new base every day and
+
+    chatmail-rebuild-userindex /usr/local/lib/chatmaild/chatmail.ini
+
+recreates the index from the user store.
+
+The base file starts with a header of HEADER,
+followed by one ENTRY per user sorted by address
+and the UTF-8 encoded addresses the entries point to.
+"""
+
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from collections import namedtuple
+from contextlib import contextmanager
+
+MAGIC = b"CMUIDX01"
+
+# magic, number of entries
+HEADER = struct.Struct("<8sI4x")
+
+# address offset, address length, flags, last-login day
+ENTRY = struct.Struct("<IHHI")
+
+# flag of journal lines removing a user
+FLAG_DELETED = 1
+
+# directory of the index in the mailboxes directory
+USER_INDEX_NAME = "userindex"
+
+# files in the index directory
+BASE_NAME = "users"
+JOURNAL_NAME = "journal"
+LOCK_NAME = "lock"
+
+
+class IndexEntry(namedtuple("IndexEntry", ("addr", "last_login_day", "flags"))):
+    @property
+    def last_login(self):
+        """Return the last-login timestamp or None if the user never logged in."""
+        return self.last_login_day * 86400 if self.last_login_day else None
+
+
+def format_journal_line(addr, day, flags):
+    if "\t" in addr or "\n" in addr:
+        raise ValueError(f"invalid address {addr!r}")
+    return f"{addr}\t{day}\t{flags}\n".encode()
+
+
+def parse_journal(data):
+    """Yield (addr, IndexEntry) of the complete lines in `data`."""
+    for line in data.decode().splitlines():
+        addr, day, flags = line.split("\t")
+        yield addr, IndexEntry(addr, int(day), int(flags))
+
+
+def write_base(path, entries):
+    """Atomically write a base file of `entries` sorted by address."""
+    blobs = [entry.addr.encode() for entry in entries]
+    blob_start = HEADER.size + len(blobs) * ENTRY.size
+    parts = [HEADER.pack(MAGIC, len(blobs))]
+    offset = blob_start
+    for entry, blob in zip(entries, blobs):
+        parts.append(ENTRY.pack(offset, len(blob), entry.flags, entry.last_login_day))
+        offset += len(blob)
+    parts.extend(blobs)
+    tmp = path.with_name(f"{path.name}.tmp-{os.urandom(8).hex()}")
+    with open(tmp, "wb") as f:
+        f.write(b"".join(parts))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+
+class BaseFile:
+    """Read-only memory map of a base file."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            self.ino = st.st_ino
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            self._map.close()
+            raise ValueError(f"{path} is not a user index")
+
+    def close(self):
+        self._map.close()
+
+    def get_addr(self, i):
+        offset, length, _, _ = ENTRY.unpack_from(
+            self._map, HEADER.size + i * ENTRY.size
+        )
+        return self._map[offset : offset + length]
+
+    def get_entry(self, i):
+        offset, length, flags, day = ENTRY.unpack_from(
+            self._map, HEADER.size + i * ENTRY.size
+        )
+        return IndexEntry(self._map[offset : offset + length].decode(), day, flags)
+
+    def find(self, addr):
+        """Return the IndexEntry of `addr` or None."""
+        key = addr.encode()
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_addr(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self.get_addr(lo) == key:
+            return self.get_entry(lo)
+        return None
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.get_entry(i)
+
+
+class UserIndex:
+    """Memory-mapped index of users in the directory `path`.
+
+    Lookups cost two stat calls to notice new journal lines
+    and a compaction, and a bisection of the base file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.base_path = path.joinpath(BASE_NAME)
+        self.journal_path = path.joinpath(JOURNAL_NAME)
+        self._lock = threading.Lock()
+        self._base = None
+        self._state = None
+        self._journal_pos = 0
+        self._changes = {}
+        self._sorted_changes = None
+
+    def exists(self):
+        return self.base_path.exists()
+
+    def _iter_rotated_journals(self):
+        prefix = JOURNAL_NAME + "."
+        try:
+            names = [x for x in os.listdir(self.path) if x.startswith(prefix)]
+        except FileNotFoundError:
+            return
+        for name in sorted(names, key=lambda x: int(x[len(prefix) :])):
+            yield self.path.joinpath(name)
+
+    def _refresh(self):
+        """Update the state of this reader to the current base and journal."""
+        try:
+            base_ino = os.stat(self.base_path).st_ino
+        except FileNotFoundError:
+            base_ino = None
+        try:
+            st = os.stat(self.journal_path)
+            journal_ino, journal_size = st.st_ino, st.st_size
+        except FileNotFoundError:
+            journal_ino, journal_size = None, 0
+
+        # the state is taken before reading, so changes meanwhile
+        # are noticed on the next refresh
+        state = (base_ino, journal_ino)
+        if state != self._state:
+            self._reload(base_ino is not None, journal_ino is not None)
+            self._state = state
+        elif journal_size > self._journal_pos:
+            self._read_journal(self.journal_path)
+
+    def _reload(self, has_base, has_journal):
+        # a replaced map is closed when the last iteration over it ends
+        self._base = None
+        if has_base:
+            try:
+                self._base = BaseFile(self.base_path)
+            except FileNotFoundError:
+                pass
+        self._changes = {}
+        self._sorted_changes = None
+        # journals rotated by an ongoing compaction are applied before the live one
+        for path in self._iter_rotated_journals():
+            self._read_journal(path, live=False)
+        self._journal_pos = 0
+        if has_journal:
+            self._read_journal(self.journal_path)
+
+    def _read_journal(self, path, live=True):
+        try:
+            with open(path, "rb") as f:
+                if live:
+                    f.seek(self._journal_pos)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        # a line which is being appended is read on the next refresh
+        end = data.rfind(b"\n") + 1
+        if live:
+            self._journal_pos += end
+        for addr, entry in parse_journal(data[:end]):
+            self._changes[addr] = entry
+        self._sorted_changes = None
+
+    def get(self, addr):
+        """Return the IndexEntry of `addr` or None if it is not a user."""
+        with self._lock:
+            self._refresh()
+            entry = self._changes.get(addr)
+            if entry is None and self._base is not None:
+                entry = self._base.find(addr)
+        if entry is None or entry.flags & FLAG_DELETED:
+            return None
+        return entry
+
+    def __contains__(self, addr):
+        return self.get(addr) is not None
+
+    def iter_entries(self):
+        """Yield the IndexEntry of all users sorted by address."""
+        with self._lock:
+            self._refresh()
+            base, changes = self._base, self._changes
+            if self._sorted_changes is None:
+                self._sorted_changes = sorted(changes, key=str.encode)
+            sorted_changes = self._sorted_changes
+        # the base map stays valid while this iterates, even if it is replaced
+        changed = iter(sorted_changes)
+        next_changed = next(changed, None)
+        for entry in base if base is not None else ():
+            while (
+                next_changed is not None and next_changed.encode() < entry.addr.encode()
+            ):
+                yield from self._live(changes[next_changed])
+                next_changed = next(changed, None)
+            if next_changed == entry.addr:
+                yield from self._live(changes[next_changed])
+                next_changed = next(changed, None)
+            else:
+                yield entry
+        while next_changed is not None:
+            yield from self._live(changes[next_changed])
+            next_changed = next(changed, None)
+
+    def _live(self, entry):
+        if not entry.flags & FLAG_DELETED:
+            yield entry
+
+    def iter_addresses(self):
+        for entry in self.iter_entries():
+            yield entry.addr
+
+    def _append(self, addr, day, flags):
+        line = format_journal_line(addr, day, flags)
+        while True:
+            flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+            try:
+                fd = os.open(self.journal_path, flags, 0o600)
+            except FileNotFoundError:
+                self.path.mkdir(exist_ok=True, parents=True)
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH)
+                # a compaction may have rotated the journal before it was locked
+                try:
+                    current = os.stat(self.journal_path).st_ino
+                except FileNotFoundError:
+                    continue
+                if os.fstat(fd).st_ino == current:
+                    os.write(fd, line)
+                    return
+            finally:
+                os.close(fd)
+
+    def add(self, addr, timestamp):
+        """Add user `addr` created at `timestamp`."""
+        self._append(addr, int(timestamp) // 86400, 0)
+
+    def set_last_login(self, addr, timestamp):
+        """Set the last-login day of user `addr` unless it is unchanged.
+
+        Addresses which are not in the index are left out,
+        so that logins do not add users which were removed meanwhile.
+        """
+        day = int(timestamp) // 86400
+        entry = self.get(addr)
+        if entry is not None and entry.last_login_day != day:
+            self._append(addr, day, entry.flags)
+
+    def delete(self, addr):
+        """Remove user `addr` from the index."""
+        self._append(addr, 0, FLAG_DELETED)
+
+    @contextmanager
+    def _rotated_journals(self):
+        """Rotate the journal and yield the paths of all rotated journals,
+        which are removed afterwards.
+
+        Writers which opened the journal before it was rotated
+        finish their line before the rotated journals are yielded.
+        """
+        self.path.mkdir(exist_ok=True, parents=True)
+        with open(self.path.joinpath(LOCK_NAME), "a") as lock:
+            # only one compaction or rebuild runs at a time
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            rotated = self.journal_path.with_name(
+                f"{self.journal_path.name}.{time.time_ns()}"
+            )
+            try:
+                os.rename(self.journal_path, rotated)
+            except FileNotFoundError:
+                pass
+            paths = list(self._iter_rotated_journals())
+            for path in paths:
+                with open(path, "rb") as f:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+            yield paths
+            for path in paths:
+                path.unlink(missing_ok=True)
+
+    def compact(self, store):
+        """Write a new base file with the journal applied
+        and return the number of users.
+
+        Without a base file the journal only holds the changes
+        since the index was enabled, so it is rebuilt from `store` instead.
+        """
+        with self._rotated_journals() as paths:
+            try:
+                base = BaseFile(self.base_path)
+            except FileNotFoundError:
+                return self._write_base_from_store(store)
+            changes = {}
+            for path in paths:
+                changes.update(parse_journal(path.read_bytes()))
+            try:
+                entries = {x.addr: x for x in base}
+            finally:
+                base.close()
+            entries.update(changes)
+            write_base(self.base_path, self._sorted_live(entries.values()))
+        return sum(1 for x in entries.values() if not x.flags & FLAG_DELETED)
+
+    def rebuild(self, store):
+        """Recreate the index from all users of `store`
+        and return the number of users.
+
+        Changes made while the store is scanned are kept in the journal.
+        """
+        with self._rotated_journals():
+            return self._write_base_from_store(store)
+
+    def _write_base_from_store(self, store):
+        entries = []
+        for addr, _, last_login in store.iter_users():
+            day = int(last_login) // 86400 if last_login else 0
+            entries.append(IndexEntry(addr, day, 0))
+        write_base(self.base_path, self._sorted_live(entries))
+        return len(entries)
+
+    def _sorted_live(self, entries):
+        live = [x for x in entries if not x.flags & FLAG_DELETED]
+        live.sort(key=lambda x: x.addr.encode())
+        return live
+
+
+def rebuild_main(args=None):
+    """Recreate the user index from the user store."""
+    from .config import read_config
+
+    parser = ArgumentParser(description=rebuild_main.__doc__)
+    parser.add_argument("chatmail_ini", help="path pointing to chatmail.ini file")
+    args = parser.parse_args(args)
+
+    config = read_config(args.chatmail_ini)
+    index = config.get_user_index()
+    if index is None:
+        parser.error("set user_index = true in chatmail.ini first")
+    start = time.time()
+    num = index.rebuild(config.get_user_store())
+    print(
+        f"indexed {num} users in {index.path} in {time.time() - start:.2f} seconds",
+        file=sys.stderr,
+    )
+
+
+def rebuild_if_missing(config):
+    """Build the user index of `config` if it is enabled and was never built."""
+    index = config.get_user_index()
+    if index is not None and not index.exists():
+        num = index.rebuild(config.get_user_store())
+        logging.info(f"built user index of {num} users at {index.path}")
@@ -0,0 +1,380 @@
+"""
+Storage backends for the account state of users.
+
+The "maildir" store keeps the encrypted password of each user
+in a ``password`` file of its mailbox directory
+whose modification time tracks the last login.
+The "sqlite" store keeps passwords and last-login days of all users
+in a single SQLite database in WAL mode
+with one connection per thread.
+
+With both stores, messages, metadata and the ``enforceE2EEincoming`` flag
+stay in the mailbox directories.
+``chatmail-migrate-userstore`` copies all users from one store to the other.
+"""
+
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from argparse import ArgumentParser
+from pathlib import Path
+
+from .addrfilter import iter_addresses
+from .filedict import write_bytes_atomic
+from .mailboxes import get_hashed_dir, get_mailbox_dir
+
+# supported values for the "user_store" setting
+USER_STORES = ("maildir", "sqlite")
+
+# file name of the sqlite store in the mailboxes directory
+SQLITE_STORE_NAME = "userstore.sqlite"
+
+# number of rows fetched per query when iterating the sqlite store
+SQLITE_ITERATE_CHUNK_SIZE = 1000
+
+
+class UserStore(ABC):
+    """Interface of stores of passwords and last-login times by address."""
+
+    # True if state is kept in files of the mailbox directories
+    in_maildir = False
+
+    @abstractmethod
+    def get_password(self, addr):
+        """Return the encrypted password of `addr` or None if it has none."""
+
+    @abstractmethod
+    def get_version(self, addr):
+        """Return a value which changes whenever the password or last login
+        of `addr` changes, also if it is deleted and created again,
+        or None if it has no password."""
+
+    @abstractmethod
+    def create_password(self, addr, enc_password):
+        """Set the password of new user `addr` and return True,
+        or return False if it has a password already.
+
+        The mailbox directory of `addr` must exist.
+        """
+
+    @abstractmethod
+    def set_password(self, addr, enc_password):
+        """Set the password of `addr` and its last login to now."""
+
+    @abstractmethod
+    def replace_password(self, addr, enc_password):
+        """Replace the password of existing user `addr` keeping its last login."""
+
+    @abstractmethod
+    def get_last_login(self, addr):
+        """Return the last login timestamp of `addr` or None."""
+
+    @abstractmethod
+    def set_last_login(self, addr, timestamp):
+        """Set the last login timestamp of existing user `addr`."""
+
+    @abstractmethod
+    def delete(self, addr):
+        """Remove the password of `addr` so it can not log in anymore."""
+
+    @abstractmethod
+    def iter_addresses(self):
+        """Yield the addresses of all users."""
+
+    def iter_users(self):
+        """Yield (addr, enc_password, last_login) of all users with a password."""
+        for addr in self.iter_addresses():
+            enc_password = self.get_password(addr)
+            if enc_password is not None:
+                yield addr, enc_password, self.get_last_login(addr)
+
+    def import_user(self, addr, enc_password, last_login):
+        """Store `addr` with the given password and last login."""
+        self.set_password(addr, enc_password)
+        if last_login:
+            self.set_last_login(addr, last_login)
+
+
+class MaildirUserStore(UserStore):
+    """User store in ``password`` files of the mailbox directories.
+
+    With the hashed mailboxes layout, the password of a mailbox
+    which was not migrated yet is found at its flat location,
+    which is only tried if the hashed one does not exist.
+    """
+
+    in_maildir = True
+
+    def __init__(self, mailboxes_dir, layout="flat"):
+        self.mailboxes_dir = mailboxes_dir
+        self.layout = layout
+
+    def get_password_path(self, addr):
+        """Return the path new passwords of `addr` are written to."""
+        if self.layout == "hashed":
+            return get_hashed_dir(self.mailboxes_dir, addr).joinpath("password")
+        return self.mailboxes_dir.joinpath(addr, "password")
+
+    def _call(self, func, addr, *args):
+        """Return `func` called with the password path of `addr`
+        falling back to the flat location with the hashed layout."""
+        try:
+            return func(self.get_password_path(addr), *args)
+        except FileNotFoundError:
+            if self.layout != "hashed":
+                raise
+        return func(self.mailboxes_dir.joinpath(addr, "password"), *args)
+
+    def get_password(self, addr):
+        try:
+            return self._call(Path.read_text, addr)
+        except FileNotFoundError:
+            return None
+
+    def get_version(self, addr):
+        try:
+            st = os.stat(self.get_password_path(addr))
+            flat_fallback = False
+        except FileNotFoundError:
+            if self.layout != "hashed":
+                return None
+            try:
+                st = os.stat(self.mailboxes_dir.joinpath(addr, "password"))
+            except FileNotFoundError:
+                return None
+            flat_fallback = True
+        # the stat of a password does not change when its mailbox is moved
+        return (st.st_ino, st.st_mtime_ns, st.st_size, flat_fallback)
+
+    def create_password(self, addr, enc_password):
+        # Linking the temporary file fails if the password already exists,
+        # so concurrent calls from any thread or process
+        # are race-free and exactly one of them wins.
+        password_path = self.get_password_path(addr)
+        tmp = password_path.with_name(f"password.tmp-{os.urandom(8).hex()}")
+        try:
+            tmp.write_bytes(enc_password.encode("ascii"))
+            os.link(tmp, password_path)
+        except FileExistsError:
+            return False
+        finally:
+            tmp.unlink(missing_ok=True)
+        return True
+
+    def set_password(self, addr, enc_password):
+        maildir = get_mailbox_dir(self.mailboxes_dir, addr, self.layout)
+        password_path = maildir.joinpath("password")
+        password_path.parent.mkdir(exist_ok=True, parents=True)
+        write_bytes_atomic(password_path, enc_password.encode("ascii"))
+
+    def replace_password(self, addr, enc_password):
+        self._call(self._replace_password, addr, enc_password)
+
+    def _replace_password(self, password_path, enc_password):
+        st = os.stat(password_path)
+        tmp = password_path.with_name(f"password.tmp-{os.urandom(8).hex()}")
+        tmp.write_bytes(enc_password.encode("ascii"))
+        os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.rename(tmp, password_path)
+
+    def get_last_login(self, addr):
+        try:
+            return int(self._call(os.stat, addr).st_mtime)
+        except FileNotFoundError:
+            return None
+
+    def set_last_login(self, addr, timestamp):
+        try:
+            self._call(self._set_last_login, addr, timestamp)
+        except FileNotFoundError:
+            logging.error(f"Can not get last login timestamp for {addr}")
+
+    def _set_last_login(self, password_path, timestamp):
+        if int(os.stat(password_path).st_mtime) != timestamp:
+            os.utime(password_path, (timestamp, timestamp))
+
+    def delete(self, addr):
+        self.get_password_path(addr).unlink(missing_ok=True)
+        self.mailboxes_dir.joinpath(addr, "password").unlink(missing_ok=True)
+
+    def iter_addresses(self):
+        return iter_addresses(self.mailboxes_dir)
+
+
+class SqliteUserStore(UserStore):
+    """User store in a SQLite database at `path`.
+
+    Each thread uses its own connection, forked processes open new ones.
+    The database is in WAL mode, so readers do not wait for writers.
+    Versions are nanosecond timestamps of the last change
+    so that a recreated user does not get the version of a deleted one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _get_conn(self):
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            self.path.parent.mkdir(exist_ok=True, parents=True)
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                " addr TEXT PRIMARY KEY,"
+                " password TEXT NOT NULL,"
+                " last_login INTEGER,"
+                " version INTEGER NOT NULL"
+                ") WITHOUT ROWID"
+            )
+            local.conn, local.pid = conn, os.getpid()
+        return local.conn
+
+    def _query_one(self, sql, *args):
+        row = self._get_conn().execute(sql, args).fetchone()
+        return row[0] if row is not None else None
+
+    def get_password(self, addr):
+        return self._query_one("SELECT password FROM users WHERE addr=?", addr)
+
+    def get_version(self, addr):
+        return self._query_one("SELECT version FROM users WHERE addr=?", addr)
+
+    def create_password(self, addr, enc_password):
+        cur = self._get_conn().execute(
+            "INSERT INTO users (addr, password, last_login, version)"
+            " VALUES (?, ?, ?, ?) ON CONFLICT (addr) DO NOTHING",
+            (addr, enc_password, int(time.time()), time.time_ns()),
+        )
+        return cur.rowcount == 1
+
+    def set_password(self, addr, enc_password):
+        self.import_user(addr, enc_password, int(time.time()))
+
+    def replace_password(self, addr, enc_password):
+        self._get_conn().execute(
+            "UPDATE users SET password=?, version=max(version+1, ?) WHERE addr=?",
+            (enc_password, time.time_ns(), addr),
+        )
+
+    def get_last_login(self, addr):
+        return self._query_one("SELECT last_login FROM users WHERE addr=?", addr)
+
+    def set_last_login(self, addr, timestamp):
+        cur = self._get_conn().execute(
+            "UPDATE users SET last_login=?, version=max(version+1, ?)"
+            " WHERE addr=? AND last_login IS NOT ?",
+            (timestamp, time.time_ns(), addr, timestamp),
+        )
+        if cur.rowcount == 0 and self.get_version(addr) is None:
+            logging.error(f"Can not get last login timestamp for {addr}")
+
+    def delete(self, addr):
+        self._get_conn().execute("DELETE FROM users WHERE addr=?", (addr,))
+
+    def iter_addresses(self):
+        for addr, _, _ in self.iter_users():
+            yield addr
+
+    def iter_users(self):
+        # Rows are fetched in chunks with a query each,
+        # so the iteration may continue in other threads
+        # and does not keep a read transaction open.
+        last = ""
+        while True:
+            rows = (
+                self._get_conn()
+                .execute(
+                    "SELECT addr, password, last_login FROM users"
+                    " WHERE addr > ? ORDER BY addr LIMIT ?",
+                    (last, SQLITE_ITERATE_CHUNK_SIZE),
+                )
+                .fetchall()
+            )
+            yield from rows
+            if len(rows) < SQLITE_ITERATE_CHUNK_SIZE:
+                return
+            last = rows[-1][0]
+
+    def import_user(self, addr, enc_password, last_login):
+        self._get_conn().execute(
+            "INSERT INTO users (addr, password, last_login, version)"
+            " VALUES (?, ?, ?, ?) ON CONFLICT (addr) DO UPDATE"
+            " SET password=excluded.password, last_login=excluded.last_login,"
+            " version=max(version+1, excluded.version)",
+            (addr, enc_password, last_login, time.time_ns()),
+        )
+
+
+def make_user_store(name, mailboxes_dir, path=None, layout="flat"):
+    """Return the user store `name` for `mailboxes_dir` with `layout`.
+
+    The sqlite store is kept at `path`,
+    by default in SQLITE_STORE_NAME in the mailboxes directory.
+    """
+    if name == "maildir":
+        return MaildirUserStore(mailboxes_dir, layout)
+    if name == "sqlite":
+        return SqliteUserStore(path or mailboxes_dir.joinpath(SQLITE_STORE_NAME))
+    raise ValueError(f"invalid user_store {name!r}")
+
+
+def migrate_user_store(source, target):
+    """Copy all users of `source` to `target` and return their number."""
+    num = 0
+    for addr, enc_password, last_login in source.iter_users():
+        target.import_user(addr, enc_password, last_login)
+        num += 1
+        if num % 10000 == 0:
+            print(f"migration-progress: {num} users copied", file=sys.stderr)
+    return num
+
+
+def migrate_main(args=None):
+    """Copy all users to another user store.
+
+    Afterwards set "user_store" in chatmail.ini to the target store
+    and restart the chatmail services.
+    Users remain in the source store until they expire.
+    """
+    from .config import read_config
+
+    parser = ArgumentParser(description=migrate_main.__doc__)
+    parser.add_argument("chatmail_ini", help="path pointing to chatmail.ini file")
+    parser.add_argument("target", choices=USER_STORES, help="store to copy users to")
+    parser.add_argument(
+        "--source",
+        choices=USER_STORES,
+        default=None,
+        help="store to copy users from (default: the configured one)",
+    )
+    args = parser.parse_args(args)
+
+    config = read_config(args.chatmail_ini)
+    source_name = args.source or config.user_store
+    if source_name == args.target:
+        parser.error(f"source and target store are both {source_name!r}")
+    source = make_user_store(
+        source_name,
+        config.mailboxes_dir,
+        config.user_store_path,
+        config.mailboxes_layout,
+    )
+    target = make_user_store(
+        args.target,
+        config.mailboxes_dir,
+        config.user_store_path,
+        config.mailboxes_layout,
+    )
+    start = time.time()
+    num = migrate_user_store(source, target)
+    print(
+        f"copied {num} users from {source_name} to {args.target}"
+        f" store in {time.time() - start:.2f} seconds"
+    )
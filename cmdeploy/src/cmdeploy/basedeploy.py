@@ -6,6 +6,7 @@ from contextlib import contextmanager
 from pyinfra import host
 from pyinfra.facts.files import Sha256File
 from pyinfra.facts.server import Command
+from pyinfra.facts.systemd import SystemdEnabled
 from pyinfra.operations import files, server, systemd
 
 
@@ -51,6 +52,15 @@ def get_resource(arg, pkg=__package__):
     return importlib.resources.files(pkg).joinpath(arg)
 
 
+def get_unit_basenames(fn) -> list:
+    """Return unit file names for `fn`, a socket unit first if there is one."""
+    if "." in fn:
+        return [fn]
+    if get_resource(f"service/{fn}.socket.f").is_file():
+        return [f"{fn}.socket", f"{fn}.service"]
+    return [f"{fn}.service"]
+
+
 def configure_remote_units(deployer, mail_domain, units) -> None:
     remote_base_dir = "/usr/local/lib/chatmaild"
     remote_venv_dir = f"{remote_base_dir}/venv"
@@ -65,29 +75,43 @@ def configure_remote_units(deployer, mail_domain, units) -> None:
             mail_domain=mail_domain,
         )
 
-        basename = fn if "." in fn else f"{fn}.service"
-
-        source_path = get_resource(f"service/{basename}.f")
-        content = source_path.read_text().format(**params).encode()
+        for basename in get_unit_basenames(fn):
+            source_path = get_resource(f"service/{basename}.f")
+            content = source_path.read_text().format(**params).encode()
 
-        deployer.put_file(
-            src=io.BytesIO(content),
-            dest=f"/etc/systemd/system/{basename}",
-        )
+            deployer.put_file(
+                src=io.BytesIO(content),
+                dest=f"/etc/systemd/system/{basename}",
+            )
 
 
 def activate_remote_units(deployer, units) -> None:
     # activate systemd units
     for fn in units:
-        basename = fn if "." in fn else f"{fn}.service"
-
         if fn == "chatmail-expire" or fn == "chatmail-fsreport":
             # don't auto-start but let the corresponding timer trigger execution
             enabled = False
         else:
             enabled = True
 
-        deployer.ensure_service(basename, running=enabled, enabled=enabled)
+        for basename in get_unit_basenames(fn):
+            # Socket units are never restarted so that their listening socket
+            # stays open while the service behind it restarts.
+            restart = not basename.endswith(".socket")
+            deployer.ensure_service(
+                basename, running=enabled, enabled=enabled, restart=restart
+            )
+
+
+def deactivate_remote_units(deployer, units) -> None:
+    # stop and disable units which are enabled but no longer used
+    if not has_systemd():
+        return
+    enabled_units = host.get_fact(SystemdEnabled)
+    for fn in units:
+        for basename in reversed(get_unit_basenames(fn)):
+            if enabled_units.get(basename):
+                deployer.ensure_service(basename, running=False, enabled=False)
 
 
 class Deployment:
@@ -144,7 +168,7 @@ class Deployer:
     def activate(self):
         pass
 
-    def ensure_service(self, service, running=True, enabled=True):
+    def ensure_service(self, service, running=True, enabled=True, restart=True):
         if running:
             verb = "Start and enable"
         else:
@@ -154,7 +178,7 @@ class Deployer:
             service=service,
             running=running,
             enabled=enabled,
-            restarted=self.need_restart if running else False,
+            restarted=self.need_restart and restart if running else False,
             daemon_reload=self.daemon_reload,
         )
         self.daemon_reload = False
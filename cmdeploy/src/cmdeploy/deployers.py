@@ -24,6 +24,7 @@ from .basedeploy import (
     activate_remote_units,
     blocked_service_startup,
     configure_remote_units,
+    deactivate_remote_units,
     has_systemd,
     is_in_container,
 )
@@ -367,9 +368,16 @@ class JournaldDeployer(Deployer):
 class ChatmailVenvDeployer(Deployer):
     def __init__(self, config):
         self.config = config
+        if config.dictproxy_layout == "combined":
+            dictproxy_units = ("chatmail-dictproxy",)
+            # doveauth is stopped here already because stopping it
+            # removes its runtime directory containing the combined socket
+            self.stale_units = ("chatmail-metadata", "lastlogin", "doveauth")
+        else:
+            dictproxy_units = ("chatmail-metadata", "lastlogin")
+            self.stale_units = ("chatmail-dictproxy",)
         self.units = (
-            "chatmail-metadata",
-            "lastlogin",
+            *dictproxy_units,
             "chatmail-expire",
             "chatmail-expire.timer",
             "chatmail-fsreport",
@@ -384,6 +392,7 @@ class ChatmailVenvDeployer(Deployer):
         configure_remote_units(self, self.config.mail_domain_bare, self.units)
 
     def activate(self):
+        deactivate_remote_units(self, self.stale_units)
         activate_remote_units(self, self.units)
 
 
@@ -34,7 +34,11 @@ class DovecotDeployer(Deployer):
     def __init__(self, config, disable_mail):
         self.config = config
         self.disable_mail = disable_mail
-        self.units = ["doveauth"]
+        # with the combined layout doveauth is served by chatmail-dictproxy
+        if config.dictproxy_layout == "combined":
+            self.units = []
+        else:
+            self.units = ["doveauth"]
 
     def install(self):
         arch = host.get_fact(Arch)
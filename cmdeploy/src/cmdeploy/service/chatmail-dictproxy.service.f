@@ -0,0 +1,16 @@
+[Unit]
+Description=Chatmail dict proxies for dovecot authentication, IMAP METADATA and last-login tracking
+Requires=chatmail-dictproxy.socket
+After=chatmail-dictproxy.socket
+
+[Service]
+ExecStart={execpath} /run/doveauth/doveauth.socket /run/chatmail-metadata/metadata.socket /run/chatmail-lastlogin/lastlogin.socket {config_path}
+Restart=always
+RestartSec=5
+User=vmail
+RuntimeDirectory=doveauth chatmail-metadata chatmail-lastlogin
+RuntimeDirectoryPreserve=yes
+UMask=0077
+
+[Install]
+WantedBy=multi-user.target
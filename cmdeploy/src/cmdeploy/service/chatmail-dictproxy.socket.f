@@ -0,0 +1,14 @@
+[Unit]
+Description=Sockets of the chatmail dict proxies for dovecot
+
+[Socket]
+ListenStream=/run/doveauth/doveauth.socket
+ListenStream=/run/chatmail-metadata/metadata.socket
+ListenStream=/run/chatmail-lastlogin/lastlogin.socket
+SocketUser=vmail
+SocketGroup=vmail
+SocketMode=0600
+Backlog=1000
+
+[Install]
+WantedBy=sockets.target
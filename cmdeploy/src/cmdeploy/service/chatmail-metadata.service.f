@@ -1,5 +1,7 @@
 [Unit]
 Description=Chatmail dict proxy for IMAP METADATA
+Requires=chatmail-metadata.socket
+After=chatmail-metadata.socket
 
 [Service]
 ExecStart={execpath} /run/chatmail-metadata/metadata.socket {config_path}
@@ -7,6 +9,7 @@ Restart=always
 RestartSec=5
 User=vmail
 RuntimeDirectory=chatmail-metadata
+RuntimeDirectoryPreserve=yes
 UMask=0077
 
 [Install]
@@ -1,5 +1,7 @@
 [Unit]
 Description=Chatmail dict authentication proxy for dovecot
+Requires=doveauth.socket
+After=doveauth.socket
 
 [Service]
 ExecStart={execpath} /run/doveauth/doveauth.socket {config_path}
@@ -7,6 +9,7 @@ Restart=always
 RestartSec=30
 User=vmail
 RuntimeDirectory=doveauth
+RuntimeDirectoryPreserve=yes
 UMask=0077
 
 [Install]
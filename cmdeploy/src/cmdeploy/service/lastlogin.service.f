@@ -1,5 +1,7 @@
 [Unit]
 Description=Dict proxy for last-login tracking
+Requires=lastlogin.socket
+After=lastlogin.socket
 
 [Service]
 ExecStart={execpath} /run/chatmail-lastlogin/lastlogin.socket {config_path}
@@ -7,6 +9,7 @@ Restart=always
 RestartSec=30
 User=vmail
 RuntimeDirectory=chatmail-lastlogin
+RuntimeDirectoryPreserve=yes
 
 [Install]
 WantedBy=multi-user.target
@@ -1,3 +1,9 @@
+import pytest
+
+from cmdeploy import remote
+from cmdeploy.cmdeploy import get_sshexec
+
+
 def test_tls_imap(benchmark, imap):
     def imap_connect():
         imap.connect()
@@ -13,6 +19,52 @@ def test_login_imap(benchmark, imap, gencreds):
     benchmark(imap_connect_and_login, 10)
 
 
+class TestAuthCache:
+    """Compare IMAP logins answered by Dovecot's auth cache
+    with logins which need a doveauth lookup."""
+
+    NUM_LOGINS = 20
+
+    @pytest.fixture
+    def accounts(self, make_imap_connection, gencreds):
+        accounts = [gencreds() for i in range(self.NUM_LOGINS)]
+        for user, password in accounts:
+            make_imap_connection().login(user, password)
+        return accounts
+
+    @pytest.fixture
+    def flush_auth_cache(self, sshdomain):
+        sshexec = get_sshexec(sshdomain, verbose=False)
+
+        def flush():
+            sshexec(
+                call=remote.rshell.shell,
+                kwargs=dict(command="doveadm auth cache flush", fail_ok=True),
+            )
+
+        return flush
+
+    def bench_logins(self, benchmark, imap, accounts, name):
+        creds = iter(accounts)
+
+        def login():
+            imap.connect()
+            imap.login(*next(creds))
+
+        def report(vmin, vmedian, vmax):
+            yield f"{name}: {1 / vmedian:.1f} logins per second (median)"
+
+        benchmark(login, len(accounts), name=name, reportfunc=report)
+
+    def test_login_uncached(self, benchmark, imap, accounts, flush_auth_cache):
+        flush_auth_cache()
+        self.bench_logins(benchmark, imap, accounts, "login_imap_uncached")
+
+    def test_login_cached(self, benchmark, imap, accounts):
+        # the logins creating the accounts filled the cache
+        self.bench_logins(benchmark, imap, accounts, "login_imap_cached")
+
+
 def test_tls_smtp(benchmark, smtp):
     def smtp_connect():
         smtp.connect()
@@ -1,6 +1,11 @@
 from unittest.mock import MagicMock, patch
 
-from cmdeploy.basedeploy import Deployer
+from cmdeploy.basedeploy import (
+    Deployer,
+    activate_remote_units,
+    configure_remote_units,
+    get_unit_basenames,
+)
 
 
 def test_put_file_restart_and_reload():
@@ -116,3 +121,37 @@ def test_ensure_service():
         second_call = mock_svc.call_args_list[1]
         assert second_call.kwargs["restarted"] is True
         assert second_call.kwargs["daemon_reload"] is False
+
+
+def test_get_unit_basenames():
+    assert get_unit_basenames("doveauth") == ["doveauth.socket", "doveauth.service"]
+    assert get_unit_basenames("chatmail-expire") == ["chatmail-expire.service"]
+    assert get_unit_basenames("chatmail-expire.timer") == ["chatmail-expire.timer"]
+
+
+def test_activate_remote_units_keeps_sockets_open():
+    deployer = Deployer()
+    deployer.need_restart = True
+    with patch("cmdeploy.basedeploy.systemd.service") as mock_svc:
+        activate_remote_units(deployer, ["lastlogin"])
+        calls = [c.kwargs for c in mock_svc.call_args_list]
+        assert [c["service"] for c in calls] == [
+            "lastlogin.socket",
+            "lastlogin.service",
+        ]
+        assert [c["restarted"] for c in calls] == [False, True]
+
+
+def test_configure_remote_units_installs_sockets():
+    deployer = Deployer()
+    mock_res = MagicMock()
+    mock_res.changed = False
+    with patch("cmdeploy.basedeploy.files.put", return_value=mock_res) as mock_put:
+        configure_remote_units(deployer, "chat.example.org", ["chatmail-dictproxy"])
+        dests = [c.kwargs["dest"] for c in mock_put.call_args_list]
+        assert dests == [
+            "/etc/systemd/system/chatmail-dictproxy.socket",
+            "/etc/systemd/system/chatmail-dictproxy.service",
+        ]
+        socket_unit = mock_put.call_args_list[0].kwargs["src"].getvalue().decode()
+        assert "ListenStream=/run/doveauth/doveauth.socket" in socket_unit
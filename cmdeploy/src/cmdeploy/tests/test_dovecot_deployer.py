@@ -2,8 +2,10 @@ from contextlib import nullcontext
 from types import SimpleNamespace
 
 import pytest
+from jinja2 import Template
 from pyinfra.facts.deb import DebPackages
 
+from cmdeploy.basedeploy import get_resource
 from cmdeploy.dovecot import deployer as dovecot_deployer
 
 
@@ -33,7 +35,7 @@ def make_host(*fact_pairs):
 @pytest.fixture
 def deployer():
     return dovecot_deployer.DovecotDeployer(
-        SimpleNamespace(mail_domain="chat.example.org"),
+        SimpleNamespace(mail_domain="chat.example.org", dictproxy_layout="separate"),
         disable_mail=False,
     )
 
@@ -235,3 +237,39 @@ def test_pick_url_falls_back_on_primary_error(monkeypatch):
     assert result == "http://fallback", (
         f"should fall back when primary fails, got {result!r}"
     )
+
+
+@pytest.mark.parametrize("layout,units", [("separate", ["doveauth"]), ("combined", [])])
+def test_dictproxy_layout_units(layout, units):
+    deployer = dovecot_deployer.DovecotDeployer(
+        SimpleNamespace(mail_domain="chat.example.org", dictproxy_layout=layout),
+        disable_mail=False,
+    )
+    assert deployer.units == units
+
+
+def render_dovecot_conf(config):
+    template = get_resource("dovecot/dovecot.conf.j2").read_text()
+    return Template(template).render(config=config, debug=False, disable_ipv6=False)
+
+
+def test_auth_cache_config(make_config):
+    conf = render_dovecot_conf(make_config("chat.example.org"))
+    assert "auth_cache_ttl = 3600 secs" in conf
+    assert "auth_cache_negative_ttl = 300 secs" in conf
+    assert "unix_listener auth-master {" in conf
+
+    config = make_config("chat.example.org", {"auth_cache_ttl": "0"})
+    assert "auth_cache_ttl" not in render_dovecot_conf(config)
+
+
+def test_mailboxes_layout_config(make_config):
+    config = make_config("chat.example.org")
+    conf = render_dovecot_conf(config)
+    assert f"mail_location = maildir:{config.mailboxes_dir}/%u\n" in conf
+    assert f"quota-warning 350 {config.mailboxes_dir}/%u\n" in conf
+
+    config = make_config("chat.example.org", {"mailboxes_layout": "hashed"})
+    conf = render_dovecot_conf(config)
+    assert f"mail_location = maildir:{config.mailboxes_dir}/%2Mu/%2.2Mu/%u\n" in conf
+    assert "quota-warning 350 %h\n" in conf